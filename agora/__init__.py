@@ -1 +1,8 @@
+import os
+
 __version__ = '0.3.0'
+
+# the job imports its feature modules where they are used, after the inline
+# runner changed into the working directory of the task, so the package
+# must not be found through a relative sys.path entry such as ''
+__path__ = [os.path.abspath(p) for p in __path__]
@@ -0,0 +1,371 @@
+"""
+Resumable local runs for long backfills.
+
+A month of logs takes hours on the local runner, and a run that dies
+starts again from zero. agora-backfill runs the session summary job in two
+phases over a work directory:
+
+* map: every input file is cut into chunks of lines. Each chunk is parsed
+  (as ``agora --mapper`` would), sorted by key and spilled to its own file,
+  then appended to the journal
+* reduce: the spills are merged by key and every stream is summarized into
+  the output, which is written next to it and renamed into place when done
+
+    agora-backfill -o 2014-09.out logs/2014-09-*/*.gz
+    agora-backfill --resume -o 2014-09.out logs/2014-09-*/*.gz
+
+The journal (``journal.jsonl``) holds one JSON record per completed chunk,
+written only once its spill has been synced and renamed into place. With
+``--resume`` the chunks of the journal whose spills are intact are skipped;
+their lines are still read to find the next chunk, but not parsed. A torn
+last record, or a record whose spill is missing, is redone. The reduce
+phase is a single pass and is redone from the spills if it was interrupted.
+A work directory that isn't empty and has no journal is refused; only the
+journal, spill and merge files are removed from it.
+
+Events of a stream reach the reducer in input order, whichever chunks were
+resumed, so a resumed run writes the same output as an uninterrupted one.
+"""
+import heapq
+import itertools
+import json
+import os
+import sys
+import time
+from optparse import OptionParser
+
+from agora.diff import line_key
+from agora.ingest import COUNTERS, map_events, open_input
+from agora.jobs import stream_stats
+from agora.logs import SNIFF_LINES, LineParser, get_format, sniff_format
+from mrjob.protocol import JSONProtocol
+
+JOURNAL_FILE = 'journal.jsonl'
+
+# lines per map chunk, the most work lost when a run dies
+CHUNK_LINES = 200000
+
+# spills merged at once, more are merged in passes
+MERGE_WIDTH = 64
+
+
+class BackfillError(Exception):
+    pass
+
+
+def fingerprint(path):
+    '''
+    Size and modification time of an input, a changed input isn't resumed
+    '''
+    stat = os.stat(path)
+    return [stat.st_size, int(stat.st_mtime)]
+
+
+def _sync_write(path, lines):
+    '''
+    Writes lines to path through a temporary file, so path is either
+    missing or complete
+    '''
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.writelines(lines)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+
+
+class Journal(object):
+    """
+    Append-only record of the map chunks a run has completed.
+    """
+
+    def __init__(self, work_dir):
+        self.work_dir = work_dir
+        self.path = os.path.join(work_dir, JOURNAL_FILE)
+        self.inputs = None
+        self.chunk_lines = None
+        # (input number, chunk number) -> record
+        self.chunks = {}
+
+    def load(self):
+        '''
+        Reads the consistent part of the journal
+        '''
+        if not os.path.exists(self.path):
+            return self
+        with open(self.path, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # torn by a crash while appending, redone
+                    break
+                if 'inputs' in record:
+                    self.inputs = record['inputs']
+                    self.chunk_lines = record['chunk_lines']
+                elif self._intact(record):
+                    self.chunks[(record['input'], record['chunk'])] = record
+        return self
+
+    def _intact(self, record):
+        spill = os.path.join(self.work_dir, record['spill'])
+        return os.path.exists(spill) and \
+            os.path.getsize(spill) == record['bytes']
+
+    def start(self, inputs, chunk_lines):
+        '''
+        Starts a new journal for inputs, [[path, fingerprint]...]
+        '''
+        self.inputs = inputs
+        self.chunk_lines = chunk_lines
+        self.chunks = {}
+        _sync_write(self.path, [json.dumps(
+            {'inputs': inputs, 'chunk_lines': chunk_lines}) + '\n'])
+
+    def add(self, record):
+        with open(self.path, 'ab') as f:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.chunks[(record['input'], record['chunk'])] = record
+
+    def spills(self):
+        '''
+        Spill files in input order
+        '''
+        return [os.path.join(self.work_dir, self.chunks[chunk]['spill'])
+                for chunk in sorted(self.chunks)]
+
+    def counters(self):
+        totals = dict.fromkeys(COUNTERS, 0)
+        for record in self.chunks.itervalues():
+            for name, value in record['counters'].iteritems():
+                totals[name] = totals.get(name, 0) + value
+        return totals
+
+
+def _chunks(path, chunk_lines):
+    '''
+    (chunk number, format, lines) of an input, with the format sniffed from
+    its first lines
+    '''
+    f = open_input(path)
+    try:
+        lines = iter(f)
+        head = list(itertools.islice(lines, SNIFF_LINES))
+        log_format = sniff_format(head)
+        lines = itertools.chain(head, lines)
+        for number in itertools.count():
+            chunk = list(itertools.islice(lines, chunk_lines))
+            if not chunk:
+                break
+            yield number, log_format, chunk
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def _read_spill(path, order):
+    with open(path, 'rb') as f:
+        for line in f:
+            yield line_key(line), order, line
+
+
+def merge_spills(paths, work_dir, width=MERGE_WIDTH):
+    '''
+    Lines of sorted spills merged by key, lines of a key in the order of
+    paths. More than width spills are merged in passes through work_dir
+    '''
+    passes = itertools.count()
+    while len(paths) > width:
+        number = next(passes)
+        merged = []
+        for start in range(0, len(paths), width):
+            path = os.path.join(
+                work_dir, 'merge-%03d-%05d' % (number, start // width))
+            _sync_write(path, merge_spills(paths[start:start + width],
+                                           work_dir, width))
+            merged.append(path)
+        # only intermediate merges are removed, spills stay for a resume
+        for path in paths:
+            if os.path.basename(path).startswith('merge-'):
+                os.remove(path)
+        paths = merged
+    streams = [_read_spill(path, order) for order, path in enumerate(paths)]
+    return (line for _, _, line in heapq.merge(*streams))
+
+
+def reduce_spills(lines, output, isp_lookup=None, geo_lookup=None):
+    '''
+    Summarizes the merged map output, one summary per stream, with the
+    job's agora.jobs.stream_stats. Returns the number of streams
+    '''
+    protocol = JSONProtocol()
+    streams = 0
+    for _, group in itertools.groupby(lines, line_key):
+        pairs = (protocol.read(line.rstrip('\n')) for line in group)
+        key, event = next(pairs)
+        stats, _ = stream_stats(
+            itertools.chain([event], (event for _, event in pairs)),
+            isp_lookup, geo_lookup)
+        output.write(protocol.write(key, stats.summary()) + '\n')
+        streams += 1
+    return streams
+
+
+class Backfill(object):
+    """
+    A resumable local run of the session summary job.
+    """
+
+    def __init__(self, work_dir, chunk_lines=CHUNK_LINES, isp_lookup=None,
+                 geo_lookup=None):
+        self.work_dir = work_dir
+        self.chunk_lines = chunk_lines
+        self.isp_lookup = isp_lookup
+        self.geo_lookup = geo_lookup
+        self.journal = Journal(work_dir)
+        self.stats = {'chunks': 0, 'resumed_chunks': 0, 'streams': 0,
+                      'map_seconds': 0.0, 'reduce_seconds': 0.0}
+
+    def run(self, paths, output_path, resume=False):
+        '''
+        Runs the job over paths into output_path, resuming the journal of
+        the work directory when resume is set
+        '''
+        inputs = [[path, fingerprint(path)] for path in paths]
+        if resume:
+            self.journal.load()
+            if self.journal.inputs is not None and (
+                    self.journal.inputs != inputs or
+                    self.journal.chunk_lines != self.chunk_lines):
+                raise BackfillError(
+                    "inputs or chunk size don't match the journal in %s"
+                    % self.work_dir)
+        if not resume or self.journal.inputs is None:
+            if os.path.exists(self.work_dir):
+                if os.listdir(self.work_dir) and not os.path.exists(
+                        self.journal.path):
+                    raise BackfillError(
+                        '%s is not a work directory of agora-backfill'
+                        % self.work_dir)
+                self._remove_work()
+            else:
+                os.makedirs(self.work_dir)
+            self.journal.start(inputs, self.chunk_lines)
+
+        started = time.time()
+        for number, path in enumerate(paths):
+            self._map(number, path)
+        self.stats['map_seconds'] = time.time() - started
+
+        started = time.time()
+        tmp_path = output_path + '.tmp'
+        with open(tmp_path, 'wb') as output:
+            self.stats['streams'] = reduce_spills(
+                merge_spills(self.journal.spills(), self.work_dir),
+                output, self.isp_lookup, self.geo_lookup)
+            output.flush()
+            os.fsync(output.fileno())
+        # the output appears complete or not at all
+        os.rename(tmp_path, output_path)
+        self.stats['reduce_seconds'] = time.time() - started
+        return self.journal.counters()
+
+    def _map(self, number, path):
+        # parses like the job's mapper, the format can change inside a file
+        parser = None
+        for chunk, log_format, lines in _chunks(path, self.chunk_lines):
+            if parser is None:
+                parser = LineParser(log_format)
+            self.stats['chunks'] += 1
+            record = self.journal.chunks.get((number, chunk))
+            if record is not None:
+                self.stats['resumed_chunks'] += 1
+                # the format the chunk ended in
+                parser.log_format = get_format(
+                    record.get('format', parser.log_format.name))
+                continue
+            output, counts = map_events(parser.parse_lines(lines))
+            output = [line + '\n' for line in output]
+            output.sort(key=line_key)
+            spill = 'map-%05d-%06d' % (number, chunk)
+            _sync_write(os.path.join(self.work_dir, spill), output)
+            self.journal.add({
+                'input': number, 'chunk': chunk, 'spill': spill,
+                'lines': len(lines), 'bytes': sum(len(l) for l in output),
+                'counters': counts, 'format': parser.log_format.name})
+
+    def _remove_work(self):
+        '''
+        Removes the journal, spills and merges of a run, leaving anything
+        else in the work directory alone
+        '''
+        for name in os.listdir(self.work_dir):
+            if name in (JOURNAL_FILE, JOURNAL_FILE + '.tmp') or \
+                    name.startswith(('map-', 'merge-')):
+                os.remove(os.path.join(self.work_dir, name))
+
+    def clean(self):
+        if not os.path.isdir(self.work_dir):
+            return
+        self._remove_work()
+        if not os.listdir(self.work_dir):
+            os.rmdir(self.work_dir)
+
+
+def main(args=None):
+    """
+    Run the session summary job locally, resumably
+    """
+    parser = OptionParser(usage='%prog -o OUTPUT [options] FILE...')
+    parser.add_option('-o', '--output', help='output file of the summaries')
+    parser.add_option('--work-dir', default=None,
+                      help='journal and spills (default: OUTPUT.work)')
+    parser.add_option('--resume', action='store_true', default=False,
+                      help='skip the chunks the journal has completed')
+    parser.add_option('--chunk-lines', type='int', default=CHUNK_LINES,
+                      help='input lines per map chunk')
+    parser.add_option('--keep-work', action='store_true', default=False,
+                      help="don't remove the work directory when done")
+    parser.add_option('--isp_db',
+                      help='Optional: path to ISP-lookup database')
+    parser.add_option('--geo_db',
+                      help='Optional: path to City-lookup database')
+    options, paths = parser.parse_args(args)
+    if not options.output:
+        parser.error('no output file given')
+    if not paths:
+        parser.error('no input files')
+    if '-' in paths:
+        parser.error("stdin can't be resumed")
+
+    isp_lookup = geo_lookup = None
+    if options.isp_db or options.geo_db:
+        import pygeoip
+        if options.isp_db:
+            isp_lookup = pygeoip.GeoIP(
+                options.isp_db, pygeoip.MEMORY_CACHE)
+        if options.geo_db:
+            geo_lookup = pygeoip.GeoIP(
+                options.geo_db, pygeoip.MEMORY_CACHE)
+
+    backfill = Backfill(options.work_dir or options.output + '.work',
+                        options.chunk_lines, isp_lookup, geo_lookup)
+    try:
+        counters = backfill.run(paths, options.output, options.resume)
+    except BackfillError, e:
+        parser.error(str(e))
+    if not options.keep_work:
+        backfill.clean()
+    stats = backfill.stats
+    print >> sys.stderr, (
+        '%(chunks)d chunks (%(resumed_chunks)d resumed), %(streams)d '
+        'streams, map %(map_seconds).1fs, reduce %(reduce_seconds).1fs'
+        % stats)
+    for name in COUNTERS:
+        print >> sys.stderr, '%s: %d' % (name, counters[name])
+
+
+if __name__ == '__main__':
+    main()
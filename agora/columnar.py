@@ -0,0 +1,312 @@
+"""
+Columnar output of session summaries, partitioned by day and source.
+
+Summaries are buffered per partition and written in large batches. The
+files are Parquet when pyarrow is installed, and typed TSV otherwise. A
+typed TSV file starts with a header row of name:type columns, followed by
+tab separated values with \\N for nulls and {1,2,3} for lists of ints.
+Partitions are hive-style directories,
+<dir>/day=YYYY-MM-DD/source=<source>/part-NNNNN.<ext>, so downstream
+loaders can skip whole days or sources without reading them.
+"""
+import os
+import sys
+import urllib
+from datetime import datetime
+from optparse import OptionParser
+
+from agora.stats import PBSVideoStats
+from mrjob.protocol import JSONProtocol
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+FORMATS = ('parquet', 'tsv')
+
+# rows buffered per partition before they're written out
+BATCH_SIZE = 50000
+
+# partition directory value of a missing day or source
+NULL_PARTITION = '__null__'
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def coerce(value, kind):
+    '''
+    value as a python object of a column type, None if it doesn't convert
+    '''
+    if value is None or value == '':
+        return None
+    try:
+        if kind == 'string':
+            if isinstance(value, basestring):
+                return value
+            return unicode(value)
+        if kind == 'int':
+            try:
+                return int(value)
+            except ValueError:
+                return int(float(value))
+        if kind == 'float':
+            return float(value)
+        if kind == 'bool':
+            if isinstance(value, bool):
+                return value
+            return str(value).lower() in ('true', '1')
+        if kind == 'timestamp':
+            if isinstance(value, datetime):
+                return value
+            return datetime.strptime(value, TIME_FORMAT)
+        if kind == 'ints':
+            if isinstance(value, basestring):
+                # {1,2,3}, as written to TSV
+                value = filter(None, value.strip('{}').split(','))
+            return [int(item) for item in value]
+    except (TypeError, ValueError):
+        return None
+    raise ValueError('unknown column type %r' % kind)
+
+
+def format_tsv_value(value, kind):
+    if value is None:
+        return '\\N'
+    if kind == 'bool':
+        return 'true' if value else 'false'
+    if kind == 'float':
+        return repr(value)
+    if kind == 'timestamp':
+        return value.strftime(TIME_FORMAT)
+    if kind == 'ints':
+        # the array literal PostgreSQL reads
+        return '{%s}' % ','.join(str(item) for item in value)
+    if kind == 'string':
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return value.replace('\\', '\\\\').replace('\t', '\\t') \
+            .replace('\n', '\\n').replace('\r', '\\r')
+    return str(value)
+
+
+def parse_tsv_value(text, kind):
+    if text == '\\N':
+        return None
+    if kind == 'string':
+        return text.decode('string_escape').decode('utf-8')
+    if kind == 'bool':
+        return text == 'true'
+    return coerce(text, kind)
+
+
+def read_tsv(path):
+    '''
+    Yields the rows of a typed TSV file as dicts
+    '''
+    with open(path) as f:
+        header = f.readline().rstrip('\n').split('\t')
+        fields = [column.split(':', 1) for column in header]
+        for line in f:
+            values = line.rstrip('\n').split('\t')
+            yield dict((name, parse_tsv_value(value, kind))
+                       for (name, kind), value in zip(fields, values))
+
+
+def partition_of(summary):
+    '''
+    (day, source) partition of a session summary
+    '''
+    day = summary['earliest_time'][:10] if summary.get('earliest_time') \
+        else None
+    return day, summary.get('source')
+
+
+def partition_path(output_dir, partition):
+    day, source = partition
+    if isinstance(source, unicode):
+        source = source.encode('utf-8')
+    return os.path.join(
+        output_dir,
+        'day=%s' % (day or NULL_PARTITION),
+        # quote so a source can't step out of its directory
+        'source=%s' % (urllib.quote(source, safe='') if source
+                       else NULL_PARTITION))
+
+
+def _next_part(directory, extension):
+    '''
+    Path of the first unused part file, so repeated runs add to a partition
+    '''
+    existing = os.listdir(directory)
+    number = 0
+    while 'part-%05d.%s' % (number, extension) in existing:
+        number += 1
+    return os.path.join(directory, 'part-%05d.%s' % (number, extension))
+
+
+class _TSVFile(object):
+
+    extension = 'tsv'
+
+    def __init__(self, path, fields):
+        self.fields = fields
+        self.file = open(path, 'w')
+        self.file.write('\t'.join('%s:%s' % field for field in fields) + '\n')
+
+    def write_batch(self, rows):
+        kinds = [kind for _, kind in self.fields]
+        self.file.writelines(
+            '\t'.join(format_tsv_value(value, kind)
+                      for value, kind in zip(row, kinds)) + '\n'
+            for row in rows)
+
+    def close(self):
+        self.file.close()
+
+
+class _ParquetFile(object):
+
+    extension = 'parquet'
+
+    def __init__(self, path, fields):
+        types = {
+            'string': pyarrow.string(),
+            'int': pyarrow.int64(),
+            'float': pyarrow.float64(),
+            'bool': pyarrow.bool_(),
+            'timestamp': pyarrow.timestamp('s'),
+            'ints': pyarrow.list_(pyarrow.int64()),
+        }
+        self.names = [name for name, _ in fields]
+        self.types = [types[kind] for _, kind in fields]
+        self.schema = pyarrow.schema(
+            [pyarrow.field(name, type_)
+             for name, type_ in zip(self.names, self.types)])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write_batch(self, rows):
+        columns = zip(*rows)
+        arrays = [pyarrow.array(list(column), type=type_)
+                  for column, type_ in zip(columns, self.types)]
+        self.writer.write_table(
+            pyarrow.Table.from_arrays(arrays, names=self.names))
+
+    def close(self):
+        self.writer.close()
+
+
+class ColumnarWriter(object):
+    """
+    Writes session summaries to partitioned columnar files.
+    """
+
+    def __init__(self, output_dir, fmt=None, batch_size=BATCH_SIZE,
+                 fields=PBSVideoStats.SUMMARY_FIELDS):
+        if fmt is None:
+            fmt = 'parquet' if pyarrow is not None else 'tsv'
+        if fmt not in FORMATS:
+            raise ValueError('unknown format %r' % fmt)
+        if fmt == 'parquet' and pyarrow is None:
+            raise ValueError('parquet output needs pyarrow')
+        self.output_dir = output_dir
+        self.format = fmt
+        self.batch_size = batch_size
+        self.fields = fields
+        # partition -> buffered rows, partition -> open file
+        self.buffers = {}
+        self.files = {}
+        self.paths = []
+        self.rows = 0
+
+    def write(self, summary):
+        row = [coerce(summary.get(name), kind) for name, kind in self.fields]
+        partition = partition_of(summary)
+        rows = self.buffers.setdefault(partition, [])
+        rows.append(row)
+        self.rows += 1
+        if len(rows) >= self.batch_size:
+            self._flush(partition)
+
+    def _flush(self, partition):
+        rows = self.buffers.pop(partition, None)
+        if not rows:
+            return
+        out = self.files.get(partition)
+        if out is None:
+            directory = partition_path(self.output_dir, partition)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            cls = _ParquetFile if self.format == 'parquet' else _TSVFile
+            path = _next_part(directory, cls.extension)
+            out = self.files[partition] = cls(path, self.fields)
+            self.paths.append(path)
+        out.write_batch(rows)
+
+    def close(self):
+        '''
+        Writes everything that is buffered, returns the paths written
+        '''
+        for partition in sorted(self.buffers):
+            self._flush(partition)
+        for out in self.files.itervalues():
+            out.close()
+        self.files = {}
+        return self.paths
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_summaries(lines):
+    '''
+    Session summaries of VideoStreamCondense output lines, skipping
+    rollups and anything else that isn't a session summary
+    '''
+    protocol = JSONProtocol()
+    for line in lines:
+        _, value = protocol.read(line.rstrip('\r\n'))
+        if isinstance(value, dict) and 'tracking_id' in value:
+            yield value
+
+
+def main(args=None):
+    """
+    Convert session summaries from job output to partitioned columnar files
+    """
+    parser = OptionParser(usage='%prog -o DIR [options] [FILE...]')
+    parser.add_option('-o', '--output-dir', help='root of the partitions')
+    parser.add_option('--format', type='choice', choices=FORMATS,
+                      default=None,
+                      help='parquet or tsv (default: parquet when pyarrow '
+                           'is installed)')
+    parser.add_option('-b', '--batch-size', type='int', default=BATCH_SIZE,
+                      help='rows buffered per partition before writing')
+    options, paths = parser.parse_args(args)
+    if not options.output_dir:
+        parser.error('no output directory given')
+    try:
+        writer = ColumnarWriter(options.output_dir, options.format,
+                                options.batch_size)
+    except ValueError, e:
+        parser.error(str(e))
+
+    for path in paths or ['-']:
+        f = sys.stdin if path == '-' else open(path)
+        try:
+            for summary in read_summaries(f):
+                writer.write(summary)
+        finally:
+            if f is not sys.stdin:
+                f.close()
+    written = writer.close()
+    print >> sys.stderr, '%d summaries in %d %s files' % (
+        writer.rows, len(written), writer.format)
+
+
+if __name__ == '__main__':
+    main()
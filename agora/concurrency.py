@@ -0,0 +1,69 @@
+"""
+Concurrent viewers per minute from session play intervals.
+
+Each session contributes a +1 boundary at the first minute it was playing
+in and a -1 boundary after the last one, per run of consecutive minutes.
+Boundaries are summed per minute (combiners do most of that) and a sorted
+sweep over the distinct minutes turns them into concurrency counts, so
+the cost is O(n log n) in the number of boundaries and memory is bounded
+by the number of distinct minutes rather than by sessions.
+"""
+import calendar
+import time
+
+
+def to_minute(timestamp):
+    '''
+    Minutes since the epoch of a (UTC) datetime
+    '''
+    return calendar.timegm(timestamp.timetuple()) // 60
+
+
+def format_minute(minute):
+    return time.strftime('%Y-%m-%d %H:%M', time.gmtime(minute * 60))
+
+
+def session_boundaries(intervals):
+    '''
+    [minute, delta] boundaries of one session's (start, end) play
+    intervals. A session counts once in every minute it played in, even
+    if it paused and resumed within that minute.
+    '''
+    ranges = sorted((to_minute(start), to_minute(end))
+                    for start, end in intervals)
+    merged = []
+    for first, last in ranges:
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], last)
+        else:
+            merged.append([first, last])
+    boundaries = []
+    for first, last in merged:
+        boundaries.append([first, 1])
+        boundaries.append([last + 1, -1])
+    return boundaries
+
+
+def sum_deltas(boundaries):
+    '''
+    minute -> summed delta of [minute, delta] boundaries
+    '''
+    deltas = {}
+    for minute, delta in boundaries:
+        deltas[minute] = deltas.get(minute, 0) + delta
+    return deltas
+
+
+def sweep(deltas):
+    '''
+    Yields (minute, concurrency) for every minute from the first boundary
+    up to the last minute with anyone playing
+    '''
+    minutes = sorted(m for m, delta in deltas.iteritems() if delta)
+    current = 0
+    for index, minute in enumerate(minutes):
+        current += deltas[minute]
+        if index + 1 == len(minutes):
+            break
+        for m in xrange(minute, minutes[index + 1]):
+            yield m, current
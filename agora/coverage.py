@@ -0,0 +1,131 @@
+"""
+Support matrix of which events and custom fields each player sends.
+"""
+import glob
+import json
+import os
+
+# Events and custom fields that are tracked in the support matrix
+EVENT_TYPES = (
+    'MediaStarted',
+    'MediaEnded',
+    'MediaCompleted',
+    'MediaFailed',
+    'MediaQualityChange',
+    'MediaQualityChangeAuto',
+    'MediaQualityChangeProgramatically',
+    'MediaInitialBufferStart',
+    'MediaInitialBufferEnd',
+    'MediaBufferingStart',
+    'MediaBufferingEnd',
+    'MediaScrub',
+)
+
+CUSTOM_FIELDS = (
+    'x_useragent',
+    'x_tpmid',
+    'x_episode_title',
+    'x_program_title',
+    'x_producer',
+    'x_video_length',
+    'x_client_id',
+    'x_session_id',
+    'x_tracking_id',
+    'x_video_location',
+    'x_stream_size',
+    'x_flash_player',
+    'x_buffering_length',
+    'x_encoding_name',
+    'x_auto',
+    'x_bandwidth',
+    'x_after_seek',
+    'x_start_time',
+    'x_previous_quality',
+    'x_new_quality',
+)
+
+
+class SupportMatrix(object):
+    """
+    Per source_tag counts of the known event types and custom fields.
+
+    Matrices built from different files or tasks are merged with merge(),
+    and travel between processes as plain dicts (to_dict/from_dict).
+    """
+
+    def __init__(self):
+        # source_tag -> {'events': {...}, 'custom_fields': {...}}
+        self.sources = {}
+
+    def source(self, source_tag):
+        '''
+        Counts of a source_tag, all zero for a source_tag not seen yet
+        '''
+        counts = self.sources.get(source_tag)
+        if counts is None:
+            counts = {
+                'events': dict.fromkeys(EVENT_TYPES, 0),
+                'custom_fields': dict.fromkeys(CUSTOM_FIELDS, 0),
+            }
+            self.sources[source_tag] = counts
+        return counts
+
+    def add_event(self, fields):
+        '''
+        Counts the event type and custom fields of a parsed event
+        '''
+        counts = self.source(fields.get('source_tag'))
+        events = counts['events']
+        custom_fields = counts['custom_fields']
+        for key in fields:
+            # If the key is an event, increment counter for that event
+            if key == 'event_type':
+                if fields[key] in events:
+                    events[fields[key]] += 1
+
+            # If key is a custom field, increment counter for that field
+            elif key in custom_fields:
+                custom_fields[key] += 1
+
+    def merge(self, other):
+        for source_tag, other_counts in other.sources.iteritems():
+            counts = self.source(source_tag)
+            for group in ('events', 'custom_fields'):
+                for key, value in other_counts[group].iteritems():
+                    counts[group][key] = counts[group].get(key, 0) + value
+        return self
+
+    def to_dict(self):
+        return self.sources
+
+    @classmethod
+    def from_dict(cls, data):
+        matrix = cls()
+        matrix.merge_dict(data)
+        return matrix
+
+    def merge_dict(self, data):
+        other = SupportMatrix()
+        other.sources = data
+        return self.merge(other)
+
+
+def write_coverage(matrix, path):
+    '''
+    Writes the matrix of one task to its side file, as [source_tag, counts]
+    pairs since events without a source_tag count under None
+    '''
+    with open(path, 'w') as f:
+        json.dump(sorted(matrix.sources.iteritems()), f, sort_keys=True)
+
+
+def read_coverage(directory):
+    '''
+    Support matrix merged from the side files the tasks of a job wrote
+    to directory
+    '''
+    matrix = SupportMatrix()
+    for path in sorted(glob.glob(os.path.join(directory, 'coverage-*.json'))):
+        with open(path) as f:
+            matrix.merge_dict(dict(json.load(f)))
+    return matrix
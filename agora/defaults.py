@@ -0,0 +1,19 @@
+"""
+Defaults of the job options that tune feature modules.
+
+They live apart from the modules that use them so that agora.jobs can
+offer them as option defaults without importing those modules in every
+task.
+"""
+
+# events between tracemalloc snapshots
+SNAPSHOT_INTERVAL = 10000
+
+# default accuracy parameter of the quantile sketches
+K = 200
+
+# default standard error of the distinct count sketches
+HLL_ERROR = 0.01
+
+# number of items reported per heavy hitter summary
+TOP_K = 50
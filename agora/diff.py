@@ -0,0 +1,346 @@
+"""
+Streaming comparison of two job outputs.
+
+Proving that a change to the parser or to PBSVideoStats leaves the output
+alone means comparing two outputs of millions of summaries. Both outputs
+are sorted by their key (the tracking key of session summaries) with an
+external merge sort, or read as they are when already sorted, and then
+merge-joined, so memory use doesn't depend on their size:
+
+    agora-diff before/part-* -- after/part-*
+    agora-diff --sorted --tolerance 0.001 before.sorted after.sorted
+
+Records whose value text is identical are never decoded. For the others,
+every field is compared, numbers within the tolerance, and mismatches are
+counted per field with a few samples.
+"""
+import heapq
+import itertools
+import json
+import shutil
+import sys
+import tempfile
+from optparse import OptionParser
+
+# bytes of lines sorted in memory per run
+BUFFER_SIZE = 256 * 1024 * 1024
+
+# samples kept per mismatching field
+SAMPLES = 5
+
+# field name of values that aren't dicts
+VALUE = '<value>'
+
+
+class UnsortedInputError(Exception):
+    pass
+
+
+def line_key(line):
+    '''
+    Key text of a tab separated job output line
+    '''
+    tab = line.find('\t')
+    return line[:tab] if tab >= 0 else line.rstrip('\n')
+
+
+def _write_run(lines, tmp_dir):
+    lines.sort(key=line_key)
+    f = tempfile.NamedTemporaryFile(
+        'wb', dir=tmp_dir, prefix='run-', delete=False)
+    with f:
+        f.writelines(lines)
+    return f.name
+
+
+def _read_run(path):
+    with open(path, 'rb') as f:
+        for line in f:
+            yield line_key(line), line
+
+
+def external_sort(lines, tmp_dir=None, buffer_size=BUFFER_SIZE):
+    '''
+    Yields lines sorted by line_key, holding at most about buffer_size bytes
+    of them in memory. Lines with the same key keep their input order.
+    Sorted runs are spilled to a directory in tmp_dir.
+    '''
+    tmp_dir = tempfile.mkdtemp(dir=tmp_dir, prefix='agora-sort-')
+    try:
+        runs = []
+        chunk = []
+        size = 0
+        for line in lines:
+            if not line.endswith('\n'):
+                line += '\n'
+            chunk.append(line)
+            size += len(line)
+            if size >= buffer_size:
+                runs.append(_write_run(chunk, tmp_dir))
+                chunk = []
+                size = 0
+        if not runs:
+            # fits in memory
+            chunk.sort(key=line_key)
+            for line in chunk:
+                yield line
+            return
+        if chunk:
+            runs.append(_write_run(chunk, tmp_dir))
+        chunk = None
+        # (key, run number, line) keeps the merge stable
+        merged = heapq.merge(*[
+            ((key, number, line) for key, line in _read_run(path))
+            for number, path in enumerate(runs)])
+        for _, _, line in merged:
+            yield line
+    finally:
+        shutil.rmtree(tmp_dir, True)
+
+
+def check_sorted(lines, name='input'):
+    '''
+    Passes lines through, raising UnsortedInputError when a key is out of
+    order
+    '''
+    previous = None
+    for line in lines:
+        key = line_key(line)
+        if previous is not None and key < previous:
+            raise UnsortedInputError(
+                '%s is not sorted: %s after %s' % (name, key, previous))
+        previous = key
+        yield line
+
+
+def values_equal(left, right, tolerance=0.0, rel_tolerance=0.0):
+    '''
+    Decoded JSON values are equal, numbers within the tolerances
+    '''
+    if isinstance(left, bool) or isinstance(right, bool):
+        return left is right
+    if isinstance(left, (int, long, float)) and \
+            isinstance(right, (int, long, float)):
+        if left == right:
+            return True
+        return abs(left - right) <= max(
+            tolerance, rel_tolerance * max(abs(left), abs(right)))
+    if isinstance(left, list) and isinstance(right, list):
+        return len(left) == len(right) and all(
+            values_equal(l, r, tolerance, rel_tolerance)
+            for l, r in itertools.izip(left, right))
+    if isinstance(left, dict) and isinstance(right, dict):
+        return set(left) == set(right) and all(
+            values_equal(left[k], right[k], tolerance, rel_tolerance)
+            for k in left)
+    return left == right
+
+
+class Diff(object):
+    """
+    Counts of a merge join of two sorted outputs.
+    """
+
+    def __init__(self, tolerance=0.0, rel_tolerance=0.0, ignore=(),
+                 samples=SAMPLES):
+        self.tolerance = tolerance
+        self.rel_tolerance = rel_tolerance
+        self.ignore = set(ignore)
+        self.samples = samples
+        self.left = 0
+        self.right = 0
+        self.identical = 0
+        self.equal = 0
+        self.different = 0
+        self.only_left = []
+        self.only_right = []
+        self.only_left_count = 0
+        self.only_right_count = 0
+        # field -> mismatch count, field -> [(key, left, right)]
+        self.fields = {}
+        self.field_samples = {}
+
+    def run(self, left_lines, right_lines):
+        '''
+        Merge-joins two sorted outputs
+        '''
+        left = self._records(left_lines, 'left')
+        right = self._records(right_lines, 'right')
+        left_record = next(left, None)
+        right_record = next(right, None)
+        while left_record is not None or right_record is not None:
+            if right_record is None or (
+                    left_record is not None and
+                    left_record[0] < right_record[0]):
+                self._only('left', left_record)
+                left_record = next(left, None)
+            elif left_record is None or right_record[0] < left_record[0]:
+                self._only('right', right_record)
+                right_record = next(right, None)
+            else:
+                self._compare(left_record, right_record)
+                left_record = next(left, None)
+                right_record = next(right, None)
+        return self
+
+    def _records(self, lines, side):
+        for line in lines:
+            setattr(self, side, getattr(self, side) + 1)
+            key = line_key(line)
+            yield key, line[len(key) + 1:].rstrip('\n')
+
+    def _only(self, side, record):
+        setattr(self, 'only_%s_count' % side,
+                getattr(self, 'only_%s_count' % side) + 1)
+        samples = getattr(self, 'only_' + side)
+        if len(samples) < self.samples:
+            samples.append(record[0])
+
+    def _compare(self, left, right):
+        key, left_text = left
+        if left_text == right[1]:
+            self.identical += 1
+            return
+        left_value = json.loads(left_text)
+        right_value = json.loads(right[1])
+        if not (isinstance(left_value, dict) and
+                isinstance(right_value, dict)):
+            left_value = {VALUE: left_value}
+            right_value = {VALUE: right_value}
+        mismatched = False
+        for field in sorted(set(left_value) | set(right_value)):
+            if field in self.ignore:
+                continue
+            l, r = left_value.get(field), right_value.get(field)
+            if (field in left_value) != (field in right_value) or \
+                    not values_equal(l, r, self.tolerance,
+                                     self.rel_tolerance):
+                mismatched = True
+                self.fields[field] = self.fields.get(field, 0) + 1
+                samples = self.field_samples.setdefault(field, [])
+                if len(samples) < self.samples:
+                    samples.append([key, l, r])
+        if mismatched:
+            self.different += 1
+        else:
+            self.equal += 1
+
+    def differs(self):
+        return bool(self.different or self.only_left_count or
+                    self.only_right_count)
+
+    def report(self):
+        return {
+            'left': self.left,
+            'right': self.right,
+            'identical': self.identical,
+            'equal_within_tolerance': self.equal,
+            'different': self.different,
+            'only_left': self.only_left_count,
+            'only_right': self.only_right_count,
+            'only_left_samples': self.only_left,
+            'only_right_samples': self.only_right,
+            'fields': dict(
+                (field, {'mismatches': count,
+                         'samples': self.field_samples[field]})
+                for field, count in self.fields.iteritems()),
+        }
+
+
+def print_report(report, out=sys.stdout):
+    print >> out, 'left: %(left)d records, right: %(right)d records' % report
+    print >> out, ('identical: %(identical)d, equal within tolerance: '
+                   '%(equal_within_tolerance)d, different: %(different)d'
+                   % report)
+    for side in ('left', 'right'):
+        if report['only_' + side]:
+            print >> out, 'only in %s: %d, e.g. %s' % (
+                side, report['only_' + side],
+                ', '.join(report['only_%s_samples' % side]))
+    for field, result in sorted(report['fields'].iteritems(),
+                                key=lambda f: -f[1]['mismatches']):
+        print >> out, '%s: %d mismatches' % (field, result['mismatches'])
+        for key, left, right in result['samples']:
+            print >> out, '    %s: %s != %s' % (
+                key, json.dumps(left), json.dumps(right))
+
+
+def _open_all(paths):
+    '''
+    Lines of several files, one after the other
+    '''
+    for path in paths:
+        if path == '-':
+            for line in sys.stdin:
+                yield line
+            continue
+        with open(path, 'rb') as f:
+            for line in f:
+                yield line
+
+
+def main(args=None):
+    """
+    Compare two job outputs record by record
+    """
+    parser = OptionParser(
+        usage='%prog [options] LEFT_FILE... -- RIGHT_FILE...\n'
+              '       %prog [options] LEFT_FILE RIGHT_FILE')
+    parser.add_option('--sorted', action='store_true', default=False,
+                      help='inputs are already sorted by key')
+    parser.add_option('--tolerance', type='float', default=0.0,
+                      help='absolute difference allowed between numbers')
+    parser.add_option('--rel-tolerance', type='float', default=0.0,
+                      help='relative difference allowed between numbers')
+    parser.add_option('--ignore', action='append', default=[],
+                      help='field not to compare, can be repeated')
+    parser.add_option('--samples', type='int', default=SAMPLES,
+                      help='samples listed per mismatching field')
+    parser.add_option('-S', '--buffer-size', type='int', default=BUFFER_SIZE,
+                      help='bytes sorted in memory per run')
+    parser.add_option('-T', '--tmp-dir', default=None,
+                      help='directory for sorted runs')
+    parser.add_option('--json', action='store_true', default=False,
+                      help='print the report as JSON')
+    args = list(sys.argv[1:] if args is None else args)
+    if '--' in args:
+        split = args.index('--')
+        options, left = parser.parse_args(args[:split])
+        right = args[split + 1:]
+    else:
+        options, paths = parser.parse_args(args)
+        if len(paths) != 2:
+            parser.error('give two files, or files separated by --')
+        left, right = paths[:1], paths[1:]
+    if not left or not right:
+        parser.error('nothing to compare')
+
+    inputs = []
+    for name, paths in (('left', left), ('right', right)):
+        lines = _open_all(paths)
+        if options.sorted:
+            inputs.append(check_sorted(lines, name))
+        else:
+            inputs.append(external_sort(
+                lines, options.tmp_dir, options.buffer_size))
+    diff = Diff(options.tolerance, options.rel_tolerance, options.ignore,
+                options.samples)
+    try:
+        diff.run(*inputs)
+    except UnsortedInputError, e:
+        print >> sys.stderr, e
+        sys.exit(2)
+    finally:
+        # removes the sorted runs
+        for lines in inputs:
+            lines.close()
+    if options.json:
+        json.dump(diff.report(), sys.stdout, indent=2, sort_keys=True)
+        print
+    else:
+        print_report(diff.report())
+    sys.exit(1 if diff.differs() else 0)
+
+
+if __name__ == '__main__':
+    main()
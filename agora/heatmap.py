@@ -0,0 +1,79 @@
+"""
+Buffering heatmaps: where in a video buffering happens.
+
+Buffering positions are counted in fixed-width, array-backed histograms,
+by 30 second bins of the video position and by 5% bins of the video
+length. The last bin also counts everything past it, so a histogram never
+grows with the length of a video. Histograms are output as plain lists
+without trailing empty bins and merge by adding them up, so they can be
+summed per title and source by combiners and reducers.
+"""
+from array import array
+
+# seconds per position bin, and bins (the last one is 2 hours in and up)
+BIN_SECONDS = 30
+TIME_BINS = 240
+
+# bins of the video length, 5% each
+PERCENT_BINS = 20
+
+
+class PositionHistogram(object):
+    """
+    Counts in a fixed number of bins.
+    """
+
+    def __init__(self, bins, counts=()):
+        self.counts = array('l', [0]) * bins
+        self.merge(counts)
+
+    def add(self, index, count=1):
+        # anything past the last bin is counted in it
+        self.counts[max(min(index, len(self.counts) - 1), 0)] += count
+
+    def merge(self, counts):
+        '''
+        Adds the counts of another histogram, as a list
+        '''
+        for index, count in enumerate(counts):
+            if count:
+                self.add(index, count)
+        return self
+
+    def to_list(self):
+        '''
+        Counts without the trailing empty bins
+        '''
+        counts = self.counts.tolist()
+        while counts and not counts[-1]:
+            counts.pop()
+        return counts
+
+
+def _seconds(value):
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        return None
+    return seconds if seconds >= 0 else None
+
+
+def session_heatmaps(positions, video_length=None):
+    '''
+    (30 second bins, percent of video length bins) of the buffering
+    positions of a session. The percent bins are None without a video
+    length
+    '''
+    by_time = PositionHistogram(TIME_BINS)
+    length = _seconds(video_length)
+    by_percent = PositionHistogram(PERCENT_BINS) if length else None
+    for position in positions:
+        seconds = _seconds(position)
+        if seconds is None:
+            continue
+        by_time.add(int(seconds // BIN_SECONDS))
+        if by_percent is not None:
+            by_percent.add(int(seconds / length * PERCENT_BINS))
+    return by_time.to_list(), \
+        by_percent.to_list() if by_percent is not None else None
+
@@ -0,0 +1,154 @@
+"""
+HyperLogLog sketches for approximate distinct counts.
+
+Sketches with the same precision merge losslessly (register-wise max), so
+distinct viewers per day can be unioned into weeks without the raw ids.
+Small sketches are kept sparse until they would be larger than the dense
+register array, which keeps per-session partials tiny.
+"""
+import base64
+import hashlib
+import math
+import struct
+import zlib
+
+MIN_PRECISION = 4
+MAX_PRECISION = 16
+
+
+def precision_for_error(error_rate):
+    '''
+    Smallest precision whose standard error (1.04 / sqrt(2 ** p)) is at
+    most error_rate
+    '''
+    if not 0 < error_rate < 1:
+        raise ValueError('error_rate must be between 0 and 1')
+    p = int(math.ceil(math.log((1.04 / error_rate) ** 2, 2)))
+    return min(max(p, MIN_PRECISION), MAX_PRECISION)
+
+
+def _hash64(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif not isinstance(value, str):
+        value = str(value)
+    return struct.unpack('<Q', hashlib.md5(value).digest()[:8])[0]
+
+
+def _bit_length(value):
+    if not value:
+        return 0
+    return len(bin(value)) - 2
+
+
+class HyperLogLog(object):
+    """
+    HyperLogLog sketch with 2 ** precision registers.
+    """
+
+    def __init__(self, error_rate=0.01, precision=None):
+        self.p = precision or precision_for_error(error_rate)
+        if not MIN_PRECISION <= self.p <= MAX_PRECISION:
+            raise ValueError('precision must be between %d and %d' % (
+                MIN_PRECISION, MAX_PRECISION))
+        self.m = 1 << self.p
+        # index -> rank while sparse, then a bytearray of all registers
+        self.sparse = {}
+        self.registers = None
+
+    @property
+    def error_rate(self):
+        return 1.04 / math.sqrt(self.m)
+
+    def add(self, value):
+        h = _hash64(value)
+        bits = 64 - self.p
+        # register from the top p bits, rank from the leading zeros of
+        # the rest
+        rank = bits - _bit_length(h & ((1 << bits) - 1)) + 1
+        self._set(h >> bits, rank)
+
+    def _set(self, index, rank):
+        if self.registers is not None:
+            if rank > self.registers[index]:
+                self.registers[index] = rank
+        elif rank > self.sparse.get(index, 0):
+            self.sparse[index] = rank
+            # sparse entries serialize to 3 bytes, registers to 1 byte
+            if len(self.sparse) * 3 > self.m:
+                self._densify()
+
+    def _densify(self):
+        self.registers = bytearray(self.m)
+        for index, rank in self.sparse.iteritems():
+            self.registers[index] = rank
+        self.sparse = None
+
+    def merge(self, other):
+        '''
+        Union of this sketch and other, in place
+        '''
+        if other.p != self.p:
+            raise ValueError('can not merge sketches of precision %d and %d' %
+                             (self.p, other.p))
+        if other.registers is None:
+            for index, rank in other.sparse.iteritems():
+                self._set(index, rank)
+            return self
+        if self.registers is None:
+            self._densify()
+        registers = self.registers
+        for index, rank in enumerate(other.registers):
+            if rank > registers[index]:
+                registers[index] = rank
+        return self
+
+    def count(self):
+        '''
+        Estimated number of distinct values added
+        '''
+        m = self.m
+        if self.registers is None:
+            ranks = self.sparse.values()
+            zeros = m - len(ranks)
+        else:
+            ranks = self.registers
+            zeros = ranks.count('\x00')
+        total = zeros + sum(2.0 ** -r for r in ranks if r)
+        if m >= 128:
+            alpha = 0.7213 / (1 + 1.079 / m)
+        else:
+            alpha = {16: 0.673, 32: 0.697, 64: 0.709}[m]
+        estimate = alpha * m * m / total
+        if estimate <= 2.5 * m and zeros:
+            # small range correction (linear counting)
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+    def to_string(self):
+        '''
+        Compact ascii form: "<p>:s:<data>" for sparse or "<p>:d:<data>"
+        for dense sketches
+        '''
+        if self.registers is None:
+            data = ''.join(struct.pack('<HB', index, rank)
+                           for index, rank in sorted(self.sparse.iteritems()))
+            kind = 's'
+        else:
+            data = zlib.compress(str(self.registers))
+            kind = 'd'
+        return '%d:%s:%s' % (self.p, kind, base64.b64encode(data))
+
+    @classmethod
+    def from_string(cls, value):
+        p, kind, data = value.split(':', 2)
+        sketch = cls(precision=int(p))
+        data = base64.b64decode(data)
+        if kind == 's':
+            for offset in xrange(0, len(data), 3):
+                index, rank = struct.unpack_from('<HB', data, offset)
+                sketch._set(index, rank)
+        else:
+            sketch.sparse = None
+            sketch.registers = bytearray(zlib.decompress(data))
+        return sketch
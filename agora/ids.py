@@ -0,0 +1,43 @@
+"""
+Compact encoding of the UUID identifiers in goonhilly events.
+
+Tracking, session and client ids are mostly canonical UUID strings (36
+characters). Packed, they are 17 byte strings that sort and hash just as
+well, which is what local grouping and state storage key on. Ids that
+aren't canonical UUIDs are kept as they are, behind a marker byte.
+"""
+import uuid
+
+# first byte of a packed id
+UUID_MARKER = '\x01'
+RAW_MARKER = '\x00'
+
+
+def pack_id(value):
+    '''
+    Compact byte string of an id, see unpack_id
+    '''
+    if len(value) == 36 and value[8:9] == '-':
+        try:
+            packed = uuid.UUID(value)
+        except ValueError:
+            pass
+        else:
+            # only the canonical form round trips, anything else (upper
+            # case, braces) stays raw
+            if str(packed) == value:
+                return UUID_MARKER + packed.bytes
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return RAW_MARKER + value
+
+
+def unpack_id(packed):
+    '''
+    Original id of a pack_id() byte string, always unicode like the ids
+    of decoded events, so ids of both kinds sort and serialize alike
+    '''
+    if packed[:1] == UUID_MARKER:
+        return unicode(uuid.UUID(bytes=packed[1:]))
+    return packed[1:].decode('utf-8')
+
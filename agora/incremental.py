@@ -0,0 +1,276 @@
+"""
+Hourly micro-batches that incrementally refresh the day's session summaries.
+
+The serialized PBSVideoStats state of every stream seen so far is kept in a
+local state directory. Each new slice (an hour of logs) is grouped by
+stream, only the streams it touches are loaded, updated with the new events
+and saved again, and only their summaries are written out:
+
+    agora-incremental --state-dir state/2014-09-02 logs/2014-09-02/00.gz
+    agora-incremental --state-dir state/2014-09-02 logs/2014-09-02/01.gz
+    agora-incremental --state-dir state/2014-09-02 --dump
+
+The cost of a refresh depends on the size of the slice, not on how much of
+the day was processed before it. Slices are recorded by absolute path,
+size and modification time, and aren't applied twice unless forced.
+
+The state is a SQLite database. The streams a slice updates are staged and
+written in one transaction together with the slice's record, so a slice is
+either applied entirely or not at all. Rows are written one key at a time
+and the number of streams is kept in the database, so nothing reads the
+whole store but ``--dump`` and ``--compact``.
+"""
+import json
+import os
+import sqlite3
+import sys
+from optparse import OptionParser
+
+from agora.backfill import fingerprint
+from agora.ids import pack_id, unpack_id
+from agora.ingest import open_input
+from agora.logs import SNIFF_LINES, GoonHillyLog, sniff_format
+from agora.stats import PBSVideoStats
+from mrjob.protocol import JSONProtocol
+
+SESSIONS_FILE = 'sessions.db'
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS sessions (key BLOB PRIMARY KEY, state TEXT)',
+    'CREATE TABLE IF NOT EXISTS slices (slice TEXT PRIMARY KEY)',
+    'CREATE TABLE IF NOT EXISTS counts (name TEXT PRIMARY KEY, '
+    'value INTEGER)',
+    "INSERT OR IGNORE INTO counts VALUES ('sessions', 0)",
+)
+
+
+class SessionStore(object):
+    """
+    PBSVideoStats states of the streams of one day, keyed by packed
+    tracking key, and the slices already applied. Saved states are staged
+    until the next commit.
+    """
+
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.db = sqlite3.connect(os.path.join(directory, SESSIONS_FILE))
+        self.db.text_factory = str
+        for statement in SCHEMA:
+            self.db.execute(statement)
+        self.db.commit()
+        # packed key -> serialized state, not committed yet
+        self.staged = {}
+
+    def load(self, key, isp_lookup=None, geo_lookup=None):
+        '''
+        PBSVideoStats of a stream, a new one if it wasn't seen before
+        '''
+        packed = pack_id(key)
+        state = self.staged.get(packed)
+        if state is None:
+            row = self.db.execute('SELECT state FROM sessions WHERE key = ?',
+                                  (sqlite3.Binary(packed),)).fetchone()
+            state = row and row[0]
+        if state is None:
+            return PBSVideoStats(isp_lookup, geo_lookup)
+        return PBSVideoStats.from_state(json.loads(state), isp_lookup,
+                                        geo_lookup)
+
+    def save(self, key, stats):
+        self.staged[pack_id(key)] = json.dumps(stats.to_state())
+
+    def __len__(self):
+        stored = self.db.execute(
+            "SELECT value FROM counts WHERE name = 'sessions'").fetchone()[0]
+        return stored + sum(1 for packed in self.staged
+                            if not self._stored(packed))
+
+    def _stored(self, packed):
+        return self.db.execute('SELECT 1 FROM sessions WHERE key = ?',
+                               (sqlite3.Binary(packed),)).fetchone() \
+            is not None
+
+    def summaries(self, isp_lookup=None, geo_lookup=None):
+        '''
+        (key, summary) of every stream in the store, by key
+        '''
+        packed_keys = set(str(row[0]) for row in
+                          self.db.execute('SELECT key FROM sessions'))
+        packed_keys.update(self.staged)
+        for packed in sorted(packed_keys, key=unpack_id):
+            key = unpack_id(packed)
+            yield key, self.load(key, isp_lookup, geo_lookup).summary()
+
+    def has_slice(self, slice_key):
+        return self.db.execute('SELECT 1 FROM slices WHERE slice = ?',
+                               (slice_key,)).fetchone() is not None
+
+    def mark_slice(self, slice_key):
+        '''
+        Commits the states saved since the last commit together with the
+        record of a slice
+        '''
+        self.commit(slice_key)
+
+    def commit(self, slice_key=None):
+        '''
+        Writes the staged states, and the record of a slice, in one
+        transaction
+        '''
+        try:
+            added = 0
+            for packed, state in self.staged.iteritems():
+                key = sqlite3.Binary(packed)
+                if self.db.execute(
+                        'UPDATE sessions SET state = ? WHERE key = ?',
+                        (state, key)).rowcount == 0:
+                    self.db.execute('INSERT INTO sessions VALUES (?, ?)',
+                                    (key, state))
+                    added += 1
+            self.db.execute("UPDATE counts SET value = value + ? "
+                            "WHERE name = 'sessions'", (added,))
+            if slice_key is not None:
+                self.db.execute('INSERT OR IGNORE INTO slices VALUES (?)',
+                                (slice_key,))
+            self.db.commit()
+        except:
+            self.db.rollback()
+            raise
+        self.staged = {}
+
+    def compact(self):
+        '''
+        Gives the space of replaced states back, rewriting the whole store
+        '''
+        self.db.execute('VACUUM')
+
+    def close(self):
+        '''
+        Closes the store, dropping the states saved since the last commit
+        '''
+        self.staged = {}
+        self.db.close()
+
+
+def slice_key(path):
+    '''
+    Absolute path, size and modification time of a slice, a changed or
+    another file of the same name is a new slice
+    '''
+    return json.dumps([os.path.abspath(path)] + fingerprint(path))
+
+
+def read_events(path):
+    '''
+    Parsed events of a log file of any registered format, in file order
+    '''
+    f = open_input(path)
+    try:
+        lines = iter(f)
+        head = []
+        for line in lines:
+            head.append(line)
+            if len(head) >= SNIFF_LINES:
+                break
+        log_format = sniff_format(head)
+        for line in head:
+            yield log_format.parse(line)
+        for line in lines:
+            yield log_format.parse(line)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def group_events(events):
+    '''
+    Events grouped by stream, keeping their order within a stream
+    '''
+    streams = {}
+    for event in events:
+        key = event and GoonHillyLog.tracking_key(event)
+        if key:
+            streams.setdefault(key, []).append(event)
+    return streams
+
+
+def refresh(store, events, isp_lookup=None, geo_lookup=None):
+    '''
+    Adds a slice of events to the streams in store. Returns the refreshed
+    (key, summary) pairs of the streams the slice touched, by key
+    '''
+    refreshed = []
+    for key, stream in sorted(group_events(events).iteritems()):
+        stats = store.load(key, isp_lookup, geo_lookup)
+        for event in stream:
+            stats.add_event(event)
+        store.save(key, stats)
+        refreshed.append((key, stats.summary()))
+    return refreshed
+
+
+def main(args=None):
+    """
+    Apply hourly slices of logs to a day's session state and print the
+    refreshed summaries
+    """
+    parser = OptionParser(usage='%prog --state-dir DIR [options] [FILE...]')
+    parser.add_option('--state-dir', help='session state of the day')
+    parser.add_option('--force', action='store_true', default=False,
+                      help='apply slices that were already applied')
+    parser.add_option('--dump', action='store_true', default=False,
+                      help='print the summaries of all streams in the state')
+    parser.add_option('--compact', action='store_true', default=False,
+                      help='reclaim the space of replaced states when done')
+    parser.add_option('--isp_db',
+                      help='Optional: path to ISP-lookup database')
+    parser.add_option('--geo_db',
+                      help='Optional: path to City-lookup database')
+    options, paths = parser.parse_args(args)
+    if not options.state_dir:
+        parser.error('no state directory given')
+    if '-' in paths:
+        parser.error("stdin can't be recorded as a slice")
+
+    isp_lookup = geo_lookup = None
+    if options.isp_db or options.geo_db:
+        import pygeoip
+        if options.isp_db:
+            isp_lookup = pygeoip.GeoIP(
+                options.isp_db, pygeoip.MEMORY_CACHE)
+        if options.geo_db:
+            geo_lookup = pygeoip.GeoIP(
+                options.geo_db, pygeoip.MEMORY_CACHE)
+
+    protocol = JSONProtocol()
+    store = SessionStore(options.state_dir)
+    try:
+        for path in paths:
+            key = slice_key(path)
+            if store.has_slice(key) and not options.force:
+                print >> sys.stderr, 'skipping %s, already applied' % path
+                continue
+            refreshed = refresh(store, read_events(path), isp_lookup,
+                                geo_lookup)
+            # the slice's streams and its record are committed together
+            store.mark_slice(key)
+            if not options.dump:
+                for key, summary in refreshed:
+                    print protocol.write(key, summary)
+            print >> sys.stderr, '%s: %d streams refreshed' % (
+                path, len(refreshed))
+        if options.dump:
+            for key, summary in store.summaries(isp_lookup, geo_lookup):
+                print protocol.write(key, summary)
+        if options.compact:
+            store.compact()
+        print >> sys.stderr, '%d streams in %s' % (
+            len(store), options.state_dir)
+    finally:
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,450 @@
+"""
+Sidecar byte-offset index for goonhilly log files.
+
+Instead of grepping a whole day of logs for one stream, build an index once
+per file and pull the matching lines straight from their offsets:
+
+    agora-index build logs/2014-09-02/*.gz
+    agora-index query logs/2014-09-02/*.gz --tracking-id 7c575311-...
+    agora-index query logs/2014-09-02/*.gz --start-ms 1409678400000 \\
+        --end-ms 1409678460000
+
+The index lives next to the log (``<file>.agidx``) and holds one fixed-size
+record per keyed line: a 64 bit hash of ``x_tracking_id``, the event minute
+and the uncompressed byte offset of the line. Records are sorted by hash so
+a tracking id lookup is a binary search. A second section holds the minute
+and offset of every line sorted by minute, so a time window is a binary
+search too. The index file is mapped into memory and records are unpacked
+only when a search touches them. The header records the log format sniffed
+from the first lines of the file, so queried lines are parsed without
+sniffing them again.
+
+Gzip files can only be entered at the start of a gzip member. Every member
+boundary is stored as a checkpoint, so files written by
+``agora-index recompress`` (a multi-member gzip that any gunzip can read)
+are seekable at block granularity. Single-member gzip files are inflated
+from the start but only the indexed lines are parsed.
+"""
+import bisect
+import calendar
+import gzip
+import hashlib
+import itertools
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+import zlib
+from optparse import OptionParser
+
+from agora.ids import pack_id, unpack_id
+from agora.logs import SNIFF_LINES, GoonHillyLog, LineParser, get_format, \
+    sniff_format
+from agora.stats import PBSVideoStats
+from mrjob.protocol import JSONProtocol
+
+INDEX_SUFFIX = '.agidx'
+INDEX_MAGIC = 'AGIX'
+INDEX_VERSION = 3
+
+# default amount of uncompressed data per gzip member
+BLOCK_SIZE = 4 * 1024 * 1024
+
+READ_SIZE = 256 * 1024
+
+
+class LogIndexError(Exception):
+    pass
+
+
+def key_hash(tracking_id):
+    '''
+    64 bit hash of a tracking id as stored in the index
+    '''
+    if isinstance(tracking_id, unicode):
+        tracking_id = tracking_id.encode('utf-8')
+    return struct.unpack('<Q', hashlib.md5(tracking_id).digest()[:8])[0]
+
+
+def event_millis(event):
+    '''
+    Event time in milliseconds since the epoch (event dates are UTC)
+    '''
+    edate = time.strptime(event['event_date'], '%Y-%m-%d %H:%M:%S')
+    return calendar.timegm(edate) * 1000
+
+
+def is_gzip(path):
+    with open(path, 'rb') as f:
+        return f.read(2) == '\x1f\x8b'
+
+
+def iter_lines(path):
+    '''
+    Yields (uncompressed offset, line) for every line of path, together
+    with the gzip member checkpoints as (uncompressed, compressed) offset
+    pairs through the returned list
+    '''
+    checkpoints = [(0, 0)]
+
+    def generate():
+        if not is_gzip(path):
+            offset = 0
+            with open(path, 'rb') as f:
+                for line in f:
+                    yield offset, line
+                    offset += len(line)
+            return
+
+        offset = 0
+        # file offset of the next chunk and uncompressed bytes so far
+        compressed = 0
+        uncompressed = 0
+        pending = ''
+        inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(READ_SIZE)
+                if not chunk:
+                    break
+                data = []
+                while chunk:
+                    data.append(inflater.decompress(chunk))
+                    uncompressed += len(data[-1])
+                    rest = inflater.unused_data
+                    if not rest:
+                        compressed += len(chunk)
+                        break
+                    # a gzip member ended inside this chunk, the rest of
+                    # it starts the next member
+                    data.append(inflater.flush())
+                    uncompressed += len(data[-1])
+                    compressed += len(chunk) - len(rest)
+                    checkpoints.append((uncompressed, compressed))
+                    inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    chunk = rest
+                pending += ''.join(data)
+                lines = pending.split('\n')
+                pending = lines.pop()
+                for line in lines:
+                    yield offset, line + '\n'
+                    offset += len(line) + 1
+        if pending:
+            yield offset, pending
+
+    return checkpoints, generate()
+
+
+def write_seekable_gzip(src, dst, block_size=BLOCK_SIZE):
+    '''
+    Recompresses src (plain or gzip) into a multi-member gzip file with a
+    member starting on a line boundary every block_size bytes
+    '''
+    _, lines = iter_lines(src)
+    with open(dst, 'wb') as out:
+        block = []
+        size = 0
+        for _, line in lines:
+            block.append(line)
+            size += len(line)
+            if size >= block_size:
+                _write_member(out, block)
+                block = []
+                size = 0
+        if block:
+            _write_member(out, block)
+
+
+def _write_member(out, lines):
+    member = gzip.GzipFile(fileobj=out, mode='wb', mtime=0)
+    member.write(''.join(lines))
+    member.close()
+
+
+class PackedRecords(object):
+    """
+    Sorted fixed-size records in a buffer, unpacked on access. Items are
+    the first field of each record, so bisect can search them.
+    """
+
+    def __init__(self, record, data, start, count):
+        self.record = record
+        self.data = data
+        self.start = start
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        return self.record.unpack_from(
+            self.data, self.start + i * self.record.size)[0]
+
+    def records(self, first, last):
+        '''
+        Unpacked records first to last (exclusive)
+        '''
+        unpack = self.record.unpack_from
+        size = self.record.size
+        return [unpack(self.data, self.start + i * size)
+                for i in xrange(first, last)]
+
+
+class LogIndex(object):
+    """
+    Sidecar index, over its packed records.
+    """
+    # (hash, minute, offset), sorted
+    RECORD = struct.Struct('<QIQ')
+    # (minute, offset), sorted
+    MINUTE_RECORD = struct.Struct('<IQ')
+
+    def __init__(self, header, data, count, start=0):
+        self.header = header
+        self.count = count
+        self.by_hash = PackedRecords(self.RECORD, data, start, count)
+        self.by_minute = PackedRecords(
+            self.MINUTE_RECORD, data, start + count * self.RECORD.size,
+            count)
+
+    @classmethod
+    def build(cls, path):
+        checkpoints, lines = iter_lines(path)
+        # the format is sniffed once, from the first lines of the file
+        head = list(itertools.islice(lines, SNIFF_LINES))
+        log_format = sniff_format([line for _, line in head])
+        parser = LineParser(log_format)
+        records = []
+        count = 0
+        for offset, line in itertools.chain(head, lines):
+            count += 1
+            event = parser.parse(line)
+            if not event or not event.get('x_tracking_id'):
+                continue
+            try:
+                minute = event_millis(event) // 60000
+            except (KeyError, TypeError, ValueError):
+                continue
+            records.append(
+                (key_hash(event['x_tracking_id']), minute, offset))
+        records.sort()
+        pack = cls.RECORD.pack
+        data = [pack(*r) for r in records]
+        pack = cls.MINUTE_RECORD.pack
+        data.extend(pack(minute, offset) for minute, offset in
+                    sorted((r[1], r[2]) for r in records))
+        stat = os.stat(path)
+        header = {
+            'path': os.path.basename(path),
+            'size': stat.st_size,
+            'mtime': int(stat.st_mtime),
+            'gzip': is_gzip(path),
+            'checkpoints': checkpoints,
+            'lines': count,
+            'format': log_format.name,
+        }
+        return cls(header, ''.join(data), len(records))
+
+    def save(self, index_path):
+        header = json.dumps(self.header)
+        tmp_path = index_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(INDEX_MAGIC)
+            f.write(struct.pack('<BII', INDEX_VERSION, len(header),
+                                self.count))
+            f.write(header)
+            for section in (self.by_hash, self.by_minute):
+                size = section.count * section.record.size
+                f.write(section.data[section.start:section.start + size])
+        os.rename(tmp_path, index_path)
+
+    @classmethod
+    def load(cls, index_path):
+        '''
+        Maps an index file, only the pages searches touch are read
+        '''
+        with open(index_path, 'rb') as f:
+            if f.read(4) != INDEX_MAGIC:
+                raise LogIndexError('%s is not an agora index' % index_path)
+            version, header_size, count = struct.unpack('<BII', f.read(9))
+            if version != INDEX_VERSION:
+                raise LogIndexError(
+                    'unsupported index version %d, rebuild it with '
+                    'agora-index build' % version)
+            header = json.loads(f.read(header_size))
+            start = f.tell()
+            size = start + count * (cls.RECORD.size + cls.MINUTE_RECORD.size)
+            if os.fstat(f.fileno()).st_size != size:
+                raise LogIndexError('%s is truncated' % index_path)
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(header, data, count, start)
+
+    def check(self, path):
+        '''
+        Raises LogIndexError if the index is stale for path
+        '''
+        stat = os.stat(path)
+        if (stat.st_size != self.header['size'] or
+                int(stat.st_mtime) != self.header['mtime']):
+            raise LogIndexError('index for %s is out of date' % path)
+
+    def offsets_for_tracking_id(self, tracking_id):
+        h = key_hash(tracking_id)
+        start = bisect.bisect_left(self.by_hash, h)
+        end = bisect.bisect_right(self.by_hash, h, start)
+        return sorted(r[2] for r in self.by_hash.records(start, end))
+
+    def offsets_for_window(self, start_ms, end_ms):
+        start = bisect.bisect_left(self.by_minute, start_ms // 60000)
+        end = bisect.bisect_right(self.by_minute, end_ms // 60000, start)
+        return sorted(r[1] for r in self.by_minute.records(start, end))
+
+
+def index_path_for(path):
+    return path + INDEX_SUFFIX
+
+
+def build_index(path):
+    '''
+    Builds and saves the sidecar index for path
+    '''
+    index = LogIndex.build(path)
+    index.save(index_path_for(path))
+    return index
+
+
+def read_lines_at(path, index, offsets):
+    '''
+    Yields the lines of path that start at the given sorted uncompressed
+    offsets, entering gzip files at the nearest preceding checkpoint
+    '''
+    if not index.header['gzip']:
+        with open(path, 'rb') as f:
+            for offset in offsets:
+                f.seek(offset)
+                yield f.readline()
+        return
+
+    checkpoints = index.header['checkpoints']
+    starts = [c[0] for c in checkpoints]
+    with open(path, 'rb') as f:
+        stream = None
+        base = None
+        for offset in offsets:
+            checkpoint = checkpoints[bisect.bisect_right(starts, offset) - 1]
+            if stream is None or checkpoint[0] > base + stream.tell() or \
+                    offset < base + stream.tell():
+                # jump to the member holding the line
+                f.seek(checkpoint[1])
+                stream = gzip.GzipFile(fileobj=f, mode='rb')
+                base = checkpoint[0]
+            stream.seek(offset - base)
+            yield stream.readline()
+
+
+def query(paths, tracking_id=None, start_ms=None, end_ms=None):
+    '''
+    Yields the parsed events for a tracking id and/or time window (in
+    milliseconds since the epoch) from indexed log files
+    '''
+    for path in paths:
+        index = LogIndex.load(index_path_for(path))
+        index.check(path)
+        if tracking_id is not None:
+            offsets = index.offsets_for_tracking_id(tracking_id)
+        else:
+            offsets = index.offsets_for_window(start_ms, end_ms)
+        parser = LineParser(get_format(index.header['format']))
+        for line in read_lines_at(path, index, offsets):
+            event = parser.parse(line)
+            if not event:
+                continue
+            if tracking_id is not None and \
+                    event.get('x_tracking_id') != tracking_id:
+                # hash collision
+                continue
+            if start_ms is not None or end_ms is not None:
+                millis = event_millis(event)
+                if start_ms is not None and millis < start_ms:
+                    continue
+                if end_ms is not None and millis > end_ms:
+                    continue
+            yield event
+
+
+def summarize(events, isp_lookup=None, geo_lookup=None):
+    '''
+    Runs events through PBSVideoStats, one summary per stream
+    '''
+    streams = {}
+    for event in events:
+        key = GoonHillyLog.tracking_key(event)
+        if not key:
+            continue
+        # group on the compact form of the tracking id
+        key = pack_id(key)
+        if key not in streams:
+            streams[key] = PBSVideoStats(isp_lookup, geo_lookup)
+        streams[key].add_event(event)
+    for key in sorted(streams, key=unpack_id):
+        yield unpack_id(key), streams[key].summary()
+
+
+def main(args=None):
+    """
+    Build, query or recompress sidecar indexes
+    """
+    parser = OptionParser(
+        usage='%prog build FILE...\n'
+              '       %prog query FILE... (--tracking-id ID | '
+              '--start-ms MS --end-ms MS) [--events]\n'
+              '       %prog recompress SRC DST [--block-size BYTES]')
+    parser.add_option('--tracking-id', help='x_tracking_id to pull')
+    parser.add_option('--start-ms', type='long',
+                      help='window start, ms since the epoch')
+    parser.add_option('--end-ms', type='long',
+                      help='window end, ms since the epoch')
+    parser.add_option('--events', action='store_true', default=False,
+                      help='print raw events instead of stream summaries')
+    parser.add_option('--block-size', type='int', default=BLOCK_SIZE,
+                      help='uncompressed bytes per gzip member')
+    options, args = parser.parse_args(args)
+    if not args:
+        parser.error('no command given')
+    command, paths = args[0], args[1:]
+    if not paths:
+        parser.error('no input files')
+
+    protocol = JSONProtocol()
+    if command == 'build':
+        for path in paths:
+            index = build_index(path)
+            sys.stderr.write('%s: %d lines, %d keyed, %d checkpoints\n' % (
+                path, index.header['lines'], index.count,
+                len(index.header['checkpoints'])))
+    elif command == 'recompress':
+        if len(paths) != 2:
+            parser.error('recompress takes SRC and DST')
+        write_seekable_gzip(paths[0], paths[1], options.block_size)
+    elif command == 'query':
+        if options.tracking_id is None and (
+                options.start_ms is None or options.end_ms is None):
+            parser.error('give --tracking-id or --start-ms and --end-ms')
+        events = query(paths, options.tracking_id,
+                       options.start_ms, options.end_ms)
+        if options.events:
+            for event in events:
+                print json.dumps(event)
+        else:
+            for key, summary in summarize(events):
+                print protocol.write(key, summary)
+    else:
+        parser.error('unknown command: %s' % command)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,382 @@
+"""
+Streaming ingest pipeline for local runs.
+
+Reading a day of compressed logs is split into three stages connected by
+bounded queues so that decompression, parsing and output overlap:
+
+* a reader thread decompresses the inputs and cuts them into batches of lines
+* a pool of parse worker processes turns each batch into mapper output
+* a writer (the calling thread) writes the batches out in input order
+
+Back-pressure policy: at most ``max_pending`` batches are in flight between
+the reader and the writer.  When that limit is reached the reader blocks
+until the writer has drained a batch, so memory stays bounded whichever
+stage is the slow one.  Time spent blocked is reported per stage.
+
+The output is identical to ``agora -r local --mapper``, so it can be fed
+straight into the reducer.
+"""
+import bz2
+import gzip
+import io
+import itertools
+import logging
+import multiprocessing
+import os
+import subprocess
+import sys
+import threading
+import time
+from optparse import OptionParser
+from Queue import Queue
+
+from agora.logs import SNIFF_LINES, GoonHillyLog, LineParser, get_format, \
+    sniff_format
+from agora.objectstore import (MAX_BUFFER, WORKERS, PrefetchReader, S3Store,
+                               is_uri)
+from mrjob.protocol import JSONProtocol
+
+log = logging.getLogger(__name__)
+
+# External decompressors, in order of preference. They run in their own
+# process so decompression overlaps with parsing; pzstd and lbzip2 also
+# decompress independent blocks in parallel, pigz offloads reading,
+# writing and checksumming to helper threads (a single gzip member can't
+# be inflated in parallel).
+DECOMPRESSORS = {
+    '.gz': (['pigz', '-dc'], ['gzip', '-dc']),
+    '.zst': (['pzstd', '-dcq'], ['zstd', '-dcq']),
+    '.bz2': (['lbzip2', '-dc'], ['pbzip2', '-dc']),
+}
+
+# mapper counters reported by every parse batch
+COUNTERS = ('total-events', 'valid-events', 'unparsable-events',
+            'keyless-events')
+
+
+def _which(program):
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        candidate = os.path.join(directory, program)
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+    return None
+
+
+class _ProcessReader(object):
+    """
+    File-like wrapper around the stdout of a decompressor process.
+    """
+
+    def __init__(self, command, path):
+        self.command = command
+        self.proc = subprocess.Popen(
+            command + [path], stdout=subprocess.PIPE, bufsize=-1)
+
+    def __iter__(self):
+        return iter(self.proc.stdout)
+
+    def close(self):
+        self.proc.stdout.close()
+        if self.proc.wait():
+            raise IOError('%s exited with status %d' % (
+                ' '.join(self.command), self.proc.returncode))
+
+
+def open_input(path, external=True):
+    '''
+    Opens a (possibly compressed) log file for line-by-line reading,
+    preferring an external parallel decompressor when one is installed
+    '''
+    if path == '-':
+        return sys.stdin
+    ext = os.path.splitext(path)[1]
+    if external:
+        for command in DECOMPRESSORS.get(ext, ()):
+            if _which(command[0]):
+                return _ProcessReader(command, path)
+    if ext == '.gz':
+        return io.BufferedReader(gzip.open(path, 'rb'))
+    if ext == '.bz2':
+        return bz2.BZ2File(path, 'rb')
+    if ext == '.zst':
+        # optional dependency, only needed without a zstd binary
+        import zstandard
+        return io.BufferedReader(
+            zstandard.ZstdDecompressor().stream_reader(open(path, 'rb')))
+    return io.open(path, 'rb')
+
+
+def parse_batch(lines, format_name='json'):
+    '''
+    Parses a batch of raw log lines of a registered format into serialized
+    mapper output. Lines the format can't parse are handled like the job's
+    mapper does (agora.logs.LineParser). Returns the output lines, the
+    mapper counters and the time spent.
+    '''
+    started = time.time()
+    parser = LineParser(get_format(format_name))
+    output, counts = map_events(parser.parse_lines(lines))
+    return output, counts, time.time() - started
+
+
+def map_events(events):
+    '''
+    Serialized mapper output and mapper counters of parsed events, None
+    for lines that couldn't be parsed
+    '''
+    protocol = JSONProtocol()
+    output = []
+    counts = dict.fromkeys(COUNTERS, 0)
+    for event in events:
+        counts['total-events'] += 1
+        key = event and GoonHillyLog.tracking_key(event)
+        if not event:
+            counts['unparsable-events'] += 1
+        elif key:
+            counts['valid-events'] += 1
+            output.append(protocol.write(key, event))
+        else:
+            counts['keyless-events'] += 1
+    return output, counts
+
+
+class _Deferred(object):
+    """
+    Stand-in for an AsyncResult when parsing runs in the writer thread.
+    """
+
+    def __init__(self, lines, format_name):
+        self.lines = lines
+        self.format_name = format_name
+
+    def get(self):
+        return parse_batch(self.lines, self.format_name)
+
+
+class StageStats(object):
+    """
+    Throughput counters for one stage of the pipeline.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.lines = 0
+        self.batches = 0
+        self.bytes = 0
+        # time spent doing work and time spent waiting on a neighbour
+        self.busy = 0.0
+        self.blocked = 0.0
+
+    def as_dict(self, elapsed):
+        return {
+            'stage': self.name,
+            'lines': self.lines,
+            'batches': self.batches,
+            'bytes': self.bytes,
+            'busy_seconds': round(self.busy, 3),
+            'blocked_seconds': round(self.blocked, 3),
+            'lines_per_second': round(self.lines / elapsed, 1)
+            if elapsed else None,
+        }
+
+
+class IngestPipeline(object):
+    """
+    Runs the reader -> parse workers -> writer pipeline over local files.
+    """
+
+    def __init__(self, workers=None, batch_size=2000, max_pending=None,
+                 external_decompression=True):
+        if workers is None:
+            workers = max(multiprocessing.cpu_count() - 1, 1)
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_pending = max_pending or max(workers * 4, 2)
+        self.external_decompression = external_decompression
+
+        self.reader_stats = StageStats('reader')
+        self.parse_stats = StageStats('parse')
+        self.writer_stats = StageStats('writer')
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        # format name -> lines read in that format
+        self.formats = {}
+        self.elapsed = 0.0
+
+    def run(self, paths, output):
+        '''
+        Streams all events from paths (or the objects of a PrefetchReader)
+        into output as mapper output lines. Returns the mapper counters.
+        '''
+        started = time.time()
+        pool = multiprocessing.Pool(self.workers) if self.workers else None
+        # bounds the number of batches in flight (back-pressure)
+        slots = threading.BoundedSemaphore(self.max_pending)
+        pending = Queue()
+        errors = []
+
+        reader = threading.Thread(
+            target=self._read, args=(paths, pool, slots, pending, errors))
+        reader.daemon = True
+        reader.start()
+        try:
+            self._write(output, slots, pending)
+        except:
+            if pool:
+                pool.terminate()
+            raise
+        reader.join()
+        if pool:
+            pool.close()
+            pool.join()
+        if errors:
+            raise errors[0]
+        self.elapsed = time.time() - started
+        return self.counters
+
+    def _read(self, paths, pool, slots, pending, errors):
+        stats = self.reader_stats
+        try:
+            for path in paths:
+                if isinstance(path, tuple):
+                    # (name, lines) of an agora.objectstore.PrefetchReader
+                    stream = path[1]
+                else:
+                    stream = open_input(path, self.external_decompression)
+                lines = iter(stream)
+                # every file gets the format its first lines look like
+                format_name = None
+                while True:
+                    tick = time.time()
+                    batch = list(itertools.islice(lines, self.batch_size))
+                    stats.busy += time.time() - tick
+                    if not batch:
+                        break
+                    stats.lines += len(batch)
+                    stats.batches += 1
+                    stats.bytes += sum(len(line) for line in batch)
+                    if format_name is None:
+                        format_name = sniff_format(batch[:SNIFF_LINES]).name
+                    self.formats[format_name] = \
+                        self.formats.get(format_name, 0) + len(batch)
+
+                    tick = time.time()
+                    slots.acquire()
+                    stats.blocked += time.time() - tick
+                    if pool:
+                        pending.put(pool.apply_async(
+                            parse_batch, (batch, format_name)))
+                    else:
+                        pending.put(_Deferred(batch, format_name))
+                if stream is not sys.stdin:
+                    stream.close()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            pending.put(None)
+
+    def _write(self, output, slots, pending):
+        stats = self.writer_stats
+        while True:
+            tick = time.time()
+            result = pending.get()
+            if result is None:
+                break
+            lines, counts, parse_time = result.get()
+            stats.blocked += time.time() - tick
+
+            self.parse_stats.batches += 1
+            self.parse_stats.lines += counts['total-events']
+            self.parse_stats.busy += parse_time
+            for name, value in counts.iteritems():
+                self.counters[name] += value
+
+            tick = time.time()
+            for line in lines:
+                output.write(line)
+                output.write('\n')
+                stats.bytes += len(line) + 1
+            stats.busy += time.time() - tick
+            stats.lines += len(lines)
+            stats.batches += 1
+            slots.release()
+        output.flush()
+
+    def stats(self):
+        '''
+        Per-stage throughput stats of the last run
+        '''
+        return [s.as_dict(self.elapsed) for s in (
+            self.reader_stats, self.parse_stats, self.writer_stats)]
+
+    def report(self, stream=sys.stderr):
+        stream.write('%-8s %10s %8s %12s %10s %10s %12s\n' % (
+            'stage', 'lines', 'batches', 'bytes', 'busy(s)', 'blocked(s)',
+            'lines/s'))
+        for s in self.stats():
+            stream.write('%-8s %10d %8d %12d %10.3f %10.3f %12s\n' % (
+                s['stage'], s['lines'], s['batches'], s['bytes'],
+                s['busy_seconds'], s['blocked_seconds'],
+                s['lines_per_second']))
+        for name in COUNTERS:
+            stream.write('%s: %d\n' % (name, self.counters[name]))
+        for name, lines in sorted(self.formats.iteritems()):
+            stream.write('format %s: %d lines\n' % (name, lines))
+
+
+def main(args=None):
+    """
+    Run the ingest pipeline over local log files and write mapper output
+    to stdout
+    """
+    parser = OptionParser(usage='%prog [options] FILE...\n'
+                                '       %prog [options] s3://BUCKET/PREFIX...')
+    parser.add_option('-w', '--workers', type='int', default=None,
+                      help='number of parse worker processes '
+                           '(0 parses in the writer thread)')
+    parser.add_option('-b', '--batch-size', type='int', default=2000,
+                      help='lines per parse batch')
+    parser.add_option('--max-pending', type='int', default=None,
+                      help='max batches in flight before the reader blocks')
+    parser.add_option('--no-external-decompression', action='store_false',
+                      dest='external', default=True,
+                      help="don't use pigz/pzstd/lbzip2 even if installed")
+    parser.add_option('--stats', action='store_true', default=False,
+                      help='print per-stage throughput stats to stderr')
+    parser.add_option('--fetch-workers', type='int', default=WORKERS,
+                      help='concurrent object store downloads')
+    parser.add_option('--read-ahead', type='int', default=MAX_BUFFER,
+                      help='bytes of objects downloaded ahead of parsing')
+    parser.add_option('--s3-endpoint',
+                      help='host:port of an S3 compatible store')
+    options, paths = parser.parse_args(args)
+    if not paths:
+        parser.error('no input files')
+    uris = [p for p in paths if is_uri(p)]
+    if uris and len(uris) != len(paths):
+        parser.error("local files and object store URIs can't be mixed")
+
+    inputs = paths
+    if uris:
+        try:
+            inputs = PrefetchReader(S3Store(options.s3_endpoint), uris,
+                                    options.fetch_workers, options.read_ahead)
+        except ValueError, e:
+            parser.error(str(e))
+
+    pipeline = IngestPipeline(workers=options.workers,
+                              batch_size=options.batch_size,
+                              max_pending=options.max_pending,
+                              external_decompression=options.external)
+    pipeline.run(inputs, sys.stdout)
+    if options.stats:
+        pipeline.report()
+        if uris:
+            stats = inputs.stats.as_dict()
+            sys.stderr.write(
+                'fetched %(objects)d objects, %(bytes)d bytes, '
+                '%(bytes_per_second)s bytes/s, stalled %(stall_seconds).3fs, '
+                'peak read-ahead %(peak_buffered_bytes)d bytes\n' % stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,45 @@
+import atexit
+import itertools
 import logging
+import os
+import shutil
+import tempfile
+import time
 
-import pygeoip
-from agora.logs import GoonHillyLog
+from agora.defaults import HLL_ERROR, K, SNAPSHOT_INTERVAL, TOP_K
+from agora.logs import SNIFF_LINES, GoonHillyLog, LineParser, \
+    sniff_format
+from agora.quarantine import MAX_BYTES, Quarantine, side_file_path
 from agora.stats import PBSVideoStats
 from mrjob.job import MRJob
+from mrjob.step import MRStep
+
+# numbers the memory reports of a process, the inline runner runs every
+# task in one process
+_memory_reports = itertools.count(1)
+
+# numbers the coverage side files of a process, like the memory reports
+_coverage_files = itertools.count(1)
+
+# job instances made by this process, only the first one pays for starting
+# the interpreter and importing the job
+_jobs_created = itertools.count()
+
+# runners that run tasks on this machine
+LOCAL_RUNNERS = ('inline', 'local')
+
+
+def stream_stats(events, isp_lookup=None, geo_lookup=None, quarantine=None):
+    '''
+    PBSVideoStats of the events of one stream and the number of events,
+    aggregated like the session reducer does. agora-backfill uses it too
+    '''
+    stats = PBSVideoStats(isp_lookup, geo_lookup, quarantine)
+    count = 0
+    for event in events:
+        stats.add_event(event)
+        count += 1
+    return stats, count
 
 
 class VideoStreamCondense(MRJob):
@@ -11,6 +47,15 @@ class VideoStreamCondense(MRJob):
     def __init__(self, args=None):
         self.isp_lookup = None
         self.geo_lookup = None
+        self.quarantine = None
+        self.memory = None
+        self._created = time.time()
+        self._first_in_process = next(_jobs_created) == 0
+        self._geoip_seconds = 0.0
+        self._runner = None
+        self._metrics = None
+        # progress of this task for interim metrics, see agora.metrics
+        self.progress = None
         super(VideoStreamCondense, self).__init__(args=args)
         self.logger = logging.getLogger('mrjob')
 
@@ -23,6 +68,68 @@ class VideoStreamCondense(MRJob):
             '--isp_db', help='Optional: path to ISP-lookup database')
         self.add_file_option(
             '--geo_db', help='Optional: path to City-lookup database')
+        self.add_passthrough_option(
+            '--rollup', action='store_true', default=False,
+            help='Also output per day/source/component/title, day/source '
+                 'and day/source/component aggregates of the session '
+                 'summaries')
+        self.add_passthrough_option(
+            '--hll-error', type='float', default=HLL_ERROR,
+            help='Standard error of the distinct viewer/session counts '
+                 'in rollups (default: %default)')
+        self.add_passthrough_option(
+            '--quantile-k', type='int', default=K,
+            help='Accuracy parameter of the buffering/playing duration '
+                 'quantile sketches in rollups (default: %default)')
+        self.add_passthrough_option(
+            '--top-k', type='int', default=TOP_K,
+            help='Number of worst-buffering ISPs, metro codes and titles '
+                 'reported with rollups (default: %default)')
+        self.add_passthrough_option(
+            '--concurrency', action='store_true', default=False,
+            help='Output concurrent playing streams per minute, per source '
+                 'and in total, instead of session summaries')
+        self.add_passthrough_option(
+            '--quarantine-dir', default=None,
+            help='Local directory for side files of sampled unparsable '
+                 'lines and bad events, one per task')
+        self.add_passthrough_option(
+            '--quarantine-sample', type='float', default=1.0,
+            help='Fraction of quarantined lines written to the side file '
+                 '(default: %default)')
+        self.add_passthrough_option(
+            '--quarantine-max-bytes', type='int', default=MAX_BYTES,
+            help='Size cap of each quarantine side file (default: %default)')
+        self.add_passthrough_option(
+            '--coverage', default=None,
+            help='Local directory for per task JSON support matrices of '
+                 'event types and custom fields per source_tag')
+        self.add_passthrough_option(
+            '--memory-report', default=None,
+            help='Local directory for per task JSON memory reports of the '
+                 'parse and session step')
+        self.add_passthrough_option(
+            '--memory-top-n', type='int', default=20,
+            help='Sessions and allocation sites listed in memory reports '
+                 '(default: %default)')
+        self.add_passthrough_option(
+            '--memory-snapshot-interval', type='int',
+            default=SNAPSHOT_INTERVAL,
+            help='Events between tracemalloc snapshots (default: %default)')
+        self.add_passthrough_option(
+            '--combine-split-size', type='int', default=0,
+            help='Combine small input files into splits of about this many '
+                 'bytes, with CombineTextInputFormat on Hadoop and by '
+                 'concatenating them in local runs (default: off)')
+        self.add_passthrough_option(
+            '--metrics', default=None,
+            help='Write run metrics to METRICS.json and, in Prometheus '
+                 'text format, to METRICS.prom')
+        self.add_passthrough_option(
+            '--metrics-interval', type='int', default=0,
+            help='Also write the metrics every this many seconds while '
+                 'the job runs; local tasks report their progress, on '
+                 'Hadoop only finished steps are counted (default: off)')
 
     def load_options(self, args):
         """
@@ -30,53 +137,276 @@ class VideoStreamCondense(MRJob):
         https://pythonhosted.org/mrjob/job.html?highlight=configure_options#mrjob.job.MRJob.load_options
         """
         super(VideoStreamCondense, self).load_options(args)
+        if self.options.rollup and self.options.concurrency:
+            self.option_parser.error(
+                '--rollup and --concurrency can not be combined')
+        self.quarantine = Quarantine(
+            side_file_path(self.options.quarantine_dir)
+            if self.options.quarantine_dir else None,
+            sample_rate=self.options.quarantine_sample,
+            max_bytes=self.options.quarantine_max_bytes,
+            on_reject=self._count_rejection)
+        started = time.time()
+        if self.options.isp_db or self.options.geo_db:
+            # imported here so tasks without lookups don't load it
+            import pygeoip
         if self.options.isp_db:
             self.isp_lookup = pygeoip.GeoIP(
                 self.options.isp_db, pygeoip.MEMORY_CACHE)
         if self.options.geo_db:
             self.geo_lookup = pygeoip.GeoIP(
                 self.options.geo_db, pygeoip.MEMORY_CACHE)
+        self._geoip_seconds = time.time() - started
+
+    def _combining(self, local):
+        return self.options.combine_split_size > 0 and \
+            (self.options.runner in LOCAL_RUNNERS) == local
+
+    def hadoop_input_format(self):
+        if self._combining(local=False):
+            from agora.splits import COMBINE_INPUT_FORMAT
+            return COMBINE_INPUT_FORMAT
+        return super(VideoStreamCondense, self).hadoop_input_format()
+
+    def jobconf(self):
+        jobconf = super(VideoStreamCondense, self).jobconf()
+        if self._combining(local=False):
+            from agora.splits import SPLIT_MAX_SIZE
+            jobconf.setdefault(SPLIT_MAX_SIZE,
+                               str(self.options.combine_split_size))
+        return jobconf
+
+    def make_runner(self):
+        """
+        Local runners make a task per input file, so small inputs are
+        concatenated into combined files first
+        """
+        if self._combining(local=True) and '-' not in self.args:
+            from agora.splits import coalesce
+            output_dir = tempfile.mkdtemp(prefix='agora-splits-')
+            atexit.register(shutil.rmtree, output_dir, True)
+            inputs = len(self.args)
+            self.args = coalesce(
+                self.args, self.options.combine_split_size, output_dir)
+            self.logger.info('combined %d inputs into %d splits',
+                             inputs, len(self.args))
+        self._runner = super(VideoStreamCondense, self).make_runner()
+        return self._runner
+
+    def run_job(self):
+        """
+        Runs the job, writing metrics of the run when asked to
+        """
+        if not self.options.metrics:
+            return super(VideoStreamCondense, self).run_job()
+        from agora.metrics import CountingStream, RunMetrics, Snapshots, \
+            input_bytes, progress_dir, write_metrics
+        self._metrics = metrics = RunMetrics(input_bytes(self.args))
+        snapshots = None
+        progress = progress_dir(self.options.metrics)
+        if self._reports_progress():
+            shutil.rmtree(progress, True)
+            os.makedirs(progress)
+        if self.options.metrics_interval > 0:
+            snapshots = Snapshots(
+                self.options.metrics, self.options.metrics_interval,
+                self.interim_snapshot)
+            snapshots.start()
+        stdout, self.stdout = self.stdout, CountingStream(self.stdout,
+                                                          metrics)
+        status = 'failed'
+        try:
+            super(VideoStreamCondense, self).run_job()
+            status = 'succeeded'
+        finally:
+            self.stdout = stdout
+            if snapshots:
+                snapshots.stop()
+            write_metrics(self.options.metrics,
+                          metrics.snapshot(self._counters(), status))
+            shutil.rmtree(progress, True)
+
+    def interim_snapshot(self):
+        '''
+        Metrics of the running job, with the progress of its local tasks
+        '''
+        from agora.metrics import progress_dir, read_progress
+        return self._metrics.snapshot(
+            self._counters(), 'running',
+            read_progress(progress_dir(self.options.metrics)))
+
+    def _reports_progress(self):
+        return bool(self.options.metrics) and \
+            self.options.metrics_interval > 0 and \
+            self.options.runner in LOCAL_RUNNERS
+
+    def job_runner_kwargs(self):
+        """
+        Tells local tasks where to report their progress
+        """
+        kwargs = super(VideoStreamCondense, self).job_runner_kwargs()
+        if self._reports_progress():
+            from agora.metrics import PROGRESS_ENV, progress_dir
+            kwargs['cmdenv'] = dict(kwargs.get('cmdenv') or {})
+            kwargs['cmdenv'][PROGRESS_ENV] = progress_dir(
+                self.options.metrics)
+        return kwargs
+
+    def increment_counter(self, group, counter, amount=1):
+        super(VideoStreamCondense, self).increment_counter(
+            group, counter, amount)
+        if self.progress is not None:
+            self.progress.add(group, counter, amount)
+
+    def _counters(self):
+        # counters the runner has so far, of finished tasks or steps
+        return self._runner.counters() if self._runner else []
+
+    def _step(self, phase, **kwargs):
+        '''
+        MRStep whose tasks count their time per phase when metrics are
+        written
+        '''
+        if self.options.metrics:
+            from agora.metrics import timed_task
+            for task in ('mapper', 'combiner', 'reducer'):
+                if task in kwargs:
+                    kwargs[task + '_init'], kwargs[task + '_final'] = \
+                        timed_task(self, '%s-%s' % (phase, task),
+                                   kwargs.get(task + '_init'),
+                                   kwargs.get(task + '_final'),
+                                   self.options.metrics_interval)
+        return MRStep(**kwargs)
+
+    def steps(self):
+        # the parse step sniffs the input format of each split, and
+        # optionally runs memory diagnostics
+        diagnostics = dict(mapper_init=self.mapper_init,
+                           mapper_final=self.mapper_final)
+        if self.options.memory_report:
+            diagnostics.update(reducer_init=self.memory_init,
+                               reducer_final=self.reducer_memory_final)
+        if self.options.concurrency:
+            return [self._step('boundaries', mapper=self.mapper,
+                               reducer=self.reducer_boundaries,
+                               **diagnostics),
+                    self._step('concurrency',
+                               combiner=self.combiner_concurrency,
+                               reducer=self.reducer_concurrency)]
+        steps = [self._step('sessions', mapper=self.mapper,
+                            reducer=self.reducer, **diagnostics)]
+        if self.options.rollup:
+            steps.append(self._step('rollup',
+                                    mapper_init=self.mapper_rollup_init,
+                                    mapper=self.mapper_rollup,
+                                    mapper_final=self.mapper_rollup_final,
+                                    combiner=self.combiner_rollup,
+                                    reducer=self.reducer_rollup))
+        return steps
+
+    def mapper_init(self):
+        self._count_task_overhead()
+        # parser of this split, bound to a format once its first lines are
+        # buffered, see agora.logs.LineParser
+        self.parser = None
+        self._sniff_buffer = []
+        # format name -> lines
+        self._format_lines = {}
+        # support matrix of this task, written once from mapper_final
+        self.coverage = None
+        if self.options.coverage:
+            from agora.coverage import SupportMatrix
+            self.coverage = SupportMatrix()
+        if self.options.memory_report:
+            self.memory_init()
+
+    def _count_task_overhead(self):
+        '''
+        Counts the map task and the time it took to get to its first line:
+        interpreter startup and imports (when the task has a process of its
+        own), option parsing and GeoIP loading
+        '''
+        from agora.splits import process_started
+        started = process_started() if self._first_in_process else None
+        if started is None:
+            started = self._created
+        self.increment_counter('task-overhead', 'map-tasks', 1)
+        self.increment_counter('task-overhead', 'startup-ms',
+                               int((time.time() - started) * 1000))
+        self.increment_counter('task-overhead', 'geoip-load-ms',
+                               int(self._geoip_seconds * 1000))
 
     def mapper(self, _, line):
         '''
         Takes a goonhilly line and parses all the fields to a dictionary
         '''
+        if self.parser is None:
+            self._sniff_buffer.append(line)
+            if len(self._sniff_buffer) < SNIFF_LINES:
+                return
+            lines = self._bind_format()
+        else:
+            lines = (line,)
+        for line in lines:
+            pair = self._map_line(line)
+            if pair:
+                yield pair
+
+    def mapper_final(self):
+        '''
+        Maps a split shorter than the sniffed lines, and reports the lines
+        per input format
+        '''
+        if self.parser is None and self._sniff_buffer:
+            for line in self._bind_format():
+                pair = self._map_line(line)
+                if pair:
+                    yield pair
+        for name, lines in self._format_lines.iteritems():
+            self.increment_counter('input-formats', name, lines)
+        if self.coverage is not None:
+            self._write_coverage()
+        if self.options.memory_report:
+            self._write_memory_report('mapper')
+
+    def _bind_format(self):
+        '''
+        Picks the parser of this split from the buffered lines, returns
+        the buffered lines
+        '''
+        lines, self._sniff_buffer = self._sniff_buffer, []
+        self.parser = LineParser(sniff_format(lines), self.quarantine)
+        return lines
+
+    def _map_line(self, line):
         self.increment_counter('job-metrics', 'total-events', 1)
-        parsed_line = GoonHillyLog.parse_log_line_json(line)
+        if self.memory is not None:
+            self.memory.add_events()
+        parsed_line = self.parser.parse(line)
+        name = self.parser.log_format.name
+        self._format_lines[name] = self._format_lines.get(name, 0) + 1
+        key = parsed_line and GoonHillyLog.tracking_key(parsed_line)
+        if parsed_line and self.coverage is not None:
+            self.coverage.add_event(parsed_line)
         if not parsed_line:
-            self.logger.debug(
-                'agora.logs.GoonHillyLog: Unable to parse line: ' + line)
+            # logged and counted per reason by the quarantine
             self.increment_counter('job-metrics', 'unparsable-events', 1)
 
-        elif parsed_line.get('x_tracking_id') and parsed_line.get('x_tpmid'):
-            # if this line has a tracking id that uses guid, then
-            # use key, else concatenate with x_tpmid to generate
-            # more unique key
-            key = parsed_line['x_tracking_id']
-            if len(key) < 30:
-                key += '-' + parsed_line['x_tpmid']
-
+        elif key:
             self.increment_counter('job-metrics', 'valid-events', 1)
-            yield key, parsed_line
+            return key, parsed_line
 
         else:
             # No tracking id, no value to the statistics so skip it
             self.logger.debug(
-                'Event: Unable to generate tracking key: ' + line)
+                'Event: Unable to generate tracking key: %s', line)
             self.increment_counter('job-metrics', 'keyless-events', 1)
 
     def reducer(self, key, events):
         '''
         Aggregates all the play events
         '''
-        # increment total number of streams
-        self.increment_counter('event-metrics', 'total-streams', 1)
-
-        # aggregate all events in a stream
-        stats = PBSVideoStats(self.isp_lookup, self.geo_lookup)
-        for event in events:
-            stats.add_event(event)
-
+        stats = self._stream_stats(key, events)
         summary = stats.summary()
         if summary.get('playing_duration'):
             # increment total number of playing_durations > 0
@@ -92,6 +422,141 @@ class VideoStreamCondense(MRJob):
 
         yield key, summary
 
+    def _stream_stats(self, key, events):
+        # increment total number of streams
+        self.increment_counter('event-metrics', 'total-streams', 1)
+
+        # aggregate all events in a stream
+        stats, count = stream_stats(events, self.isp_lookup,
+                                    self.geo_lookup, self.quarantine)
+        if self.memory is not None:
+            self.memory.add_session(key, stats, count)
+        return stats
+
+    def memory_init(self):
+        from agora.memory import MemoryDiagnostics
+        self.memory = MemoryDiagnostics(self.options.memory_top_n,
+                                        self.options.memory_snapshot_interval)
+
+    def reducer_memory_final(self):
+        self._write_memory_report('reducer')
+
+    def _write_memory_report(self, phase):
+        '''
+        Writes the memory report of this task, with counters and the peak
+        RSS in the task status
+        '''
+        if not os.path.isdir(self.options.memory_report):
+            os.makedirs(self.options.memory_report)
+        report = self.memory.close(side_file_path(
+            self.options.memory_report,
+            'memory-%s-%d' % (phase, next(_memory_reports)), 'json'))
+        self.memory = None
+        for name in ('sessions', 'large_sessions', 'snapshots'):
+            self.increment_counter('memory-diagnostics',
+                                   name.replace('_', '-'), report[name])
+        self.set_status('peak rss %s KB' % report['peak_rss_kb'])
+
+    def _write_coverage(self):
+        from agora.coverage import write_coverage
+        if not os.path.isdir(self.options.coverage):
+            os.makedirs(self.options.coverage)
+        write_coverage(self.coverage, side_file_path(
+            self.options.coverage, 'coverage-%d' % next(_coverage_files),
+            'json'))
+
+    def _count_rejection(self, reason):
+        self.increment_counter('quarantine', reason, 1)
+
+    def reducer_boundaries(self, key, events):
+        '''
+        Aggregates a stream and emits the +1/-1 minute boundaries of its
+        play intervals, per source and for the total
+        '''
+        from agora.concurrency import session_boundaries
+        stats = self._stream_stats(key, events)
+        for boundary in session_boundaries(stats.playing_intervals()):
+            yield ['source', stats.source], boundary
+            yield ['total'], boundary
+
+    def combiner_concurrency(self, key, boundaries):
+        from agora.concurrency import sum_deltas
+        for minute, delta in sorted(sum_deltas(boundaries).iteritems()):
+            if delta:
+                yield key, [minute, delta]
+
+    def reducer_concurrency(self, key, boundaries):
+        '''
+        Sweeps the summed boundaries into per minute concurrency
+        '''
+        from agora.concurrency import format_minute, sum_deltas, sweep
+        for minute, concurrency in sweep(sum_deltas(boundaries)):
+            yield key + [format_minute(minute)], concurrency
+
+    def mapper_rollup_init(self):
+        from agora.topk import HeavyHitters
+        self.heavy_hitters = HeavyHitters(self.options.top_k)
+
+    def mapper_rollup(self, key, summary):
+        '''
+        Passes a session summary through and turns it into partial
+        rollups, one per grouping
+        '''
+        # the session summary itself passes through to the output unchanged.
+        # Only the last step writes the job output, so this shuffles every
+        # summary a second time
+        yield key, summary
+        from agora.rollup import session_partials
+        self.heavy_hitters.add_summary(summary)
+        for rollup_key, partial in session_partials(
+                summary, self.options.hll_error, self.options.quantile_k):
+            yield rollup_key, partial
+
+    def mapper_rollup_final(self):
+        '''
+        Emits the heavy hitter summaries of this task
+        '''
+        for key, partial in self.heavy_hitters.partials():
+            yield key, partial
+
+    def combiner_rollup(self, key, partials):
+        if not isinstance(key, list):
+            for summary in partials:
+                yield key, summary
+            return
+        from agora.rollup import RollupStats
+        from agora.topk import is_heavy_hitter_key, merge_heavy_hitters
+        if is_heavy_hitter_key(key):
+            yield key, merge_heavy_hitters(partials).to_dict()
+            return
+        stats = RollupStats(self.options.hll_error)
+        for partial in partials:
+            stats.merge(partial)
+        yield key, stats.to_dict()
+
+    def reducer_rollup(self, key, partials):
+        '''
+        Merges all partial rollups of a rollup key
+        '''
+        if not isinstance(key, list):
+            # a session summary, keyed by its tracking key
+            for summary in partials:
+                yield key, summary
+            return
+        from agora.rollup import RollupStats
+        from agora.topk import heavy_hitters_report, is_heavy_hitter_key, \
+            merge_heavy_hitters
+        if is_heavy_hitter_key(key):
+            self.increment_counter('rollup-metrics', 'heavy-hitters', 1)
+            yield key, heavy_hitters_report(
+                merge_heavy_hitters(partials), self.options.top_k)
+            return
+        self.increment_counter('rollup-metrics', 'total-rollups', 1)
+        stats = RollupStats(self.options.hll_error)
+        for partial in partials:
+            stats.merge(partial)
+        yield key, stats.summary()
+
 
 def main():
     """
@@ -0,0 +1,316 @@
+"""
+Bulk loading of session summaries into a SQL store.
+
+Job output is streamed, deduplicated per batch and written in large batches,
+upserted on (tracking_id, media_id) so loading the same output twice is
+harmless. The pair identifies a stream as the job's tracking key does,
+which joins short tracking ids with the media id:
+
+    agora-load --db sqlite:///reports.db output/part-*
+    agora -r emr <logs> | agora-load --db postgresql://host/reports
+
+PostgreSQL (psycopg2) batches are COPYed into a temporary staging table and
+merged with one INSERT ... ON CONFLICT. SQLite batches use executemany with
+an upsert. A transaction spans several batches (``transaction_size`` rows),
+and connections come from a pool, so repeated loads in one process don't
+reconnect.
+"""
+import sys
+import threading
+import time
+from optparse import OptionParser
+from StringIO import StringIO
+
+from agora.columnar import coerce, format_tsv_value, read_summaries
+from agora.stats import PBSVideoStats
+
+TABLE = 'sessions'
+BATCH_SIZE = 5000
+TRANSACTION_SIZE = 50000
+# primary key of a stream
+KEY = ('tracking_id', 'media_id')
+
+SQL_TYPES = {
+    'sqlite': {'string': 'TEXT', 'int': 'INTEGER', 'float': 'REAL',
+               'bool': 'INTEGER', 'timestamp': 'TEXT', 'ints': 'TEXT'},
+    'postgresql': {'string': 'TEXT', 'int': 'BIGINT',
+                   'float': 'DOUBLE PRECISION', 'bool': 'BOOLEAN',
+                   'timestamp': 'TIMESTAMP', 'ints': 'BIGINT[]'},
+}
+
+
+class ConnectionPool(object):
+    """
+    Keeps up to ``size`` idle connections made by ``connect``.
+    """
+
+    def __init__(self, connect, size=1):
+        self.connect = connect
+        self.size = size
+        self.idle = []
+        self.created = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self.idle:
+                return self.idle.pop()
+        self.created += 1
+        return self.connect()
+
+    def put(self, connection):
+        with self._lock:
+            if len(self.idle) < self.size:
+                self.idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self._lock:
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            connection.close()
+
+
+class SQLiteBackend(object):
+
+    dialect = 'sqlite'
+
+    def __init__(self, path):
+        self.path = path
+
+    def connect(self):
+        import sqlite3
+        # the pool may hand the connection to another thread
+        return sqlite3.connect(self.path, check_same_thread=False)
+
+    def write_batch(self, cursor, table, fields, rows):
+        import sqlite3
+        names = [name for name, _ in fields]
+        if sqlite3.sqlite_version_info < (3, 24, 0):
+            # no upsert before 3.24, replacing the row is the same here
+            # since every column is written
+            sql = 'INSERT OR REPLACE INTO %s (%s) VALUES (%s)' % (
+                table, ', '.join(names), ', '.join('?' * len(names)))
+        else:
+            sql = 'INSERT INTO %s (%s) VALUES (%s) ' \
+                'ON CONFLICT (%s) DO UPDATE SET %s' % (
+                    table, ', '.join(names), ', '.join('?' * len(names)),
+                    ', '.join(KEY),
+                    ', '.join('%s = excluded.%s' % (name, name)
+                              for name in names if name not in KEY))
+        # no array type, lists are stored as their {1,2,3} text
+        lists = [index for index, (_, kind) in enumerate(fields)
+                 if kind == 'ints']
+        if lists:
+            for row in rows:
+                for index in lists:
+                    if row[index] is not None:
+                        row[index] = format_tsv_value(row[index], 'ints')
+        cursor.executemany(sql, rows)
+
+
+class PostgresBackend(object):
+
+    dialect = 'postgresql'
+
+    def __init__(self, dsn):
+        try:
+            import psycopg2
+        except ImportError:
+            raise ValueError('postgresql loading needs psycopg2')
+        self.psycopg2 = psycopg2
+        self.dsn = dsn
+
+    def connect(self):
+        return self.psycopg2.connect(self.dsn)
+
+    def write_batch(self, cursor, table, fields, rows):
+        names = [name for name, _ in fields]
+        kinds = [kind for _, kind in fields]
+        staging = '%s_staging' % table
+        # text format COPY uses the same escaping as typed TSV
+        data = StringIO()
+        data.writelines(
+            '\t'.join(format_tsv_value(value, kind)
+                      for value, kind in zip(row, kinds)) + '\n'
+            for row in rows)
+        data.seek(0)
+        cursor.execute('CREATE TEMPORARY TABLE IF NOT EXISTS %s '
+                       '(LIKE %s)' % (staging, table))
+        cursor.copy_expert('COPY %s (%s) FROM STDIN' % (
+            staging, ', '.join(names)), data)
+        cursor.execute(
+            'INSERT INTO %s (%s) SELECT %s FROM %s '
+            'ON CONFLICT (%s) DO UPDATE SET %s' % (
+                table, ', '.join(names), ', '.join(names), staging,
+                ', '.join(KEY),
+                ', '.join('%s = excluded.%s' % (name, name)
+                          for name in names if name not in KEY)))
+        cursor.execute('TRUNCATE %s' % staging)
+
+
+def backend_for(url):
+    '''
+    Backend of a sqlite:///path or postgresql://... database URL
+    '''
+    if url.startswith('sqlite:///'):
+        return SQLiteBackend(url[len('sqlite:///'):])
+    if url.startswith(('postgresql://', 'postgres://')):
+        return PostgresBackend(url)
+    raise ValueError('unsupported database %r' % url)
+
+
+class BulkLoader(object):
+    """
+    Upserts session summaries into a table in batches.
+    """
+
+    def __init__(self, backend, table=TABLE, batch_size=BATCH_SIZE,
+                 transaction_size=TRANSACTION_SIZE, pool_size=1,
+                 fields=PBSVideoStats.SUMMARY_FIELDS):
+        self.backend = backend
+        self.table = table
+        self.batch_size = batch_size
+        # whole batches per transaction
+        self.batches_per_transaction = max(
+            transaction_size // batch_size, 1)
+        self.fields = fields
+        self.pool = ConnectionPool(backend.connect, pool_size)
+        self.rows = 0
+        self.duplicates = 0
+        self.skipped = 0
+        self.batches = 0
+        self.transactions = 0
+        self.elapsed = 0.0
+
+    def create_table(self):
+        types = SQL_TYPES[self.backend.dialect]
+        columns = ', '.join(
+            '%s %s%s' % (name, types[kind],
+                         ' NOT NULL' if name in KEY else '')
+            for name, kind in self.fields)
+        columns += ', PRIMARY KEY (%s)' % ', '.join(KEY)
+        connection = self.pool.get()
+        try:
+            cursor = connection.cursor()
+            cursor.execute('CREATE TABLE IF NOT EXISTS %s (%s)' % (
+                self.table, columns))
+            connection.commit()
+        finally:
+            self.pool.put(connection)
+
+    def _batches(self, summaries):
+        '''
+        Rows in batches, keeping the last summary of a stream that repeats
+        within a batch (an upsert can't touch a row twice)
+        '''
+        batch = {}
+        for summary in summaries:
+            key = tuple(summary.get(name) for name in KEY)
+            if not all(key):
+                self.skipped += 1
+                continue
+            if key in batch:
+                self.duplicates += 1
+            batch[key] = [coerce(summary.get(name), kind)
+                          for name, kind in self.fields]
+            if len(batch) >= self.batch_size:
+                yield batch.values()
+                batch = {}
+        if batch:
+            yield batch.values()
+
+    def load(self, summaries):
+        '''
+        Upserts summaries, returns the number of rows written
+        '''
+        started = time.time()
+        rows = 0
+        connection = self.pool.get()
+        try:
+            cursor = connection.cursor()
+            pending = 0
+            for batch in self._batches(summaries):
+                self.backend.write_batch(cursor, self.table, self.fields,
+                                         batch)
+                rows += len(batch)
+                self.batches += 1
+                pending += 1
+                if pending >= self.batches_per_transaction:
+                    connection.commit()
+                    self.transactions += 1
+                    pending = 0
+            if pending:
+                connection.commit()
+                self.transactions += 1
+        except:
+            connection.rollback()
+            raise
+        finally:
+            self.pool.put(connection)
+        self.rows += rows
+        self.elapsed += time.time() - started
+        return rows
+
+    def stats(self):
+        return {
+            'rows': self.rows,
+            'batches': self.batches,
+            'transactions': self.transactions,
+            'duplicates': self.duplicates,
+            'skipped': self.skipped,
+            'connections': self.pool.created,
+            'seconds': round(self.elapsed, 3),
+            'rows_per_second': round(self.rows / self.elapsed, 1)
+            if self.elapsed else None,
+        }
+
+    def close(self):
+        self.pool.close()
+
+
+def main(args=None):
+    """
+    Upsert session summaries from job output into a SQL table
+    """
+    parser = OptionParser(usage='%prog --db URL [options] [FILE...]')
+    parser.add_option('--db', help='sqlite:///PATH or postgresql://...')
+    parser.add_option('-t', '--table', default=TABLE,
+                      help='table to load into, created if missing')
+    parser.add_option('-b', '--batch-size', type='int', default=BATCH_SIZE,
+                      help='rows per batch')
+    parser.add_option('--transaction-size', type='int',
+                      default=TRANSACTION_SIZE,
+                      help='rows per transaction, in whole batches')
+    options, paths = parser.parse_args(args)
+    if not options.db:
+        parser.error('no database given')
+    try:
+        backend = backend_for(options.db)
+    except ValueError, e:
+        parser.error(str(e))
+
+    loader = BulkLoader(backend, options.table, options.batch_size,
+                        options.transaction_size)
+    try:
+        loader.create_table()
+        for path in paths or ['-']:
+            f = sys.stdin if path == '-' else open(path)
+            try:
+                loader.load(read_summaries(f))
+            finally:
+                if f is not sys.stdin:
+                    f.close()
+    finally:
+        loader.close()
+    print >> sys.stderr, (
+        '%(rows)d rows in %(batches)d batches and %(transactions)d '
+        'transactions, %(seconds).3fs, %(rows_per_second)s rows/s '
+        '(%(duplicates)d duplicates, %(skipped)d without tracking or media '
+        'id)'
+        % loader.stats())
+
+
+if __name__ == '__main__':
+    main()
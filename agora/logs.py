@@ -1,15 +1,272 @@
 # -*- coding: utf-8 -*-
-import re, json
-from dateutil.parser import parse
+import os
+import re
+from datetime import datetime
+
+from agora.quarantine import BAD_DATE, UNPARSABLE
+
+# Values of these fields repeat across millions of events. Parsed events
+# share one string per distinct value instead of allocating a fresh copy
+# for every event (field names are always shared).
+INTERNED_FIELDS = frozenset([
+    'event_type', 'component', 'source_tag', 'severity', 'message', 'path',
+    'agent', 'x_useragent', 'x_episode_title', 'x_program_title',
+    'x_producer', 'x_encoding_name', 'x_auto', 'x_after_seek',
+    'x_flash_player', 'ua_os_family', 'ua_os_major', 'ua_os_minor',
+    'ua_user_agent_family', 'ua_user_agent_major', 'ua_user_agent_minor',
+    'ua_device_family', 'ua_device_is_mobile', 'ua_device_is_spider',
+])
+
+# upper bound on distinct interned strings, past it new values are left
+# alone so a field with unexpected cardinality can't grow the table forever
+MAX_INTERNED = 100000
+
+INTERNING = True
+
+_interned = {}
+
+
+def intern_value(value):
+    '''
+    Returns the shared copy of a string
+    '''
+    if not INTERNING:
+        return value
+    try:
+        return _interned[value]
+    except KeyError:
+        if len(_interned) < MAX_INTERNED:
+            _interned[value] = value
+        return value
+
+
+def clear_interned():
+    _interned.clear()
+
+
+_dateutil_parse = None
+
+
+def parse(value):
+    '''
+    dateutil's parser, imported on first use so that tasks that never
+    parse log lines (reducers) don't pay for importing it
+    '''
+    global _dateutil_parse
+    if _dateutil_parse is None:
+        from dateutil import parser
+        _dateutil_parse = parser.parse
+    return _dateutil_parse(value)
+
+
+# JSON backends in order of preference, AGORA_JSON_BACKEND picks one
+JSON_BACKENDS = ('orjson', 'ujson', 'simplejson', 'json')
+
+
+def json_backend(name=None):
+    '''
+    (name, loads) of the named JSON backend, or of the first one that is
+    installed
+    '''
+    names = [name] if name else JSON_BACKENDS
+    for candidate in names:
+        try:
+            module = __import__(candidate)
+        except ImportError:
+            if name:
+                raise
+            continue
+        return candidate, module.loads
+
+
+def strip_quotes(value):
+    '''
+    Removes double quotes from around a string value
+    '''
+    if isinstance(value, basestring) and value.startswith('"') \
+            and value.endswith('"'):
+        return value[1:-1]
+    return value
+
+
+def _intern_converter(value):
+    value = strip_quotes(value)
+    if isinstance(value, basestring):
+        return intern_value(value)
+    return value
+
+
+def _lower(value):
+    value = strip_quotes(value)
+    if value and isinstance(value, basestring):
+        return value.lower()
+    return value
+
+
+# ISO 8601 times as fluentd writes them, optionally with fractions and
+# a zone
+_ISO_TIME = re.compile(
+    r'(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)'
+    r'(?:\.\d+)?(?:Z|[+-]\d\d:?\d\d)?$')
+
+
+def event_date(value):
+    '''
+    "%Y-%m-%d %H:%M:%S" of a fluentd time, in the time's own zone, or
+    None if it isn't a time. ISO times are sliced, anything else goes
+    through dateutil
+    '''
+    value = strip_quotes(value)
+    if not isinstance(value, basestring):
+        return None
+    match = _ISO_TIME.match(value)
+    if match:
+        try:
+            # checks the ranges, e.g. no february 30th
+            datetime(*[int(part) for part in match.groups()])
+        except ValueError:
+            return None
+        return str(value[:10] + ' ' + value[11:19])
+    try:
+        return parse(value).strftime('%Y-%m-%d %H:%M:%S')
+    except Exception:
+        return None
+
+
+# converter name -> function applied to the raw value of a field
+CONVERTERS = {
+    'string': strip_quotes,
+    'interned': _intern_converter,
+    'lower': _lower,
+}
+
+# Declared fluentd fields and their converters. Undeclared fields (custom
+# fields added by players) are passed through with their quotes stripped.
+JSON_FIELDS = tuple(
+    [(field, 'interned') for field in sorted(INTERNED_FIELDS)] + [
+        ('x_session_id', 'lower'),
+        ('time', 'string'),
+        ('remote', 'string'),
+        ('client_id', 'string'),
+        ('x_client_id', 'string'),
+        ('x_tracking_id', 'string'),
+        ('x_tpmid', 'string'),
+        ('x_video_length', 'string'),
+        ('x_video_location', 'string'),
+        ('x_buffering_length', 'string'),
+        ('x_stream_size', 'string'),
+        ('x_bandwidth', 'string'),
+        ('x_start_time', 'string'),
+        ('x_previous_quality', 'string'),
+        ('x_new_quality', 'string'),
+    ])
+
+
+class JSONNormalizer(object):
+    """
+    Parser of fluentd JSON lines compiled from a field schema.
+
+    The schema is turned into one lookup of (output key, converter) per
+    field up front, so normalizing an event is a single pass over its
+    items. Batches of lines are decoded with one call to the JSON backend.
+    """
+
+    def __init__(self, fields=JSON_FIELDS, backend=None, passthrough=True):
+        self.backend, self.loads = json_backend(
+            backend or os.environ.get('AGORA_JSON_BACKEND'))
+        self.passthrough = passthrough
+        self.converters = dict(
+            (field, (intern_value(field), CONVERTERS[kind]))
+            for field, kind in fields)
+
+    def normalize(self, raw, line=None, quarantine=None):
+        '''
+        Event dict of a decoded line, None if it can't be used
+        '''
+        if not isinstance(raw, dict):
+            if quarantine is not None:
+                quarantine.reject(UNPARSABLE, line)
+            return None
+        date = event_date(raw.get('time'))
+        if date is None:
+            # invalid date, skip the line
+            if quarantine is not None:
+                quarantine.reject(BAD_DATE, line)
+            return None
+
+        converters = self.converters
+        event = {'event_date': date}
+        for key, value in raw.iteritems():
+            converter = converters.get(key)
+            if converter is not None:
+                key, convert = converter
+                event[key] = convert(value)
+            elif self.passthrough:
+                event[intern_value(key)] = strip_quotes(value)
+        return event
+
+    def parse(self, line, quarantine=None):
+        try:
+            raw = self.loads(line)
+        except ValueError:
+            if quarantine is not None:
+                quarantine.reject(UNPARSABLE, line)
+            return None
+        return self.normalize(raw, line, quarantine)
+
+    def parse_lines(self, lines, quarantine=None):
+        '''
+        Events of a batch of lines (None for lines that can't be used),
+        decoded as one JSON array. A batch with a bad line is decoded line
+        by line instead
+        '''
+        lines = [line.strip() for line in lines]
+        try:
+            raws = self.loads('[' + ','.join(lines) + ']')
+        except ValueError:
+            raws = None
+        # one object per line, or lines were merged or split
+        if raws is None or len(raws) != len(lines) or \
+                not all(isinstance(raw, dict) for raw in raws):
+            return [self.parse(line, quarantine) for line in lines]
+        return [self.normalize(raw, line, quarantine)
+                for raw, line in zip(raws, lines)]
+
+
+_normalizer = None
+
+
+def default_normalizer():
+    global _normalizer
+    if _normalizer is None:
+        _normalizer = JSONNormalizer()
+    return _normalizer
 
 
 class GoonHillyLog(object):
 
     @staticmethod
-    def parse_log_line(line):
+    def tracking_key(event):
+        '''
+        Returns the key used to group the events of a single stream, or
+        None if the event can't be tied to a stream
+        '''
+        if not (event.get('x_tracking_id') and event.get('x_tpmid')):
+            return None
+        # if this line has a tracking id that uses guid, then
+        # use key, else concatenate with x_tpmid to generate
+        # more unique key
+        key = event['x_tracking_id']
+        if len(key) < 30:
+            key += '-' + event['x_tpmid']
+        return key
+
+    @staticmethod
+    def parse_log_line(line, quarantine=None):
         '''
         Parses a goonhilly log line and returns a dictionary of
-        key value objects
+        key value objects. Lines that can't be parsed are passed to the
+        optional agora.quarantine.Quarantine
         '''
         # attempt to get a valid date.  If no valid date, skip the line
         try:
@@ -20,17 +277,16 @@ class GoonHillyLog(object):
             event_date = dateutil_event_date.strftime("%Y-%m-%d %H:%M:%S")
         except:
             # invalid date, skip the line
-            # print 'skipping line'
+            if quarantine is not None:
+                quarantine.reject(BAD_DATE, line)
             return None
 
         # just get the k,v part of the input line
         try:
             discard, data = rline.split('] ', 1)
-        except:
-            # TODO: raise custom error?
-            print line
-            print '\n\n'
-            print rline
+        except ValueError:
+            if quarantine is not None:
+                quarantine.reject(UNPARSABLE, line)
             return None
 
         # get all the items
@@ -45,46 +301,148 @@ class GoonHillyLog(object):
         matches = [m.replace('|', '\|').split('=', 1) for m in matches]
 
         # use results to make a dict
-        d = dict(matches)
+        d = {}
+        for k, v in matches:
+            # remove double quotes or single quotes from around values
+            if v.startswith('"') and v.endswith('"'):
+                v = v[1:-1]
+            if k in INTERNED_FIELDS:
+                v = intern_value(v)
+            d[intern_value(k)] = v
         # add in the timestamp for consistency
         d['event_date'] = event_date
 
-        # remove double quotes or single quotes from around values
-        for k, v in d.iteritems():
-            if v.startswith('"') and v.endswith('"'):
-                d[k] = d[k][1:-1]
-
         # special transforms
         if d.get('x_session_id'):
             d['x_session_id'] = d['x_session_id'].lower()
         return d
 
     @staticmethod
-    def parse_log_line_json(line):
+    def parse_log_line_json(line, quarantine=None):
         '''
         Parses a goonhilly fluentd json formatted log line and returns a
-        dictionary of key value objects
+        dictionary of key value objects. Lines that can't be parsed are
+        passed to the optional agora.quarantine.Quarantine
         '''
-        # pull in a line of json to a dict or bail
-        try:
-            event = json.loads(line)
-        except:
-            return None
-        # attempt to get a valid date and format it properly. If no valid date, bail
-        try:
-            dateutil_event_date = parse(event["time"])
-            event["event_date"] = dateutil_event_date.strftime("%Y-%m-%d %H:%M:%S")
-        except:
-            # invalid date, skip the line
-            # print 'skipping line'
-            return None
+        return default_normalizer().parse(line, quarantine)
 
-        # remove double quotes or single quotes from around values
-        for k, v in event.iteritems():
-            if isinstance(v, str) and v.startswith('"') and v.endswith('"'):
-                event[k] = event[k][1:-1]
+    @staticmethod
+    def parse_log_lines_json(lines, quarantine=None):
+        '''
+        parse_log_line_json of a batch of lines, decoded in one call
+        '''
+        return default_normalizer().parse_lines(lines, quarantine)
 
-        # special transforms
-        if event.get('x_session_id'):
-            event['x_session_id'] = event['x_session_id'].lower()
+
+# lines of a file or split that are looked at to pick its format
+SNIFF_LINES = 20
+
+
+class LogFormat(object):
+    """
+    An input format: sniff(line) tells if a line looks like the format,
+    parse(line, quarantine) parses one line and parse_lines(lines,
+    quarantine) a batch of them.
+    """
+
+    def __init__(self, name, sniff, parse, parse_lines=None):
+        self.name = name
+        self.sniff = sniff
+        self.parse = parse
+        if parse_lines is not None:
+            self.parse_lines = parse_lines
+
+    def parse_lines(self, lines, quarantine=None):
+        return [self.parse(line, quarantine) for line in lines]
+
+
+# registered formats, in sniffing order. The first one is the default for
+# input that doesn't look like any of them
+FORMATS = []
+
+
+def register_format(log_format):
+    '''
+    Adds a LogFormat, replacing a registered format of the same name
+    '''
+    for i, registered in enumerate(FORMATS):
+        if registered.name == log_format.name:
+            FORMATS[i] = log_format
+            return
+    FORMATS.append(log_format)
+
+
+def get_format(name):
+    for log_format in FORMATS:
+        if log_format.name == name:
+            return log_format
+    raise KeyError('unknown log format %r' % name)
+
+
+def sniff_format(lines):
+    '''
+    The registered format most of the (non blank) lines look like, the
+    default format when none of them match
+    '''
+    lines = [line for line in lines if line.strip()]
+    best, best_matches = FORMATS[0], 0
+    for log_format in FORMATS:
+        matches = sum(1 for line in lines if log_format.sniff(line))
+        if matches > best_matches:
+            best, best_matches = log_format, matches
+    return best
+
+
+class LineParser(object):
+    """
+    Parses the lines of an input with the format sniffed from its first
+    lines.
+
+    Lines aren't sniffed again as long as the bound format parses them. A
+    line it can't parse but another registered format would take binds
+    that format from then on: a combined split on Hadoop can hold files of
+    several formats, and streaming tasks aren't told where one file ends.
+    Lines that can't be parsed either way go to the optional quarantine.
+    """
+
+    def __init__(self, log_format, quarantine=None):
+        self.log_format = log_format
+        self.quarantine = quarantine
+
+    def parse(self, line):
+        event = self.log_format.parse(line)
+        if event is None:
+            event = self._parse_failed(line)
         return event
+
+    def parse_lines(self, lines):
+        '''
+        Events of a batch of lines, parsed together in the bound format
+        '''
+        events = self.log_format.parse_lines(lines)
+        for i, event in enumerate(events):
+            if event is None:
+                events[i] = self._parse_failed(lines[i])
+        return events
+
+    def _parse_failed(self, line):
+        '''
+        Parses a line the bound format failed on again, in the format it
+        looks like, passing it to the quarantine if that fails too
+        '''
+        if line.strip() and not self.log_format.sniff(line):
+            for log_format in FORMATS:
+                if log_format.sniff(line):
+                    self.log_format = log_format
+                    break
+        return self.log_format.parse(line, self.quarantine)
+
+
+_GOONHILLY_LINE = re.compile(r'\d{4}-\d\d-\d\d \d\d:\d\d:\d\d[,.]\d+ ')
+
+register_format(LogFormat(
+    'json', lambda line: line.lstrip()[:1] == '{',
+    GoonHillyLog.parse_log_line_json, GoonHillyLog.parse_log_lines_json))
+register_format(LogFormat(
+    'goonhilly', lambda line: _GOONHILLY_LINE.match(line) is not None,
+    GoonHillyLog.parse_log_line))
@@ -0,0 +1,166 @@
+"""
+Memory measurements for comparing parsing and grouping strategies, and
+opt-in memory diagnostics of job tasks.
+"""
+import heapq
+import json
+import sys
+
+from agora.defaults import SNAPSHOT_INTERVAL
+
+try:
+    import resource
+except ImportError:
+    # not available on windows
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    # python 2 only has it with the pytracemalloc backport
+    tracemalloc = None
+
+# files whose allocation sites are reported
+TRACED_FILES = ('agora/logs.py', 'agora/stats.py')
+
+# sessions with more events than this are counted separately
+LARGE_SESSION_EVENTS = 10000
+
+
+def deep_sizeof(obj, exclude=()):
+    '''
+    Bytes used by obj and everything it references, counting shared
+    objects (interned strings) once. Objects in exclude, and everything
+    only reachable through them, aren't counted
+    '''
+    seen = set(id(o) for o in exclude)
+    total = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.iterkeys())
+            stack.extend(obj.itervalues())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif hasattr(obj, '__dict__'):
+            stack.append(obj.__dict__)
+    return total
+
+
+def peak_rss_kb():
+    '''
+    Peak resident set size of this process in KB, None where unknown
+    '''
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # bytes on OS X, KB everywhere else
+        rss //= 1024
+    return rss
+
+
+class MemoryDiagnostics(object):
+    """
+    Memory diagnostics of one task: the largest sessions it aggregated,
+    the top allocation sites in the parser and stats modules (when
+    tracemalloc is available) and its peak RSS.
+    """
+
+    def __init__(self, top_n=20, snapshot_interval=SNAPSHOT_INTERVAL):
+        self.top_n = top_n
+        self.snapshot_interval = snapshot_interval
+        self.events = 0
+        self.sessions = 0
+        self.large_sessions = 0
+        self.snapshots = 0
+        # min-heap of (bytes, sequence, session record)
+        self._largest = []
+        # "file:line" -> [peak bytes, blocks]
+        self.sites = {}
+        self._next_snapshot = snapshot_interval
+        self._tracing = False
+        if tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+
+    def add_events(self, count=1):
+        self.events += count
+        if self.events >= self._next_snapshot:
+            self._next_snapshot = self.events + self.snapshot_interval
+            self.snapshot()
+
+    def add_session(self, key, stats, events):
+        '''
+        Records the size of a PBSVideoStats after all of its events
+        were added, which is when it is largest
+        '''
+        self.sessions += 1
+        if events > LARGE_SESSION_EVENTS:
+            self.large_sessions += 1
+        size = deep_sizeof(stats, exclude=(
+            stats.isp_lookup, stats.geo_lookup, stats.quarantine))
+        record = {
+            'key': key,
+            'bytes': size,
+            'events': events,
+            'duration_events': len(stats.duration_events),
+            'buffering_positions': len(stats.buffering_positions or ()),
+        }
+        entry = (size, self.sessions, record)
+        if len(self._largest) < self.top_n:
+            heapq.heappush(self._largest, entry)
+        elif size > self._largest[0][0]:
+            heapq.heapreplace(self._largest, entry)
+        self.add_events(events)
+
+    def snapshot(self):
+        '''
+        Keeps the peak size of every allocation site in TRACED_FILES
+        '''
+        if tracemalloc is None:
+            return
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(True, '*' + name) for name in TRACED_FILES])
+        for stat in snapshot.statistics('lineno'):
+            frame = stat.traceback[0]
+            site = '%s:%d' % (frame.filename, frame.lineno)
+            if stat.size > self.sites.get(site, (0, 0))[0]:
+                self.sites[site] = [stat.size, stat.count]
+        self.snapshots += 1
+
+    def report(self):
+        sites = sorted(self.sites.iteritems(), key=lambda s: -s[1][0])
+        return {
+            'peak_rss_kb': peak_rss_kb(),
+            'events': self.events,
+            'sessions': self.sessions,
+            'large_sessions': self.large_sessions,
+            'largest_sessions': [record for _, _, record in
+                                 sorted(self._largest, reverse=True)],
+            'tracemalloc': tracemalloc is not None,
+            'snapshots': self.snapshots,
+            'allocation_sites': [
+                {'site': site, 'bytes': size, 'blocks': blocks}
+                for site, (size, blocks) in sites[:self.top_n]],
+        }
+
+    def close(self, path=None):
+        '''
+        Takes a last snapshot, returns the report and writes it as JSON
+        to path
+        '''
+        self.snapshot()
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+        report = self.report()
+        if path:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+        return report
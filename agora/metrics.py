@@ -0,0 +1,350 @@
+"""
+Machine-readable metrics of job runs.
+
+Throughput and error counts otherwise only show up in the mrjob log. With
+``--metrics PREFIX`` a run writes ``PREFIX.json`` and ``PREFIX.prom``
+(Prometheus text format) when it ends, and every ``--metrics-interval``
+seconds while it runs, so a scraper can follow long local runs.
+
+The launcher measures the run: wall and CPU time (its own and that of the
+local task processes it waited for), peak RSS, bytes in and out. Tasks
+measure their phase, the mapper, combiner or reducer of a step, and report
+wall and CPU milliseconds as counters that are summed over all tasks.
+Counters of finished steps are included as they come in.
+
+Runners only hand over the counters of a task once it is done (the inline
+runner) or of a step once it is done (Hadoop), so interim snapshots would
+show no lines until then. With ``--metrics-interval`` local tasks also
+write their lines and sessions so far to a file of their own in
+``PREFIX.progress/``, every interval seconds and when they end, and
+interim snapshots count the larger of those and the counters. On Hadoop,
+whose tasks can't write to the launcher's disk, interim snapshots only
+follow finished steps.
+"""
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+
+from agora.memory import resource
+from agora.quarantine import side_file_path
+from agora.splits import list_inputs
+
+# counter group of the task phase timings
+PHASE_GROUP = 'phase-metrics'
+
+# prefix of the prometheus metric names
+NAMESPACE = 'agora'
+
+# counters tasks report as progress, and the snapshot field they count
+PROGRESS_COUNTERS = {
+    ('job-metrics', 'total-events'): 'lines',
+    ('event-metrics', 'total-streams'): 'sessions',
+}
+
+# environment variable of the progress directory of local tasks
+PROGRESS_ENV = 'AGORA_METRICS_PROGRESS'
+
+# numbers the progress files of a process, the inline runner runs every
+# task in one process
+_progress_files = itertools.count(1)
+
+
+def cpu_seconds():
+    '''
+    User and system time of this process and its waited for children
+    '''
+    return sum(os.times()[:4])
+
+
+def peak_rss_bytes():
+    '''
+    Peak resident set size of this process or its largest child, None
+    where unknown
+    '''
+    if resource is None:
+        return None
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # KB everywhere but OS X
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def input_bytes(paths):
+    '''
+    Size of the local inputs, None when none of them is a local file
+    '''
+    files = [p for p in list_inputs(p for p in paths if p != '-')
+             if os.path.isfile(p)]
+    return sum(os.path.getsize(p) for p in files) if files else None
+
+
+def timed_task(job, phase, init=None, final=None, progress_interval=0):
+    '''
+    (init, final) task functions that count the wall and CPU time of a
+    task in phase, wrapping the step's own init and final functions. With
+    a progress interval, local tasks also set job.progress to a
+    TaskProgress, which the job feeds its counters
+    '''
+    started = []
+
+    def timed_init():
+        started[:] = [time.time(), sum(os.times()[:2])]
+        directory = os.environ.get(PROGRESS_ENV)
+        if progress_interval > 0 and directory:
+            job.progress = TaskProgress(directory, progress_interval)
+        for pair in (init and init()) or ():
+            yield pair
+
+    def timed_final():
+        for pair in (final and final()) or ():
+            yield pair
+        if job.progress is not None:
+            job.progress.write()
+            job.progress = None
+        wall, cpu = started or [time.time(), sum(os.times()[:2])]
+        job.increment_counter(PHASE_GROUP, phase + '-tasks', 1)
+        job.increment_counter(PHASE_GROUP, phase + '-wall-ms',
+                              int((time.time() - wall) * 1000))
+        job.increment_counter(PHASE_GROUP, phase + '-cpu-ms',
+                              int((sum(os.times()[:2]) - cpu) * 1000))
+
+    return timed_init, timed_final
+
+
+def total_counters(step_counters):
+    '''
+    Counters of all steps, {group: {name: total}}
+    '''
+    totals = {}
+    for counters in step_counters:
+        for group, names in counters.iteritems():
+            group_totals = totals.setdefault(group, {})
+            for name, value in names.iteritems():
+                group_totals[name] = group_totals.get(name, 0) + value
+    return totals
+
+
+def _phases(counters):
+    phases = {}
+    for name, value in counters.get(PHASE_GROUP, {}).iteritems():
+        phase, measure = name.rsplit('-', 1)
+        if measure == 'ms':
+            phase, measure = phase.rsplit('-', 1)
+            measure, value = measure + '_seconds', value / 1000.0
+        phases.setdefault(phase, {})[measure] = value
+    return phases
+
+
+def _rate(count, seconds):
+    return round(count / seconds, 1) if seconds else None
+
+
+def progress_dir(prefix):
+    return os.path.abspath(prefix) + '.progress'
+
+
+class TaskProgress(object):
+    """
+    Lines and sessions a running task has counted so far, written to its
+    own file in directory every interval seconds.
+    """
+
+    def __init__(self, directory, interval):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = side_file_path(
+            directory, 'task-%d' % next(_progress_files), 'json')
+        self.interval = interval
+        self.counts = dict.fromkeys(PROGRESS_COUNTERS.itervalues(), 0)
+        self.next_write = time.time() + interval
+
+    def add(self, group, name, amount):
+        field = PROGRESS_COUNTERS.get((group, name))
+        if field is None:
+            return
+        self.counts[field] += amount
+        if time.time() >= self.next_write:
+            self.write()
+
+    def write(self):
+        _replace(self.path, json.dumps(self.counts))
+        self.next_write = time.time() + self.interval
+
+
+def read_progress(directory):
+    '''
+    Lines and sessions of the progress files in directory, summed
+    '''
+    totals = dict.fromkeys(PROGRESS_COUNTERS.itervalues(), 0)
+    if not os.path.isdir(directory):
+        return totals
+    for name in os.listdir(directory):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                counts = json.load(f)
+        except (IOError, ValueError):
+            # removed or not renamed into place yet
+            continue
+        for field in totals:
+            totals[field] += counts.get(field, 0)
+    return totals
+
+
+class RunMetrics(object):
+    """
+    Measurements of one job run, from its start.
+    """
+
+    def __init__(self, bytes_in=None):
+        self.started = time.time()
+        self.cpu_started = cpu_seconds()
+        self.bytes_in = bytes_in
+        self.bytes_out = 0
+
+    def snapshot(self, step_counters=(), status='running', progress=None):
+        '''
+        Measurements so far, with the counters of step_counters and, when
+        given, the progress of running tasks
+        '''
+        wall = time.time() - self.started
+        counters = total_counters(step_counters)
+        lines = counters.get('job-metrics', {}).get('total-events', 0)
+        sessions = counters.get('event-metrics', {}).get('total-streams', 0)
+        if progress:
+            # both count from the start, the larger one is further along
+            lines = max(lines, progress['lines'])
+            sessions = max(sessions, progress['sessions'])
+        return {
+            'status': status,
+            'started': self.started,
+            'wall_seconds': round(wall, 3),
+            'cpu_seconds': round(cpu_seconds() - self.cpu_started, 3),
+            'peak_rss_bytes': peak_rss_bytes(),
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'lines': lines,
+            'sessions': sessions,
+            'lines_per_second': _rate(lines, wall),
+            'sessions_per_second': _rate(sessions, wall),
+            'phases': _phases(counters),
+            'counters': counters,
+        }
+
+
+def _number(value):
+    # longs without their L
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _label(value):
+    return '"%s"' % unicode(value).replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n')
+
+
+def to_prometheus(snapshot):
+    '''
+    A snapshot in the Prometheus text exposition format
+    '''
+    lines = []
+
+    def metric(name, kind, help, samples):
+        name = '%s_%s' % (NAMESPACE, name)
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for labels, value in samples:
+            if value is None:
+                continue
+            labels = ','.join('%s=%s' % (k, _label(v)) for k, v in labels)
+            lines.append('%s%s %s' % (
+                name, '{%s}' % labels if labels else '', _number(value)))
+
+    metric('run_info', 'gauge', 'Status of the run',
+           [([('status', snapshot['status'])], 1)])
+    metric('run_started_seconds', 'gauge', 'Start of the run',
+           [((), snapshot['started'])])
+    for name, help in (
+            ('wall_seconds', 'Wall time of the run'),
+            ('cpu_seconds', 'CPU time of the launcher and local tasks'),
+            ('peak_rss_bytes', 'Peak RSS of the launcher or a local task'),
+            ('bytes_in', 'Bytes of local input files'),
+            ('bytes_out', 'Bytes of output written'),
+            ('lines_per_second', 'Input lines per second of wall time'),
+            ('sessions_per_second', 'Sessions per second of wall time')):
+        metric('run_' + name, 'gauge', help, [((), snapshot[name])])
+    phases = sorted(snapshot['phases'].iteritems())
+    for measure, help in (
+            ('tasks', 'Tasks of a phase'),
+            ('wall_seconds', 'Wall time of the tasks of a phase'),
+            ('cpu_seconds', 'CPU time of the tasks of a phase')):
+        metric('phase_' + measure, 'gauge', help,
+               [([('phase', phase)], values.get(measure))
+                for phase, values in phases])
+    metric('counter_total', 'counter', 'Job counter totals',
+           [([('group', group), ('name', name)], value)
+            for group, names in sorted(snapshot['counters'].iteritems())
+            for name, value in sorted(names.iteritems())])
+    return '\n'.join(lines) + '\n'
+
+
+def _replace(path, data):
+    # a scraper never reads a half written file
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+
+
+def write_metrics(prefix, snapshot):
+    '''
+    Writes a snapshot to PREFIX.json and PREFIX.prom
+    '''
+    _replace(prefix + '.json',
+             json.dumps(snapshot, indent=2, sort_keys=True) + '\n')
+    _replace(prefix + '.prom', to_prometheus(snapshot).encode('utf-8'))
+
+
+class Snapshots(threading.Thread):
+    """
+    Writes interim snapshots every interval seconds until stopped.
+    """
+
+    def __init__(self, prefix, interval, snapshot):
+        super(Snapshots, self).__init__()
+        self.daemon = True
+        self.prefix = prefix
+        self.interval = interval
+        self.snapshot = snapshot
+        self.written = 0
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            write_metrics(self.prefix, self.snapshot())
+            self.written += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+class CountingStream(object):
+    """
+    Output stream that counts the bytes written to it as the bytes out of
+    a run.
+    """
+
+    def __init__(self, stream, metrics):
+        self.stream = stream
+        self.metrics = metrics
+
+    def write(self, data):
+        self.metrics.bytes_out += len(data)
+        self.stream.write(data)
+
+    def flush(self):
+        self.stream.flush()
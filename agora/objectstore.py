@@ -0,0 +1,352 @@
+"""
+Prefetching reader for logs in an object store.
+
+A day of logs under ``s3://bucket/path/2014-09-02/`` is many objects. Read
+one after the other, the CPU sits idle during every download. The
+PrefetchReader lists the prefix and downloads several objects at once on a
+pool of threads, while the caller reads them in listing order:
+
+* workers claim objects in listing order and download them in chunks
+* downloaded chunks wait in a read-ahead buffer of at most ``max_buffer``
+  bytes (plus one chunk); a worker blocks when the buffer is full, except
+  for the object the caller is reading, which always makes progress
+* the caller gets the objects in order as line iterators, decompressed
+  according to their extension
+
+Time the caller spends waiting for data that isn't downloaded yet is
+reported as stall time, next to the download throughput.
+
+Stores are small objects with ``list(bucket, prefix)`` and
+``open(bucket, key)``. S3Store uses boto (any S3 compatible endpoint can be
+given); LocalStore is backed by a directory per bucket, for tests and
+local mirrors.
+"""
+import bz2
+import os
+import threading
+import time
+import zlib
+
+# download granularity and default read-ahead budget
+CHUNK_SIZE = 1024 * 1024
+MAX_BUFFER = 64 * 1024 * 1024
+
+# default number of concurrent downloads
+WORKERS = 4
+
+
+def parse_uri(uri):
+    '''
+    (bucket, prefix) of an s3://bucket/prefix URI
+    '''
+    scheme, _, rest = uri.partition('://')
+    if scheme not in ('s3', 's3n', 's3a') or not rest:
+        raise ValueError('not an s3 URI: %r' % uri)
+    bucket, _, prefix = rest.partition('/')
+    return bucket, prefix
+
+
+def is_uri(path):
+    return '://' in path
+
+
+def _is_data_key(key):
+    '''
+    False for directory markers and hidden or bookkeeping objects
+    (_SUCCESS, .agidx sidecars)
+    '''
+    name = key.rsplit('/', 1)[-1]
+    return bool(name) and name[0] not in '._' and \
+        not name.endswith('.agidx')
+
+
+class LocalStore(object):
+    """
+    Object store backed by a directory per bucket under root.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def list(self, bucket, prefix=''):
+        '''
+        Sorted (key, size) of the objects under prefix
+        '''
+        base = os.path.join(self.root, bucket)
+        objects = []
+        for directory, _, files in os.walk(base):
+            for name in files:
+                path = os.path.join(directory, name)
+                key = os.path.relpath(path, base).replace(os.sep, '/')
+                if key.startswith(prefix) and _is_data_key(key):
+                    objects.append((key, os.path.getsize(path)))
+        return sorted(objects)
+
+    def open(self, bucket, key):
+        return open(os.path.join(self.root, bucket, key), 'rb')
+
+
+class S3Store(object):
+    """
+    Object store on S3 or an S3 compatible endpoint (host:port), via boto.
+    """
+
+    def __init__(self, endpoint=None, connection=None):
+        self.endpoint = endpoint
+        self._connection = connection
+        self._local = threading.local()
+
+    def _bucket(self, name):
+        # boto connections aren't thread safe, every worker gets its own
+        buckets = getattr(self._local, 'buckets', None)
+        if buckets is None:
+            buckets = self._local.buckets = {}
+        if name not in buckets:
+            buckets[name] = self._connect().get_bucket(name, validate=False)
+        return buckets[name]
+
+    def _connect(self):
+        if self._connection is not None:
+            return self._connection
+        # only runs that read from S3 pay for importing boto
+        import boto
+        from boto.s3.connection import OrdinaryCallingFormat
+        if not self.endpoint:
+            return boto.connect_s3()
+        host, _, port = self.endpoint.partition(':')
+        return boto.connect_s3(
+            host=host, port=int(port) if port else None, is_secure=False,
+            calling_format=OrdinaryCallingFormat())
+
+    def list(self, bucket, prefix=''):
+        return sorted((key.name, key.size)
+                      for key in self._bucket(bucket).list(prefix)
+                      if _is_data_key(key.name))
+
+    def open(self, bucket, key):
+        # a boto Key streams the object with read(size)
+        return self._bucket(bucket).get_key(key)
+
+
+class _Object(object):
+    """
+    Download state of one object.
+    """
+
+    def __init__(self, index, key, size):
+        self.index = index
+        self.key = key
+        self.size = size
+        self.chunks = []
+        self.done = False
+        self.abandoned = False
+        self.error = None
+
+
+class PrefetchStats(object):
+
+    def __init__(self):
+        self.objects = 0
+        self.bytes = 0
+        # summed over workers, and caller time waiting on downloads
+        self.download_seconds = 0.0
+        self.stall_seconds = 0.0
+        self.peak_buffered = 0
+        self.elapsed = 0.0
+
+    def as_dict(self):
+        return {
+            'objects': self.objects,
+            'bytes': self.bytes,
+            'download_seconds': round(self.download_seconds, 3),
+            'stall_seconds': round(self.stall_seconds, 3),
+            'peak_buffered_bytes': self.peak_buffered,
+            'bytes_per_second': round(self.bytes / self.elapsed, 1)
+            if self.elapsed else None,
+        }
+
+
+class PrefetchReader(object):
+    """
+    Reads the objects under one or more s3:// prefixes in listing order,
+    downloading ahead on a pool of threads.
+    """
+
+    def __init__(self, store, uris, workers=WORKERS, max_buffer=MAX_BUFFER,
+                 chunk_size=CHUNK_SIZE):
+        self.store = store
+        self.objects = []
+        for uri in uris:
+            bucket, prefix = parse_uri(uri)
+            for key, size in store.list(bucket, prefix):
+                self.objects.append(
+                    _Object(len(self.objects), (bucket, key), size))
+        self.workers = workers
+        self.max_buffer = max_buffer
+        self.chunk_size = chunk_size
+        self.stats = PrefetchStats()
+
+        self._lock = threading.Condition()
+        self._buffered = 0
+        # next object to claim for download, object being read
+        self._next = 0
+        self._current = 0
+        self._closed = False
+        self._threads = []
+
+    def _start(self):
+        for _ in range(min(self.workers, len(self.objects))):
+            thread = threading.Thread(target=self._download)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _download(self):
+        while True:
+            with self._lock:
+                if self._closed or self._next >= len(self.objects):
+                    return
+                obj = self.objects[self._next]
+                self._next += 1
+            started = time.time()
+            try:
+                stream = self.store.open(*obj.key)
+                try:
+                    while True:
+                        chunk = stream.read(self.chunk_size)
+                        if not chunk or not self._put(obj, chunk):
+                            break
+                finally:
+                    stream.close()
+            except Exception as e:
+                obj.error = e
+            with self._lock:
+                obj.done = True
+                self.stats.download_seconds += time.time() - started
+                self._lock.notify_all()
+
+    def _put(self, obj, chunk):
+        '''
+        Adds a downloaded chunk to the buffer, waiting while it is full.
+        False once the reader is closed
+        '''
+        with self._lock:
+            # the object being read may always add a chunk once the
+            # caller has drained it, so a full buffer can't stall it
+            while (not self._closed and
+                   self._buffered + len(chunk) > self.max_buffer and
+                   not (obj.index == self._current and not obj.chunks)):
+                self._lock.wait()
+            if self._closed or obj.abandoned:
+                return False
+            obj.chunks.append(chunk)
+            self._buffered += len(chunk)
+            self.stats.peak_buffered = max(self.stats.peak_buffered,
+                                           self._buffered)
+            self._lock.notify_all()
+            return True
+
+    def _chunks(self, obj):
+        '''
+        Chunks of the object being read, as they arrive
+        '''
+        while True:
+            with self._lock:
+                tick = time.time()
+                while not obj.chunks and not obj.done:
+                    self._lock.wait()
+                self.stats.stall_seconds += time.time() - tick
+                if obj.chunks:
+                    chunk = obj.chunks.pop(0)
+                    self._buffered -= len(chunk)
+                    self._lock.notify_all()
+                elif obj.error is not None:
+                    raise obj.error
+                else:
+                    return
+            self.stats.bytes += len(chunk)
+            yield chunk
+
+    def __iter__(self):
+        '''
+        Yields (name, line iterator) of every object, in listing order
+        '''
+        started = time.time()
+        self._start()
+        try:
+            for obj in self.objects:
+                with self._lock:
+                    self._current = obj.index
+                    self._lock.notify_all()
+                yield 's3://%s/%s' % obj.key, iter_lines(
+                    self._chunks(obj), obj.key[1])
+                self.stats.objects += 1
+                self._discard(obj)
+        finally:
+            self.stats.elapsed = time.time() - started
+            self.close()
+
+    def _discard(self, obj):
+        '''
+        Drops whatever the caller didn't read of an object, so it doesn't
+        hold on to the buffer
+        '''
+        with self._lock:
+            obj.abandoned = True
+            self._buffered -= sum(len(chunk) for chunk in obj.chunks)
+            obj.chunks = []
+            self._lock.notify_all()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._lock.notify_all()
+
+
+def _decompressor(name):
+    ext = os.path.splitext(name)[1]
+    if ext == '.gz':
+        # 16 + MAX_WBITS: expect a gzip header
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if ext == '.bz2':
+        return bz2.BZ2Decompressor()
+    if ext == '.zst':
+        # optional dependency, only needed for zstd objects
+        import zstandard
+        return zstandard.ZstdDecompressor().decompressobj()
+    return None
+
+
+def _decompress(chunks, name):
+    decompressor = _decompressor(name)
+    if decompressor is None:
+        for chunk in chunks:
+            yield chunk
+    elif name.endswith('.gz'):
+        for chunk in chunks:
+            # concatenated gzip members (agora-index recompress output)
+            while chunk:
+                yield decompressor.decompress(chunk)
+                chunk = decompressor.unused_data
+                if chunk:
+                    decompressor = _decompressor(name)
+    else:
+        for chunk in chunks:
+            yield decompressor.decompress(chunk)
+
+
+def iter_lines(chunks, name=''):
+    '''
+    Lines of a stream of chunks, decompressed according to the extension
+    of name
+    '''
+    rest = ''
+    for data in _decompress(chunks, name):
+        if not data:
+            continue
+        lines = (rest + data).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if rest:
+        yield rest
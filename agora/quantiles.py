@@ -0,0 +1,178 @@
+"""
+KLL quantile sketches for metric distributions.
+
+A sketch keeps a hierarchy of compactors; level h holds items that each
+stand for 2 ** h values. Memory is bounded by about 3k items regardless of
+how many values are added and sketches merge in any order. At the default
+k the rank error stays well under 1%.
+"""
+import base64
+import math
+import random
+import struct
+import zlib
+
+from agora.defaults import K
+
+
+class KLLSketch(object):
+    """
+    Mergeable quantile sketch (Karnin, Lang, Liberty 2016).
+    """
+    C = 2.0 / 3.0
+
+    def __init__(self, k=K, seed=0):
+        self.k = k
+        self.compactors = [[]]
+        self.count = 0
+        self.min = None
+        self.max = None
+        self._size = 0
+        self._random = random.Random(seed)
+        self._update_max_size()
+
+    def _capacity(self, height):
+        depth = len(self.compactors) - height - 1
+        return int(math.ceil(self.C ** depth * self.k)) + 1
+
+    def _update_max_size(self):
+        self._max_size = sum(self._capacity(h)
+                             for h in xrange(len(self.compactors)))
+
+    def add(self, value):
+        value = float(value)
+        self.compactors[0].append(value)
+        self.count += 1
+        self._size += 1
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if self._size >= self._max_size:
+            self._compress()
+
+    def _compress(self):
+        while self._size >= self._max_size:
+            for height, compactor in enumerate(self.compactors):
+                if len(compactor) >= self._capacity(height):
+                    if height + 1 == len(self.compactors):
+                        self.compactors.append([])
+                        self._update_max_size()
+                    self._compact(height)
+                    if self._size < self._max_size:
+                        break
+
+    def _compact(self, height):
+        '''
+        Promotes every other item of a level (random offset) to the
+        level above
+        '''
+        compactor = self.compactors[height]
+        compactor.sort()
+        # an odd item out stays behind
+        keep = [compactor.pop()] if len(compactor) % 2 else []
+        offset = self._random.randint(0, 1)
+        promoted = compactor[offset::2]
+        self.compactors[height + 1].extend(promoted)
+        self.compactors[height] = keep
+        self._size -= len(compactor) - len(promoted)
+
+    def merge(self, other):
+        '''
+        Adds all values summarized by other, in place
+        '''
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append([])
+        self._update_max_size()
+        for height, compactor in enumerate(other.compactors):
+            self.compactors[height].extend(compactor)
+            self._size += len(compactor)
+        self.count += other.count
+        for value in (other.min, other.max):
+            if value is not None:
+                if self.min is None or value < self.min:
+                    self.min = value
+                if self.max is None or value > self.max:
+                    self.max = value
+        if self._size >= self._max_size:
+            self._compress()
+        return self
+
+    def _weighted(self):
+        items = []
+        for height, compactor in enumerate(self.compactors):
+            weight = 1 << height
+            items.extend((value, weight) for value in compactor)
+        items.sort()
+        return items
+
+    def rank(self, value):
+        '''
+        Estimated number of values <= value
+        '''
+        return sum(weight for item, weight in self._weighted()
+                   if item <= value)
+
+    def quantiles(self, fractions):
+        '''
+        Estimated values at the given fractions (0..1) of the distribution
+        '''
+        items = self._weighted()
+        if not items:
+            return [None] * len(fractions)
+        total = sum(weight for _, weight in items)
+        results = []
+        for fraction in fractions:
+            if fraction <= 0:
+                results.append(self.min)
+                continue
+            if fraction >= 1:
+                results.append(self.max)
+                continue
+            target = fraction * total
+            seen = 0
+            for item, weight in items:
+                seen += weight
+                if seen >= target:
+                    break
+            results.append(item)
+        return results
+
+    def quantile(self, fraction):
+        return self.quantiles([fraction])[0]
+
+    def to_string(self):
+        '''
+        Compact ascii form of the sketch
+        '''
+        parts = [struct.pack('<IQdd', self.k, self.count,
+                             self.min if self.min is not None else 0.0,
+                             self.max if self.max is not None else 0.0),
+                 struct.pack('<I', len(self.compactors))]
+        for compactor in self.compactors:
+            parts.append(struct.pack('<I%dd' % len(compactor),
+                                     len(compactor), *compactor))
+        return base64.b64encode(zlib.compress(''.join(parts)))
+
+    @classmethod
+    def from_string(cls, value):
+        data = zlib.decompress(base64.b64decode(value))
+        k, count, minimum, maximum = struct.unpack_from('<IQdd', data)
+        offset = struct.calcsize('<IQdd')
+        levels, = struct.unpack_from('<I', data, offset)
+        offset += 4
+        sketch = cls(k)
+        sketch.compactors = []
+        for _ in xrange(levels):
+            size, = struct.unpack_from('<I', data, offset)
+            offset += 4
+            sketch.compactors.append(
+                list(struct.unpack_from('<%dd' % size, data, offset)))
+            offset += 8 * size
+        sketch.count = count
+        if count:
+            sketch.min = minimum
+            sketch.max = maximum
+        sketch._size = sum(len(c) for c in sketch.compactors)
+        sketch._update_max_size()
+        return sketch
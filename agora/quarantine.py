@@ -0,0 +1,121 @@
+"""
+Quarantine of log lines and events that can't be used.
+
+Rejections are counted per reason. A sample of the offending raw lines or
+events is written to a size-capped side file of JSON records, so they can
+be looked at or reprocessed later. Nothing is formatted unless it is
+actually logged or written.
+"""
+import json
+import logging
+import os
+import random
+import socket
+
+logger = logging.getLogger(__name__)
+
+# reasons a line or event is quarantined
+UNPARSABLE = 'unparsable'
+BAD_DATE = 'bad-date'
+NO_MEDIA_ID = 'no-tp-media-id'
+NEGATIVE_BUFFERING = 'negative-buffering'
+FLOAT_BUFFERING = 'float-buffering'
+MEDIA_ID_MISMATCH = 'media-id-mismatch'
+BAD_IP = 'bad-ip'
+
+REASONS = (
+    UNPARSABLE,
+    BAD_DATE,
+    NO_MEDIA_ID,
+    NEGATIVE_BUFFERING,
+    FLOAT_BUFFERING,
+    MEDIA_ID_MISMATCH,
+    BAD_IP,
+)
+
+# side file size cap
+MAX_BYTES = 10 * 1024 * 1024
+
+
+def side_file_path(directory, prefix='quarantine', extension='jsonl'):
+    '''
+    Side file of this process, so concurrent tasks never share a file
+    '''
+    return os.path.join(directory, '%s-%s-%d.%s' % (
+        prefix, socket.gethostname(), os.getpid(), extension))
+
+
+class Quarantine(object):
+    """
+    Counts rejected lines and events, and samples them to a side file.
+
+    on_reject, when given, is called with the reason of every rejection
+    (the job uses it to keep Hadoop counters).
+    """
+
+    def __init__(self, path=None, sample_rate=1.0, max_bytes=MAX_BYTES,
+                 on_reject=None, seed=None):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.on_reject = on_reject
+        self.counts = dict.fromkeys(REASONS, 0)
+        self.written = 0
+        self.written_bytes = 0
+        self.dropped = 0
+        self._file = None
+        self._random = random.Random(seed)
+
+    def reject(self, reason, line=None, event=None):
+        '''
+        Records a rejected raw line or parsed event
+        '''
+        self.counts[reason] = self.counts.get(reason, 0) + 1
+        if self.on_reject is not None:
+            self.on_reject(reason)
+        # arguments are only formatted when debug logging is on
+        logger.debug('quarantined (%s): %r', reason,
+                     line if line is not None else event)
+        if self.path is None or (line is None and event is None):
+            return
+        if self.sample_rate < 1 and self._random.random() >= self.sample_rate:
+            return
+        record = {'reason': reason}
+        if isinstance(line, str):
+            line = line.decode('utf-8', 'replace')
+        if line is not None:
+            record['line'] = line.rstrip(u'\r\n')
+        if event is not None:
+            record['event'] = event
+        data = json.dumps(record) + '\n'
+        if self.written_bytes + len(data) > self.max_bytes:
+            self.dropped += 1
+            return
+        if self._file is None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            self._file = open(self.path, 'a')
+        self._file.write(data)
+        # tasks can be killed at any time, don't lose the buffer
+        self._file.flush()
+        self.written += 1
+        self.written_bytes += len(data)
+
+    def total(self):
+        return sum(self.counts.itervalues())
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def read_side_file(path):
+    '''
+    Yields (reason, line, event) of a side file, for reprocessing
+    '''
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            yield record['reason'], record.get('line'), record.get('event')
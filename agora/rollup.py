@@ -0,0 +1,225 @@
+"""
+Rollups of session summaries into daily aggregates.
+
+Every session summary becomes a small partial aggregate under one rollup
+key per grouping; partials are plain dicts so they can be merged in any
+order by combiners and reducers. Distinct viewers and sessions are
+estimated with HyperLogLog sketches that are kept in the output, so daily
+rollups can be unioned into weekly ones downstream. Per source/component
+rollups also carry KLL quantile sketches of the buffering and playing
+duration distributions. All rollups carry buffering heatmaps, the summed
+position histograms of their sessions, the summed seconds played at each
+rendition (from which the time-weighted mean bitrate follows) and the
+range of the measured bandwidth.
+"""
+from agora.defaults import HLL_ERROR
+from agora.heatmap import PERCENT_BINS, TIME_BINS, PositionHistogram
+from agora.hll import HyperLogLog
+from agora.quantiles import K, KLLSketch
+from agora.stats import mean_bitrate, rendition_lists
+
+# grouping name -> summary fields it is keyed by (after the day)
+GROUPINGS = (
+    ('title', ('source', 'component', 'title')),
+    ('source', ('source',)),
+    ('component', ('source', 'component')),
+)
+
+# groupings that get quantile sketches
+QUANTILE_GROUPINGS = ('component',)
+
+
+def rollup_keys(summary):
+    '''
+    [grouping, day, dimension...] keys of a session summary, one per
+    grouping
+    '''
+    day = summary['earliest_time'][:10] if summary.get('earliest_time') \
+        else None
+    return [[name, day] + [summary.get(field) for field in fields]
+            for name, fields in GROUPINGS]
+
+
+def session_partials(summary, hll_error=HLL_ERROR, quantile_k=K):
+    '''
+    (rollup key, partial aggregate) pairs of one session summary
+    '''
+    partials = {}
+    for key in rollup_keys(summary):
+        detailed = key[0] in QUANTILE_GROUPINGS
+        if detailed not in partials:
+            stats = RollupStats(hll_error, quantile_k if detailed else None)
+            stats.add_summary(summary)
+            partials[detailed] = stats.to_dict()
+        yield key, partials[detailed]
+
+
+class RollupStats(object):
+    """
+    Mergeable aggregate of any number of session summaries.
+    """
+
+    # totals that are simply summed when merging
+    SUM_FIELDS = (
+        'sessions',
+        'plays',
+        'completed',
+        'playing_duration',
+        'buffer_start_events',
+        'buffering_events',
+        'buffering_length',
+        'buffering_length_sessions',
+        'initial_buffering_length',
+        'auto_bitrate_events',
+        'user_bitrate_events',
+    )
+
+    # distinct count sketch -> summary field counted
+    SKETCH_FIELDS = (
+        ('viewers', 'viewer_id'),
+        ('session_ids', 'session_id'),
+    )
+
+    # summary fields with quantile sketches, and the reported quantiles
+    QUANTILE_FIELDS = (
+        'buffering_length',
+        'initial_buffering_length',
+        'playing_duration',
+    )
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    # summary fields with buffering position histograms, and their bins
+    HEATMAP_FIELDS = (
+        ('buffering_time_bins', TIME_BINS),
+        ('buffering_percent_bins', PERCENT_BINS),
+    )
+
+    def __init__(self, hll_error=HLL_ERROR, quantile_k=None):
+        self.totals = dict.fromkeys(self.SUM_FIELDS, 0)
+        self.sketches = {}
+        for name, _ in self.SKETCH_FIELDS:
+            self.sketches[name] = HyperLogLog(hll_error)
+        # created up front when requested, otherwise by merging partials
+        # that have them
+        self.quantiles = {}
+        if quantile_k:
+            for field in self.QUANTILE_FIELDS:
+                self.quantiles[field] = KLLSketch(quantile_k)
+        self.heatmaps = dict((field, PositionHistogram(bins))
+                             for field, bins in self.HEATMAP_FIELDS)
+        # kbps -> seconds played at that rendition
+        self.rendition_seconds = {}
+        self.min_bandwidth = None
+        self.max_bandwidth = None
+
+    def add_summary(self, summary):
+        '''
+        Adds one PBSVideoStats summary
+        '''
+        totals = self.totals
+        totals['sessions'] += 1
+        if summary.get('playing_duration'):
+            totals['plays'] += 1
+            totals['playing_duration'] += summary['playing_duration']
+        if summary.get('finished_playback'):
+            totals['completed'] += 1
+        if summary.get('buffering_length') is not None:
+            # only streams with a valid buffering length
+            totals['buffering_length'] += summary['buffering_length']
+            totals['buffering_length_sessions'] += 1
+        for field in ('buffer_start_events', 'buffering_events',
+                      'initial_buffering_length', 'auto_bitrate_events',
+                      'user_bitrate_events'):
+            totals[field] += summary.get(field) or 0
+        for name, field in self.SKETCH_FIELDS:
+            if summary.get(field):
+                self.sketches[name].add(summary[field])
+        for field, sketch in self.quantiles.iteritems():
+            if summary.get(field) is not None:
+                sketch.add(summary[field])
+        for field, heatmap in self.heatmaps.iteritems():
+            heatmap.merge(summary.get(field) or ())
+        self._merge_bitrates(summary)
+
+    def _merge_bitrates(self, r):
+        # summaries and partials have the same rendition and bandwidth
+        # fields
+        for kbps, seconds in zip(r.get('renditions') or (),
+                                 r.get('rendition_seconds') or ()):
+            self.rendition_seconds[kbps] = \
+                self.rendition_seconds.get(kbps, 0) + seconds
+        if r.get('min_bandwidth') is not None and (
+                self.min_bandwidth is None or
+                r['min_bandwidth'] < self.min_bandwidth):
+            self.min_bandwidth = r['min_bandwidth']
+        if r.get('max_bandwidth') is not None and (
+                self.max_bandwidth is None or
+                r['max_bandwidth'] > self.max_bandwidth):
+            self.max_bandwidth = r['max_bandwidth']
+
+    def merge(self, partial):
+        '''
+        Merges a partial aggregate as returned by to_dict()
+        '''
+        for field in self.SUM_FIELDS:
+            self.totals[field] += partial.get(field, 0)
+        for name, _ in self.SKETCH_FIELDS:
+            sketch = partial.get(name + '_hll')
+            if sketch:
+                self.sketches[name].merge(HyperLogLog.from_string(sketch))
+        for field in self.QUANTILE_FIELDS:
+            sketch = partial.get(field + '_kll')
+            if not sketch:
+                continue
+            sketch = KLLSketch.from_string(sketch)
+            if field in self.quantiles:
+                self.quantiles[field].merge(sketch)
+            else:
+                self.quantiles[field] = sketch
+        for field, heatmap in self.heatmaps.iteritems():
+            heatmap.merge(partial.get(field) or ())
+        self._merge_bitrates(partial)
+
+    def to_dict(self):
+        r = dict(self.totals)
+        for name, sketch in self.sketches.iteritems():
+            r[name + '_hll'] = sketch.to_string()
+        for field, sketch in self.quantiles.iteritems():
+            r[field + '_kll'] = sketch.to_string()
+        for field, heatmap in self.heatmaps.iteritems():
+            r[field] = heatmap.to_list()
+        r['renditions'], r['rendition_seconds'] = \
+            rendition_lists(self.rendition_seconds)
+        r['min_bandwidth'] = self.min_bandwidth
+        r['max_bandwidth'] = self.max_bandwidth
+        return r
+
+    @classmethod
+    def from_dict(cls, partial, hll_error=HLL_ERROR):
+        stats = cls(hll_error)
+        stats.merge(partial)
+        return stats
+
+    def summary(self):
+        r = self.to_dict()
+        totals = self.totals
+        r['completion_rate'] = None
+        if totals['sessions']:
+            r['completion_rate'] = \
+                float(totals['completed']) / totals['sessions']
+        r['avg_playing_duration'] = None
+        if totals['plays']:
+            r['avg_playing_duration'] = \
+                float(totals['playing_duration']) / totals['plays']
+        r['mean_bitrate'] = mean_bitrate(self.rendition_seconds)
+        r['distinct_viewers'] = self.sketches['viewers'].count()
+        r['distinct_sessions'] = self.sketches['session_ids'].count()
+        for field, sketch in self.quantiles.iteritems():
+            values = sketch.quantiles(self.QUANTILES)
+            for fraction, value in zip(self.QUANTILES, values):
+                r['%s_p%d' % (field, fraction * 100)] = value
+        r['avg_buffering_length'] = None
+        if totals['buffering_length_sessions']:
+            r['avg_buffering_length'] = float(totals['buffering_length']) / \
+                totals['buffering_length_sessions']
+        return r
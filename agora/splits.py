@@ -0,0 +1,132 @@
+"""
+Coalescing of small inputs into target-sized splits, and the startup
+overhead of tasks.
+
+Fluentd writes many small files a day. Every input file is at least one map
+task, and every task pays for starting an interpreter, importing the job
+and loading the GeoIP databases. On Hadoop the job combines small files
+with CombineTextInputFormat; in local runs group_inputs() does the same by
+concatenating small files of the same compression and log format into
+combined files of about the target size.
+"""
+import os
+import time
+
+from agora.logs import SNIFF_LINES, sniff_format
+
+# old API input format, as used by hadoop streaming
+COMBINE_INPUT_FORMAT = 'org.apache.hadoop.mapred.lib.CombineTextInputFormat'
+SPLIT_MAX_SIZE = 'mapreduce.input.fileinputformat.split.maxsize'
+
+# compressed input extensions, and the compressions (plain text is '')
+# whose files are still valid when concatenated
+COMPRESSIONS = ('.gz', '.bz2', '.zst')
+CONCATENABLE = ('', '.gz')
+
+
+def compression(path):
+    ext = os.path.splitext(path)[1]
+    return ext if ext in COMPRESSIONS else ''
+
+
+def list_inputs(paths):
+    '''
+    Files of paths, with directories expanded, in order
+    '''
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, names in sorted(os.walk(path)):
+                files.extend(os.path.join(directory, name)
+                             for name in sorted(names)
+                             if name[0] not in '._')
+        else:
+            files.append(path)
+    return files
+
+
+def input_format(path):
+    '''
+    Name of the log format a file's first lines look like
+    '''
+    # only the launcher groups inputs, tasks don't need the ingest imports
+    from agora.ingest import open_input
+    f = open_input(path, external=False)
+    try:
+        head = []
+        for line in f:
+            head.append(line)
+            if len(head) >= SNIFF_LINES:
+                break
+    finally:
+        f.close()
+    return sniff_format(head).name
+
+
+def group_inputs(paths, target_size):
+    '''
+    Input files in groups of about target_size bytes. Only files of the
+    same compression and log format share a group, since every task parses
+    its split with one format. Files that can't be concatenated, and files
+    of at least target_size bytes, are groups of their own.
+    '''
+    groups = []
+    # (compression, format) -> group being filled, and its size
+    open_groups = {}
+    for path in list_inputs(paths):
+        size = os.path.getsize(path)
+        ext = compression(path)
+        if ext not in CONCATENABLE or size >= target_size:
+            groups.append([path])
+            continue
+        kind = (ext, input_format(path))
+        group, group_size = open_groups.get(kind, (None, 0))
+        if group is None or group_size + size > target_size:
+            group = []
+            groups.append(group)
+            group_size = 0
+        group.append(path)
+        open_groups[kind] = (group, group_size + size)
+    return groups
+
+
+def coalesce(paths, target_size, output_dir):
+    '''
+    Concatenates small inputs into combined files in output_dir, returns
+    the paths to run on instead of paths
+    '''
+    inputs = []
+    for group in group_inputs(paths, target_size):
+        if len(group) == 1:
+            inputs.append(group[0])
+            continue
+        ext = compression(group[0])
+        combined = os.path.join(
+            output_dir, 'combined-%05d%s' % (len(inputs), ext))
+        with open(combined, 'wb') as out:
+            for path in group:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                out.write(data)
+                # gzip members can follow each other, lines can't
+                if not ext and data and not data.endswith('\n'):
+                    out.write('\n')
+        inputs.append(combined)
+    return inputs
+
+
+def process_started():
+    '''
+    Time this process started, None where it isn't known
+    '''
+    try:
+        with open('/proc/self/stat') as f:
+            # the fields after the parenthesized command name, starting
+            # with the state (field 3); the start time is field 22
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        started = int(fields[19]) / float(os.sysconf('SC_CLK_TCK'))
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+    return time.time() - (uptime - started)
@@ -1,15 +1,96 @@
+import bisect
 import socket
 from datetime import datetime
 
+from agora.heatmap import session_heatmaps
+from agora.logs import intern_value
+from agora.quarantine import BAD_IP, FLOAT_BUFFERING, MEDIA_ID_MISMATCH, \
+    NEGATIVE_BUFFERING, NO_MEDIA_ID
+
+
+def rendition_lists(rendition_seconds):
+    '''
+    ([kbps...], [seconds...]) of a {kbps: seconds} dict, by kbps
+    '''
+    renditions = sorted((int(kbps), seconds)
+                        for kbps, seconds in rendition_seconds.iteritems()
+                        if seconds)
+    return [kbps for kbps, _ in renditions], \
+        [seconds for _, seconds in renditions]
+
+
+def mean_bitrate(rendition_seconds):
+    '''
+    Time-weighted mean bitrate in kbps of a {kbps: seconds} dict, None
+    without any time
+    '''
+    total = sum(rendition_seconds.itervalues())
+    if not total:
+        return None
+    return float(sum(int(kbps) * seconds for kbps, seconds in
+                     rendition_seconds.iteritems())) / total
+
 
 class PBSVideoStats(object):
 
+    # (name, type) of every field of summary(), in output order. Types are
+    # the columnar output types: string, int, float, bool, timestamp or
+    # ints (a list of integers)
+    SUMMARY_FIELDS = (
+        ('tracking_id', 'string'),
+        ('media_id', 'string'),
+        ('earliest_time', 'timestamp'),
+        ('latest_time', 'timestamp'),
+        ('incomplete_stream', 'bool'),
+        ('finished_playback', 'bool'),
+        ('first_event_type', 'string'),
+        ('last_event_type', 'string'),
+        ('buffer_start_events', 'int'),
+        ('playing_duration', 'int'),
+        ('source', 'string'),
+        ('user_agent', 'string'),
+        ('component', 'string'),
+        ('auto_bitrate', 'bool'),
+        ('title', 'string'),
+        ('session_id', 'string'),
+        ('viewer_id', 'string'),
+        ('video_length', 'float'),
+        ('position_earliest_play', 'float'),
+        ('buffering_events', 'int'),
+        ('buffering_length', 'int'),
+        ('initial_buffering_length', 'int'),
+        ('auto_bitrate_events', 'int'),
+        ('user_bitrate_events', 'int'),
+        ('encoding_name', 'string'),
+        ('mean_bitrate', 'float'),
+        ('renditions', 'ints'),
+        ('rendition_seconds', 'ints'),
+        ('min_bandwidth', 'float'),
+        ('max_bandwidth', 'float'),
+        ('buffering_time_bins', 'ints'),
+        ('buffering_percent_bins', 'ints'),
+        ('isp_name', 'string'),
+        ('geo_city', 'string'),
+        ('geo_longitude', 'float'),
+        ('geo_latitude', 'float'),
+        ('geo_postal_code', 'string'),
+        ('geo_metro_code', 'int'),
+        ('geo_country_code', 'string'),
+        ('geo_country_name', 'string'),
+    )
+
+    # attributes that aren't part of the state of a stream, and the
+    # datetime attributes of the state
+    NOT_STATE = ('isp_lookup', 'geo_lookup', 'quarantine')
+    DATETIME_STATE = ('earliest_time', 'latest_time',
+                      '_buffering_start_time')
+
     # These are the only events that are parsed for playing duration
     MEDIA_START_EVENTS = ['MediaStarted', 'MediaInitialBufferStart']
     MEDIA_ENDED_EVENTS = ['MediaEnded', 'MediaCompleted']
     MEDIA_EVENTS = MEDIA_START_EVENTS + MEDIA_ENDED_EVENTS
 
-    def __init__(self, isp_lookup=None, geo_lookup=None):
+    def __init__(self, isp_lookup=None, geo_lookup=None, quarantine=None):
 
         # Ids used to differentiate videos
         self.tracking_id = None
@@ -36,6 +117,7 @@ class PBSVideoStats(object):
         self.component = None
         self.auto_bitrate = None
         self.client_id = None
+        self.viewer_id = None
         self.title = None
         self.session_id = None
         self.user_agent = None
@@ -48,6 +130,14 @@ class PBSVideoStats(object):
         # track bitrate changes manually made by the user
         self.user_bitrate_events = 0
 
+        # [timestamp, kbps] of the rendition (x_stream_size) events report,
+        # timed against the play intervals in summary(), and the range of
+        # the measured bandwidth
+        self.encoding_name = None
+        self.rendition_points = []
+        self.min_bandwidth = None
+        self.max_bandwidth = None
+
         # Keeps track of number of buffering events/video location
         # of the events
         self.buffering_positions = []
@@ -64,6 +154,8 @@ class PBSVideoStats(object):
 
         self.isp_lookup = isp_lookup
         self.geo_lookup = geo_lookup
+        # optional agora.quarantine.Quarantine of rejected events
+        self.quarantine = quarantine
 
     def add_event(self, event):
         '''
@@ -82,6 +174,8 @@ class PBSVideoStats(object):
             self.component = event['component']
         if not self.client_id and event.get('remote'):
             self.client_id = event['remote']
+        if not self.viewer_id and event.get('x_client_id'):
+            self.viewer_id = event['x_client_id']
         if not self.title and event.get('x_episode_title'):
             self.title = event['x_episode_title']
         if not self.session_id and event.get('x_session_id'):
@@ -90,6 +184,8 @@ class PBSVideoStats(object):
             self.user_agent = event['agent']
         if not self.video_length and event.get('x_video_length'):
             self.video_length = event['x_video_length']
+        if not self.encoding_name and event.get('x_encoding_name'):
+            self.encoding_name = event['x_encoding_name']
 
         # Skip event if it contains bad data
         if self._contains_bad_data(event):
@@ -144,6 +240,48 @@ class PBSVideoStats(object):
         if edate is not None and etype in self.MEDIA_EVENTS:
             self._add_duration_event(etype, edate)
 
+        self._add_bandwidth(event.get('x_bandwidth'))
+        if edate is not None and event.get('x_stream_size'):
+            self._add_rendition_point(event['x_stream_size'], edate)
+
+    def to_state(self):
+        '''
+        JSON serializable state of the stream, events can be added to it
+        again after from_state()
+        '''
+        state = {}
+        for name, value in self.__dict__.iteritems():
+            if name in self.NOT_STATE:
+                continue
+            if name in self.DATETIME_STATE and value is not None:
+                value = value.strftime('%Y-%m-%d %H:%M:%S')
+            state[name] = value
+        state['duration_events'] = [
+            {'etype': event['etype'],
+             'edate': event['edate'].strftime('%Y-%m-%d %H:%M:%S')}
+            for event in self.duration_events]
+        state['rendition_points'] = [
+            [edate.strftime('%Y-%m-%d %H:%M:%S'), kbps]
+            for edate, kbps in self.rendition_points]
+        return state
+
+    @classmethod
+    def from_state(cls, state, isp_lookup=None, geo_lookup=None,
+                   quarantine=None):
+        stats = cls(isp_lookup, geo_lookup, quarantine)
+        for name, value in state.iteritems():
+            if name in cls.DATETIME_STATE and value is not None:
+                value = datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+            setattr(stats, name, value)
+        stats.duration_events = [
+            {'etype': event['etype'],
+             'edate': datetime.strptime(event['edate'], '%Y-%m-%d %H:%M:%S')}
+            for event in state.get('duration_events', ())]
+        stats.rendition_points = [
+            [datetime.strptime(edate, '%Y-%m-%d %H:%M:%S'), kbps]
+            for edate, kbps in state.get('rendition_points', ())]
+        return stats
+
     def summary(self):
         r = dict()
         r['tracking_id'] = self.tracking_id
@@ -162,6 +300,7 @@ class PBSVideoStats(object):
         r['auto_bitrate'] = self.auto_bitrate
         r['title'] = self.title
         r['session_id'] = self.session_id
+        r['viewer_id'] = self.viewer_id
         r['video_length'] = self.video_length
         r['position_earliest_play'] = self.position_earliest_play
         r['buffering_events'] = self.buffering_events
@@ -169,13 +308,24 @@ class PBSVideoStats(object):
         r['initial_buffering_length'] = self.initial_buffering_length
         r['auto_bitrate_events'] = self.auto_bitrate_events
         r['user_bitrate_events'] = self.user_bitrate_events
+        r['encoding_name'] = self.encoding_name
+        rendition_seconds = self.rendition_seconds()
+        r['renditions'], r['rendition_seconds'] = \
+            rendition_lists(rendition_seconds)
+        r['mean_bitrate'] = mean_bitrate(rendition_seconds)
+        r['min_bandwidth'] = self.min_bandwidth
+        r['max_bandwidth'] = self.max_bandwidth
+        r['buffering_time_bins'] = None
+        r['buffering_percent_bins'] = None
+        if self.buffering_positions is not None:
+            r['buffering_time_bins'], r['buffering_percent_bins'] = \
+                session_heatmaps(self.buffering_positions, self.video_length)
         r['isp_name'] = None
         if self.client_id and self.isp_lookup:
             try:
                 r['isp_name'] = self.isp_lookup.org_by_addr(self.client_id)
             except socket.error:
-                # TODO: logging
-                print 'BAD IP: %s' % self.client_id
+                self._reject(BAD_IP, {'remote': self.client_id})
         r['geo_city'] = None
         r['geo_longitude'] = None
         r['geo_latitude'] = None
@@ -188,8 +338,7 @@ class PBSVideoStats(object):
                 geo_record = self.geo_lookup.record_by_addr(self.client_id)
             except socket.error:
                 geo_record = None
-                # TODO: logging
-                print 'BAD IP: %s' % self.client_id
+                self._reject(BAD_IP, {'remote': self.client_id})
             if geo_record:
                 r['geo_city'] = geo_record.get('city')
                 r['geo_longitude'] = geo_record.get('longitude')
@@ -208,35 +357,39 @@ class PBSVideoStats(object):
 
         # All events must have a me
         if not self._check_media_id(event):
-            print 'XXXX Fail!'
             return True
 
         try:
             # TODO: truncate floating to int
             # Events should not have negative buffering_length
             if int(event.get('x_buffering_length', 0)) < 0:
-                print 'Negative Buffering'
+                self._reject(NEGATIVE_BUFFERING, event)
                 return True
         except ValueError:
             # buffering_length is a float (illegal)
-            print 'Buffering Length not an integer'
+            self._reject(FLOAT_BUFFERING, event)
             return True
 
         return False
 
     def _check_media_id(self, event):
         if not event.get('x_tpmid'):
-            print 'no tp media id'
+            self._reject(NO_MEDIA_ID, event)
             return None
 
         if not self.media_id:
             self.media_id = event['x_tpmid']
         else:
             if self.media_id != event['x_tpmid']:
-                print 'Media ID mismatch!'
+                # counted, but the event is still used
+                self._reject(MEDIA_ID_MISMATCH, event)
 
         return True
 
+    def _reject(self, reason, event):
+        if self.quarantine is not None:
+            self.quarantine.reject(reason, event=event)
+
     def _addEventMediaStarted(self, event):
         # We are seeing the play event in the stream so we consider it complete
         # from a logging perspective
@@ -365,16 +518,77 @@ class PBSVideoStats(object):
     def _addEventMediaQualityChange(self, event):
         self.user_bitrate_events += 1
 
+    def _add_bandwidth(self, value):
+        try:
+            bandwidth = float(value)
+        except (TypeError, ValueError):
+            return
+        if bandwidth <= 0:
+            return
+        if self.min_bandwidth is None or bandwidth < self.min_bandwidth:
+            self.min_bandwidth = bandwidth
+        if self.max_bandwidth is None or bandwidth > self.max_bandwidth:
+            self.max_bandwidth = bandwidth
+
+    def _add_rendition_point(self, stream_size, edate):
+        try:
+            kbps = int(stream_size)
+        except (TypeError, ValueError):
+            return
+        if kbps <= 0:
+            return
+        self.rendition_points.append([edate, kbps])
+
+    def _rendition_changes(self):
+        """
+        Rendition points by time, without the ones that repeat the
+        rendition before them. Every point is kept in the stats, since
+        one that arrives later can fall between any two of them
+        """
+        self.rendition_points.sort()
+        changes = []
+        for point in self.rendition_points:
+            if not changes or changes[-1][1] != point[1]:
+                changes.append(point)
+        return changes
+
+    def rendition_seconds(self):
+        """
+        {kbps: seconds} played at each rendition. Every play interval is
+        split at the rendition points inside it, time before the first
+        known rendition isn't counted
+        """
+        changes = self._rendition_changes()
+        dates = [edate for edate, _ in changes]
+        seconds = {}
+        for start_time, end_time in self.playing_intervals():
+            index = bisect.bisect_right(dates, start_time)
+            kbps = changes[index - 1][1] if index else None
+            time = start_time
+            while index < len(dates) and dates[index] < end_time:
+                if kbps is not None:
+                    seconds[kbps] = seconds.get(kbps, 0) + \
+                        self._total_seconds(dates[index] - time)
+                time, kbps = changes[index]
+                index += 1
+            if kbps is not None:
+                seconds[kbps] = seconds.get(kbps, 0) + \
+                    self._total_seconds(end_time - time)
+        return seconds
+
     def _add_duration_event(self, etype, edate):
         # append dictionary of event type and timestamp
         # to the list of duration events
         self.duration_events.append({'etype': etype, 'edate': edate})
 
-    def _calculate_duration(self):
+    def playing_intervals(self):
+        """
+        (start, end) timestamps of every play period in the stream
+        """
         # sort duration events by timestamp
         self.duration_events.sort(key=lambda event: event['edate'])
 
-        duration = 0
+        intervals = []
         start_time = None
         for event in self.duration_events:
             # if event is a start event, save event timestamp
@@ -382,13 +596,19 @@ class PBSVideoStats(object):
                 if not start_time:
                     start_time = event['edate']
 
-            # if event is an end event, find time delta between
-            # play and pause times and add to duration
+            # if event is an end event, pair it up with the
+            # play time
             elif event['etype'] in self.MEDIA_ENDED_EVENTS:
                 if start_time:
-                    duration += self._total_seconds(
-                        event['edate'] - start_time)
+                    intervals.append((start_time, event['edate']))
                     start_time = None
+        return intervals
+
+    def _calculate_duration(self):
+        # add up the time delta between play and pause times
+        duration = 0
+        for start_time, end_time in self.playing_intervals():
+            duration += self._total_seconds(end_time - start_time)
 
         # if no duration can be calculate, return None
         if duration == 0:
@@ -408,7 +628,8 @@ class PBSVideoStats(object):
     def _parse_source_from_path(self, path):
         path_list = path.split('/')
         if len(path_list) >= 2:
-            source = path_list[2]
+            # one shared string per source across all streams
+            source = intern_value(path_list[2])
         else:
             source = None
         return source
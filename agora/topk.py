@@ -0,0 +1,170 @@
+"""
+Space-Saving heavy hitters for finding the worst ISPs, metros and titles.
+
+A summary keeps at most ``capacity`` weighted counters. Every reported
+count is an upper bound that overestimates by at most the item's ``error``,
+and any item that isn't tracked has a weight of at most ``max_error``.
+Summaries are mergeable (Agarwal et al., "Mergeable Summaries").
+"""
+from agora.defaults import TOP_K
+
+# (dimension, weight) pairs tracked from session summaries
+HEAVY_HITTERS = (
+    ('isp_name', 'buffering_events'),
+    ('isp_name', 'buffering_length'),
+    ('geo_metro_code', 'buffering_events'),
+    ('geo_metro_code', 'buffering_length'),
+    ('title', 'buffering_events'),
+    ('title', 'buffering_length'),
+)
+
+
+class SpaceSaving(object):
+    """
+    Weighted Space-Saving summary.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        # item -> [count, error]
+        self.counters = {}
+        self.total = 0
+
+    def offer(self, item, weight=1):
+        if weight <= 0:
+            return
+        self.total += weight
+        counter = self.counters.get(item)
+        if counter is not None:
+            counter[0] += weight
+        elif len(self.counters) < self.capacity:
+            self.counters[item] = [weight, 0]
+        else:
+            # evict the smallest counter, the newcomer inherits its count
+            # as possible overestimate
+            victim = min(self.counters, key=lambda i: self.counters[i][0])
+            floor = self.counters.pop(victim)[0]
+            self.counters[item] = [floor + weight, floor]
+
+    def _floor(self):
+        if len(self.counters) < self.capacity:
+            return 0
+        return min(c[0] for c in self.counters.itervalues())
+
+    @property
+    def max_error(self):
+        '''
+        Upper bound on the weight of any item that isn't tracked
+        '''
+        return self._floor()
+
+    def merge(self, other):
+        '''
+        Merges other into this summary, in place
+        '''
+        floor = self._floor()
+        other_floor = other._floor()
+        merged = {}
+        for item in set(self.counters) | set(other.counters):
+            count, error = self.counters.get(item, (floor, floor))
+            other_count, other_error = other.counters.get(
+                item, (other_floor, other_floor))
+            merged[item] = [count + other_count, error + other_error]
+        if len(merged) > self.capacity:
+            ranked = sorted(merged.iteritems(), key=lambda i: -i[1][0])
+            merged = dict(ranked[:self.capacity])
+        self.counters = merged
+        self.total += other.total
+        return self
+
+    def top(self, k=None):
+        '''
+        [item, count, error] of the k heaviest items
+        '''
+        ranked = sorted(self.counters.iteritems(),
+                        key=lambda i: (-i[1][0], i[0]))
+        return [[item, count, error] for item, (count, error)
+                in ranked[:k or self.capacity]]
+
+    def to_dict(self):
+        return {
+            'capacity': self.capacity,
+            'total': self.total,
+            'counters': self.top(),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        summary = cls(data['capacity'])
+        summary.total = data['total']
+        for item, count, error in data['counters']:
+            summary.counters[item] = [count, error]
+        return summary
+
+
+def heavy_hitter_keys(day):
+    '''
+    ['heavy-hitters', day, dimension, weight] keys for one day
+    '''
+    return [['heavy-hitters', day, dimension, weight]
+            for dimension, weight in HEAVY_HITTERS]
+
+
+def is_heavy_hitter_key(key):
+    return isinstance(key, list) and key and key[0] == 'heavy-hitters'
+
+
+class HeavyHitters(object):
+    """
+    All heavy hitter summaries of the session summaries seen by one task.
+    """
+
+    def __init__(self, top_k=TOP_K):
+        self.top_k = top_k
+        # tracking a few times more counters than reported keeps the
+        # reported counts tight
+        self.capacity = top_k * 4
+        # key -> SpaceSaving
+        self.summaries = {}
+
+    def add_summary(self, summary):
+        day = summary['earliest_time'][:10] if summary.get('earliest_time') \
+            else None
+        for key in heavy_hitter_keys(day):
+            item = summary.get(key[2])
+            weight = summary.get(key[3])
+            if item is None or not weight:
+                continue
+            key = tuple(key)
+            if key not in self.summaries:
+                self.summaries[key] = SpaceSaving(self.capacity)
+            self.summaries[key].offer(item, weight)
+
+    def partials(self):
+        '''
+        (key, partial) pairs to emit at the end of a task
+        '''
+        for key, summary in sorted(self.summaries.iteritems()):
+            yield list(key), summary.to_dict()
+
+
+def merge_heavy_hitters(partials):
+    merged = None
+    for partial in partials:
+        summary = SpaceSaving.from_dict(partial)
+        if merged is None:
+            merged = summary
+        else:
+            merged.merge(summary)
+    return merged
+
+
+def heavy_hitters_report(summary, top_k=TOP_K):
+    '''
+    Final output of a merged summary
+    '''
+    return {
+        'total': summary.total,
+        'max_error': summary.max_error,
+        'top': summary.top(top_k),
+    }
@@ -30,6 +30,13 @@ setup(
     entry_points={
         'console_scripts': [
             'agora=agora.jobs:main',
+            'agora-ingest=agora.ingest:main',
+            'agora-index=agora.index:main',
+            'agora-columnar=agora.columnar:main',
+            'agora-incremental=agora.incremental:main',
+            'agora-load=agora.load:main',
+            'agora-diff=agora.diff:main',
+            'agora-backfill=agora.backfill:main',
         ],
     },
 )
@@ -1,14 +1,28 @@
 """
 This script takes in a number of GoonHilly formatted log files
 and searches through them, aggregating which events/fields are
-supported for a specific source_tag
+supported for a specific source_tag, or with --all for every
+source_tag seen in a single pass
 
-NOTE: it is recommended that you first run zgrep
-on all of the log files for the source_tag
-you want and then pass that output into this script
-or else it will take a very long time
+Files (plain or gzipped) are scanned in a pool of processes (-j)
+and lines that can't match are dropped with a substring check
+before they are parsed, so there is no need to zgrep first.
+
+To look into a single stream, don't grep at all: build sidecar
+indexes once with `agora-index build` and pull the stream with
+`agora-index query --tracking-id`
+
+With --job-output the files are the directories given to
+`agora --coverage` and the matrix is read from the side files its tasks
+wrote, without scanning logs
 """
 import argparse
+import json
+import multiprocessing
+import sys
+
+from agora.coverage import SupportMatrix, read_coverage
+from agora.ingest import open_input
 from agora.logs import GoonHillyLog
 
 
@@ -54,89 +68,128 @@ def print_results(events, custom_fields, source_tag):
         print '%-40s:\t%s' % (key, result)
 
 
-def test_support(file_list, source_tag):
-    events = {
-        'MediaStarted': 0,
-        'MediaEnded': 0,
-        'MediaCompleted': 0,
-        'MediaFailed': 0,
-        'MediaQualityChange': 0,
-        'MediaQualityChangeAuto': 0,
-        'MediaQualityChangeProgramatically': 0,
-        'MediaInitialBufferStart': 0,
-        'MediaInitialBufferEnd': 0,
-        'MediaBufferingStart': 0,
-        'MediaBufferingEnd': 0,
-        'MediaScrub': 0
-    }
-
-    custom_fields = {
-        'x_useragent': 0,
-        'x_tpmid': 0,
-        'x_episode_title': 0,
-        'x_program_title': 0,
-        'x_producer': 0,
-        'x_video_length': 0,
-        'x_client_id': 0,
-        'x_session_id': 0,
-        'x_tracking_id': 0,
-        'x_video_location': 0,
-        'x_stream_size': 0,
-        'x_flash_player': 0,
-        'x_buffering_length': 0,
-        'x_encoding_name': 0,
-        'x_auto': 0,
-        'x_bandwidth': 0,
-        'x_after_seek': 0,
-        'x_start_time': 0,
-        'x_previous_quality': 0,
-        'x_new_quality': 0
-    }
-
-    # Iterate over passed in files
-    for filename in file_list:
-        try:
-            with open(filename, 'r') as f:
-                print 'processing file...'
-
-                # Read file line by line and aggregate all fields ecountered
-                for line in f:
-                    # Parse line into dict
-                    fields = GoonHillyLog.parse_log_line(line)
-
-                    # Skip line if event source tag is not what we are looking
-                    # for
-                    if fields.get('source_tag') != source_tag:
-                        continue
-
-                    # Iterate over all keys in the event
-                    for key in fields.iterkeys():
-                        # If the key is an event, increment counter for that
-                        # event
-                        if key == 'event_type' and fields.get(key) in events:
-                            events[fields.get(key)] += 1
-
-                        # If key is a custom field, increment counter for that
-                        # field
-                        elif key in custom_fields:
-                            custom_fields[key] += 1
-        except IOError:
-            # Catch error if passed in file does not exist
-            pass
-
-    print_results(events, custom_fields, source_tag)
+def scan_file(args):
+    """
+    Builds the support matrix for one file. Only lines mentioning the
+    source_tag (or any source_tag with source_tag=None) are parsed.
+    """
+    filename, source_tag = args
+    if source_tag is None:
+        prefilter = 'source_tag'
+    else:
+        prefilter = source_tag
+    matrix = SupportMatrix()
+    try:
+        f = open_input(filename, external=False)
+    except IOError:
+        # Catch error if passed in file does not exist
+        return matrix.to_dict()
+
+    # Read file line by line and aggregate all fields ecountered
+    for line in f:
+        # cheap raw-line check before the full parse
+        if prefilter not in line:
+            continue
+        # Parse line into dict
+        fields = GoonHillyLog.parse_log_line(line)
+        if not fields or not fields.get('source_tag'):
+            continue
+
+        # Skip line if event source tag is not what we are looking for
+        if source_tag is not None and fields['source_tag'] != source_tag:
+            continue
+        matrix.add_event(fields)
+    f.close()
+    return matrix.to_dict()
+
+
+def job_output_matrix(file_list):
+    """
+    Reads the side files of VideoStreamCondense --coverage directories
+    """
+    matrix = SupportMatrix()
+    for directory in file_list:
+        matrix.merge(read_coverage(directory))
+    return matrix
+
+
+def support_matrix(file_list, source_tag=None, processes=None,
+                   job_output=False):
+    """
+    Scans all files in a process pool and merges the per-file results
+    """
+    if job_output:
+        return job_output_matrix(file_list)
+    matrix = SupportMatrix()
+    tasks = [(filename, source_tag) for filename in file_list]
+    pool = None
+    if processes == 1 or len(tasks) < 2:
+        results = map(scan_file, tasks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(scan_file, tasks)
+    for result in results:
+        print >> sys.stderr, 'processing file...'
+        matrix.merge_dict(result)
+    if pool:
+        pool.close()
+        pool.join()
+    return matrix
+
+
+def test_support(file_list, source_tag, processes=None, job_output=False):
+    matrix = support_matrix(file_list, source_tag, processes, job_output)
+    counts = matrix.to_dict().get(source_tag) or \
+        SupportMatrix().source(source_tag)
+    print_results(counts['events'], counts['custom_fields'], source_tag)
+
+
+def test_support_all(file_list, processes=None, json_file=None,
+                     job_output=False):
+    matrix = support_matrix(file_list, None, processes, job_output)
+    if json_file:
+        out = sys.stdout if json_file == '-' else open(json_file, 'w')
+        json.dump(matrix.to_dict(), out, indent=2, sort_keys=True)
+        out.write('\n')
+        if out is not sys.stdout:
+            out.close()
+        return
+    for source_tag in sorted(matrix.sources):
+        counts = matrix.sources[source_tag]
+        print_results(counts['events'], counts['custom_fields'], source_tag)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('-s',
-                        required=True,
-                        help='source tag to look for')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('-s',
+                       help='source tag to look for')
+    group.add_argument('--all',
+                       action='store_true',
+                       help='report every source tag seen')
 
     parser.add_argument('-f',
                         nargs='*',
                         required=True,
                         help='files to search through')
 
+    parser.add_argument('-j',
+                        type=int,
+                        default=None,
+                        help='number of processes (default: one per cpu)')
+
+    parser.add_argument('--json',
+                        help='with --all, write the matrix as json to this '
+                             'file (- for stdout)')
+
+    parser.add_argument('--job-output',
+                        action='store_true',
+                        help='files are --coverage directories of agora '
+                             'runs, read the matrix from them instead of '
+                             'scanning logs')
+
     args = parser.parse_args()
-    test_support(args.f, args.s)
+    if args.all:
+        test_support_all(args.f, args.j, args.json, args.job_output)
+    else:
+        test_support(args.f, args.s, args.j, args.job_output)
@@ -0,0 +1,194 @@
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from os import path
+
+from agora.backfill import (JOURNAL_FILE, Backfill, BackfillError, Journal,
+                            merge_spills)
+from agora.index import summarize
+from agora.jobs import VideoStreamCondense
+from agora.logs import GoonHillyLog
+from mrjob.protocol import JSONProtocol
+
+HERE = path.abspath(path.dirname(__file__))
+ROOT = path.dirname(HERE)
+
+
+class BackfillTestcase(unittest.TestCase):
+
+    """
+    Test agora.backfill resumable local runs
+    """
+    @classmethod
+    def setup_class(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        with open(path.join(HERE, './fixtures/fluentd-log-sample')) as f:
+            lines = f.readlines()
+        # streams span several inputs and chunks
+        cls.inputs = []
+        for number in range(4):
+            name = path.join(cls.tmp_dir, 'fluentd-%d.log' % number)
+            with open(name, 'w') as f:
+                f.writelines(lines[number::4])
+            cls.inputs.append(name)
+        events = [GoonHillyLog.parse_log_line_json(line) for line in lines]
+        cls.keys = sorted(json.dumps(key) for key, _ in summarize(events))
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def run_backfill(self, name, chunk_lines=7, **kwargs):
+        output = path.join(self.tmp_dir, name)
+        backfill = Backfill(output + '.work', chunk_lines=chunk_lines)
+        backfill.run(self.inputs, output, **kwargs)
+        with open(output) as f:
+            return backfill, f.read()
+
+    def test_summaries(self):
+        backfill, output = self.run_backfill('summaries.out')
+        protocol = JSONProtocol()
+        keys = [json.dumps(protocol.read(line)[0])
+                for line in output.splitlines()]
+        self.assertEqual(sorted(keys), self.keys)
+        self.assertEqual(backfill.stats['resumed_chunks'], 0)
+        self.assertEqual(backfill.journal.counters()['total-events'], 400)
+        self.assertFalse(path.exists(
+            path.join(self.tmp_dir, 'summaries.out.tmp')))
+
+    def test_merge_passes(self):
+        self.run_backfill('merge.out')
+        work_dir = path.join(self.tmp_dir, 'merge.out.work')
+        spills = Journal(work_dir).load().spills()
+        self.assertTrue(len(spills) > 9)
+        self.assertEqual(list(merge_spills(spills, work_dir, 3)),
+                         list(merge_spills(spills, work_dir)))
+
+    def test_resume_journal(self):
+        _, expected = self.run_backfill('journal.out')
+        work_dir = path.join(self.tmp_dir, 'journal.out.work')
+        journal = Journal(work_dir).load()
+        chunks = len(journal.chunks)
+        # lose a spill, and tear the last record
+        os.remove(path.join(work_dir, journal.chunks[(1, 2)]['spill']))
+        with open(path.join(work_dir, JOURNAL_FILE), 'a') as f:
+            f.write('{"input": 3, "chu')
+        backfill, output = self.run_backfill('journal.out', resume=True)
+        self.assertEqual(backfill.stats['resumed_chunks'], chunks - 1)
+        self.assertEqual(output, expected)
+        with self.assertRaises(BackfillError):
+            self.run_backfill('journal.out', chunk_lines=8, resume=True)
+
+        # without --resume the journal starts over
+        backfill, output = self.run_backfill('journal.out')
+        self.assertEqual(backfill.stats['resumed_chunks'], 0)
+        self.assertEqual(output, expected)
+
+    def test_mixed_formats(self):
+        """
+        A file that changes format is parsed like the job parses it, also
+        when it is resumed
+        """
+        with open(path.join(HERE, './fixtures/fluentd-log-sample')) as f:
+            json_lines = f.readlines()
+        with open(path.join(HERE, './fixtures/goonhilly-log-sample')) as f:
+            goonhilly_lines = f.readlines()[:100]
+        mixed = path.join(self.tmp_dir, 'mixed-formats.log')
+        with open(mixed, 'w') as f:
+            f.writelines(json_lines[:50] + goonhilly_lines + json_lines[50:])
+        mr_job = VideoStreamCondense(['--mapper', '--step-num=0'])
+        with open(mixed) as f:
+            mr_job.sandbox(stdin=f)
+            mr_job.execute()
+        expected = sorted(mr_job.stdout.getvalue().splitlines(True))
+
+        output = path.join(self.tmp_dir, 'mixed-formats.out')
+        work_dir = output + '.work'
+        backfill = Backfill(work_dir, chunk_lines=30)
+        backfill.run([mixed], output)
+        spills = backfill.journal.spills()
+        self.assertEqual(sorted(merge_spills(spills, work_dir)), expected)
+        with open(output) as f:
+            summaries = f.read()
+        formats = [record['format'] for _, record in
+                   sorted(backfill.journal.chunks.iteritems())]
+        self.assertEqual(formats[1:5], ['goonhilly'] * 4)
+        self.assertEqual(formats[-1], 'json')
+
+        # resumed after the switch, the parser goes on in the journal format
+        journal_path = path.join(work_dir, JOURNAL_FILE)
+        with open(journal_path) as f:
+            records = f.readlines()
+        with open(journal_path, 'w') as f:
+            f.writelines(records[:4])
+        backfill = Backfill(work_dir, chunk_lines=30)
+        backfill.run([mixed], output, resume=True)
+        self.assertEqual(backfill.stats['resumed_chunks'], 3)
+        with open(output) as f:
+            self.assertEqual(f.read(), summaries)
+        self.assertEqual(formats, [
+            record['format'] for _, record in
+            sorted(backfill.journal.chunks.iteritems())])
+
+    def test_work_dir(self):
+        work_dir = path.join(self.tmp_dir, 'foreign.work')
+        os.makedirs(work_dir)
+        notes = path.join(work_dir, 'notes.txt')
+        with open(notes, 'w') as f:
+            f.write('not ours')
+        backfill = Backfill(work_dir, chunk_lines=7)
+        output = path.join(self.tmp_dir, 'foreign.out')
+        with self.assertRaises(BackfillError):
+            backfill.run(self.inputs, output)
+        self.assertTrue(path.exists(notes))
+
+        # with a journal, only the files of the run are removed
+        _, expected = self.run_backfill('mixed.out')
+        work_dir = path.join(self.tmp_dir, 'mixed.out.work')
+        notes = path.join(work_dir, 'notes.txt')
+        with open(notes, 'w') as f:
+            f.write('not ours')
+        backfill, output = self.run_backfill('mixed.out')
+        self.assertEqual(output, expected)
+        backfill.clean()
+        self.assertEqual(os.listdir(work_dir), ['notes.txt'])
+        os.remove(notes)
+        backfill.clean()
+        self.assertFalse(path.exists(work_dir))
+
+    def test_kill_and_resume(self):
+        _, expected = self.run_backfill('uninterrupted.out')
+        output = path.join(self.tmp_dir, 'killed.out')
+        journal_path = path.join(output + '.work', JOURNAL_FILE)
+        command = [sys.executable, '-m', 'agora.backfill', '-o', output,
+                   '--chunk-lines', '1'] + self.inputs
+        env = dict(os.environ, PYTHONPATH=ROOT)
+        proc = subprocess.Popen(command, env=env, stderr=subprocess.PIPE)
+        # kill it once some chunks are journaled
+        deadline = time.time() + 30
+        while time.time() < deadline and proc.poll() is None:
+            if path.exists(journal_path) and \
+                    len(open(journal_path).readlines()) > 20:
+                break
+            time.sleep(0.01)
+        if proc.poll() is not None:
+            raise unittest.SkipTest('finished before it could be killed')
+        os.kill(proc.pid, signal.SIGKILL)
+        proc.wait()
+        self.assertFalse(path.exists(output))
+
+        proc = subprocess.Popen(command + ['--resume'], env=env,
+                                stderr=subprocess.PIPE)
+        _, err = proc.communicate()
+        self.assertEqual(proc.returncode, 0, err)
+        resumed = int(err.split('(')[1].split()[0])
+        self.assertTrue(resumed >= 20)
+        with open(output) as f:
+            self.assertEqual(f.read(), expected)
+        self.assertFalse(path.exists(output + '.work'))
@@ -0,0 +1,122 @@
+import glob
+import shutil
+import tempfile
+import unittest
+from os import path
+
+from agora import columnar
+from agora.index import summarize
+from agora.logs import GoonHillyLog
+from agora.stats import PBSVideoStats
+from mrjob.protocol import JSONProtocol
+
+HERE = path.abspath(path.dirname(__file__))
+
+
+class ColumnarWriterTestcase(unittest.TestCase):
+
+    """
+    Test agora.columnar partitioned typed TSV output
+    """
+    @classmethod
+    def setup_class(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        with open(path.join(HERE, './fixtures/fluentd-log-sample')) as f:
+            events = [GoonHillyLog.parse_log_line_json(line) for line in f]
+        cls.summaries = [summary for _, summary in summarize(events)]
+        # a field that needs escaping
+        cls.summaries[0]['title'] = u'tab\tnew\nline back\\slash caf\xe9'
+
+        # small batches so partitions are written more than once
+        writer = columnar.ColumnarWriter(cls.tmp_dir, 'tsv', batch_size=7)
+        for summary in cls.summaries:
+            writer.write(summary)
+        cls.paths = writer.close()
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def read_all(self):
+        rows = []
+        for filename in glob.glob(path.join(self.tmp_dir, '*/*/*.tsv')):
+            rows.extend(columnar.read_tsv(filename))
+        return rows
+
+    def test_partitions(self):
+        self.assertEqual(sorted(self.paths), sorted(
+            glob.glob(path.join(self.tmp_dir, '*/*/*.tsv'))))
+        for filename in self.paths:
+            partition = path.dirname(path.relpath(filename, self.tmp_dir))
+            for row in columnar.read_tsv(filename):
+                day, source = columnar.partition_of(
+                    {'earliest_time': str(row['earliest_time'] or '') or None,
+                     'source': row['source']})
+                self.assertEqual(partition, path.relpath(
+                    columnar.partition_path('', (day, source))))
+
+    def test_roundtrip(self):
+        rows = dict((row['tracking_id'], row) for row in self.read_all())
+        self.assertEqual(len(rows), len(self.summaries))
+        for summary in self.summaries:
+            row = rows[summary['tracking_id']]
+            self.assertEqual(row['title'], summary['title'])
+            self.assertEqual(row['playing_duration'],
+                             summary['playing_duration'])
+            self.assertEqual(row['finished_playback'],
+                             summary['finished_playback'])
+            self.assertEqual(str(row['earliest_time']),
+                             summary['earliest_time'])
+            self.assertEqual(row['buffering_time_bins'],
+                             summary['buffering_time_bins'])
+
+    def test_header(self):
+        with open(self.paths[0]) as f:
+            header = f.readline().rstrip('\n').split('\t')
+        self.assertEqual(header, ['%s:%s' % field for field in
+                                  PBSVideoStats.SUMMARY_FIELDS])
+
+    def test_coerce(self):
+        self.assertEqual(columnar.coerce('4227', 'int'), 4227)
+        self.assertEqual(columnar.coerce('12.5', 'int'), 12)
+        self.assertEqual(columnar.coerce('abc', 'float'), None)
+        self.assertEqual(columnar.coerce('', 'string'), None)
+        self.assertEqual(columnar.coerce('False', 'bool'), False)
+        self.assertEqual(columnar.coerce('{0,2}', 'ints'), [0, 2])
+        self.assertEqual(columnar.coerce('{}', 'ints'), [])
+
+    def test_read_summaries(self):
+        protocol = JSONProtocol()
+        lines = [protocol.write('key', self.summaries[0]),
+                 protocol.write(['source', 'day'], {'sessions': 3})]
+        self.assertEqual(list(columnar.read_summaries(lines)),
+                         [self.summaries[0]])
+
+    def test_main_appends(self):
+        out_dir = path.join(self.tmp_dir, 'main')
+        sample = path.join(self.tmp_dir, 'output')
+        protocol = JSONProtocol()
+        with open(sample, 'w') as f:
+            for summary in self.summaries:
+                f.write(protocol.write(summary['tracking_id'], summary) + '\n')
+        columnar.main(['-o', out_dir, '--format', 'tsv', sample])
+        columnar.main(['-o', out_dir, '--format', 'tsv', sample])
+        files = glob.glob(path.join(out_dir, '*/*/*.tsv'))
+        self.assertTrue([f for f in files if f.endswith('part-00001.tsv')])
+        rows = sum(len(list(columnar.read_tsv(f))) for f in files)
+        self.assertEqual(rows, 2 * len(self.summaries))
+
+    @unittest.skipIf(columnar.pyarrow is None, 'pyarrow is not installed')
+    def test_parquet(self):
+        import pyarrow.parquet
+        out_dir = path.join(self.tmp_dir, 'parquet')
+        with columnar.ColumnarWriter(out_dir, 'parquet') as writer:
+            for summary in self.summaries:
+                writer.write(summary)
+        rows = 0
+        for filename in writer.paths:
+            table = pyarrow.parquet.read_table(filename)
+            self.assertEqual(table.schema.names, [
+                name for name, _ in PBSVideoStats.SUMMARY_FIELDS])
+            rows += table.num_rows
+        self.assertEqual(rows, len(self.summaries))
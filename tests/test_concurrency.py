@@ -0,0 +1,74 @@
+import random
+import unittest
+from datetime import datetime, timedelta
+
+from agora.concurrency import format_minute, session_boundaries, \
+    sum_deltas, sweep, to_minute
+
+
+class ConcurrencyTestcase(unittest.TestCase):
+
+    """
+    Test agora.concurrency against expanding sessions into minutes
+    """
+    @classmethod
+    def setup_class(cls):
+        rand = random.Random(11)
+        start = datetime(2014, 9, 2)
+        cls.sessions = []
+        for _ in xrange(300):
+            intervals = []
+            offset = rand.randint(0, 6 * 3600)
+            for _ in xrange(rand.randint(1, 3)):
+                length = rand.randint(1, 1800)
+                begin = start + timedelta(seconds=offset)
+                intervals.append((begin, begin + timedelta(seconds=length)))
+                # pause before resuming
+                offset += length + rand.randint(0, 300)
+            cls.sessions.append(intervals)
+
+    def brute_force(self):
+        counts = {}
+        for intervals in self.sessions:
+            minutes = set()
+            for start, end in intervals:
+                minutes.update(xrange(to_minute(start), to_minute(end) + 1))
+            for minute in minutes:
+                counts[minute] = counts.get(minute, 0) + 1
+        return counts
+
+    def test_sweep(self):
+        boundaries = []
+        for intervals in self.sessions:
+            boundaries.extend(session_boundaries(intervals))
+        results = dict(sweep(sum_deltas(boundaries)))
+        expected = self.brute_force()
+        for minute, count in results.iteritems():
+            self.assertEqual(count, expected.get(minute, 0))
+        self.assertEqual(min(results), min(expected))
+        self.assertEqual(max(results), max(expected))
+
+    def test_partial_sums(self):
+        """
+        Summing boundaries in several combiners gives the same result
+        """
+        parts = [[], [], []]
+        for count, intervals in enumerate(self.sessions):
+            parts[count % 3].extend(session_boundaries(intervals))
+        combined = []
+        for part in parts:
+            combined.extend(sum_deltas(part).items())
+        self.assertEqual(list(sweep(sum_deltas(combined))),
+                         sorted(self.brute_force().items()))
+
+    def test_same_minute(self):
+        """
+        Pausing and resuming within a minute counts the session once
+        """
+        start = datetime(2014, 9, 2, 17, 20, 5)
+        intervals = [(start, start + timedelta(seconds=10)),
+                     (start + timedelta(seconds=30),
+                      start + timedelta(seconds=90))]
+        results = list(sweep(sum_deltas(session_boundaries(intervals))))
+        self.assertEqual([(format_minute(m), c) for m, c in results],
+                         [('2014-09-02 17:20', 1), ('2014-09-02 17:21', 1)])
@@ -0,0 +1,83 @@
+import shutil
+import tempfile
+import unittest
+from os import path
+
+from agora.coverage import SupportMatrix, read_coverage, write_coverage
+from agora.logs import GoonHillyLog
+
+HERE = path.abspath(path.dirname(__file__))
+
+
+class SupportMatrixTestcase(unittest.TestCase):
+
+    """
+    Test agora.coverage.SupportMatrix
+    """
+    @classmethod
+    def setup_class(cls):
+        cls.events = []
+        input_filename = path.join(HERE, './fixtures/fluentd-log-sample')
+        with open(input_filename, 'r') as f:
+            for line in f:
+                cls.events.append(GoonHillyLog.parse_log_line_json(line))
+
+    def test_counts(self):
+        """
+        Known events and custom fields are counted per source_tag
+        """
+        matrix = SupportMatrix()
+        for event in self.events:
+            matrix.add_event(event)
+        counts = matrix.sources['cove-jwplayer']
+        events = [e for e in self.events
+                  if e.get('source_tag') == 'cove-jwplayer']
+        started = len([e for e in events
+                       if e['event_type'] == 'MediaStarted'])
+        self.assertEqual(counts['events']['MediaStarted'], started)
+        self.assertEqual(counts['custom_fields']['x_tpmid'], len(events))
+        self.assertEqual(counts['events']['MediaFailed'], 0)
+        self.assertTrue(matrix.source('cove-jwplayer') is counts)
+        unseen = matrix.source('unseen')
+        self.assertEqual(sum(unseen['events'].values()), 0)
+        self.assertEqual(sorted(unseen['custom_fields']),
+                         sorted(counts['custom_fields']))
+
+    def test_merge(self):
+        """
+        Merging partial matrices gives the same result as one pass
+        """
+        whole = SupportMatrix()
+        first = SupportMatrix()
+        second = SupportMatrix()
+        for count, event in enumerate(self.events):
+            whole.add_event(event)
+            if count % 3:
+                first.add_event(event)
+            else:
+                second.add_event(event)
+        merged = SupportMatrix().merge_dict(first.to_dict())
+        merged.merge_dict(second.to_dict())
+        self.assertEqual(merged.to_dict(), whole.to_dict())
+
+    def test_side_files(self):
+        """
+        Per task side files merge back into the full matrix
+        """
+        full = SupportMatrix()
+        halves = [SupportMatrix(), SupportMatrix()]
+        # an event without a source_tag counts under None
+        events = self.events + [{'event_type': 'MediaScrub'}]
+        for i, event in enumerate(events):
+            full.add_event(event)
+            halves[i % 2].add_event(event)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            for i, half in enumerate(halves):
+                write_coverage(half,
+                               path.join(tmp_dir, 'coverage-%d.json' % i))
+            merged = read_coverage(tmp_dir)
+        finally:
+            shutil.rmtree(tmp_dir)
+        self.assertEqual(merged.to_dict(), full.to_dict())
+        self.assertEqual(merged.sources[None]['events']['MediaScrub'], 1)
@@ -0,0 +1,118 @@
+import random
+import shutil
+import tempfile
+import unittest
+from os import listdir, path
+
+from agora.diff import (Diff, UnsortedInputError, check_sorted, external_sort,
+                        line_key, main, values_equal)
+from agora.index import summarize
+from agora.logs import GoonHillyLog
+from mrjob.protocol import JSONProtocol
+
+HERE = path.abspath(path.dirname(__file__))
+
+
+class DiffTestcase(unittest.TestCase):
+
+    """
+    Test agora.diff external sort and merge join of job outputs
+    """
+    @classmethod
+    def setup_class(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        with open(path.join(HERE, './fixtures/fluentd-log-sample')) as f:
+            events = [GoonHillyLog.parse_log_line_json(line) for line in f]
+        protocol = JSONProtocol()
+        cls.lines = [protocol.write(key, summary) + '\n'
+                     for key, summary in summarize(events)]
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def write(self, name, lines):
+        name = path.join(self.tmp_dir, name)
+        with open(name, 'w') as f:
+            f.writelines(lines)
+        return name
+
+    def test_external_sort(self):
+        lines = list(self.lines)
+        random.Random(3).shuffle(lines)
+        expected = sorted(lines, key=line_key)
+        # small buffers spill many runs
+        self.assertEqual(list(external_sort(iter(lines), self.tmp_dir, 2000)),
+                         expected)
+        self.assertEqual(list(external_sort(iter(lines))), expected)
+
+    def test_check_sorted(self):
+        lines = sorted(self.lines, key=line_key)
+        self.assertEqual(list(check_sorted(lines)), lines)
+        with self.assertRaises(UnsortedInputError):
+            list(check_sorted(reversed(lines)))
+
+    def test_values_equal(self):
+        self.assertTrue(values_equal(1.0, 1.05, 0.1))
+        self.assertFalse(values_equal(1.0, 1.05))
+        self.assertTrue(values_equal(100, 101, rel_tolerance=0.01))
+        self.assertTrue(values_equal([1, {'a': 2.0}], [1, {'a': 2.01}], 0.1))
+        self.assertFalse(values_equal([1, 2], [1, 2, 3], 0.1))
+        self.assertFalse(values_equal(True, 1))
+
+    def test_diff(self):
+        protocol = JSONProtocol()
+        changed = 0
+        left = []
+        right = []
+        for number, line in enumerate(sorted(self.lines, key=line_key)):
+            key, summary = protocol.read(line.rstrip('\n'))
+            left.append(protocol.write(key, summary) + '\n')
+            if number == 0:
+                # only on the left
+                continue
+            if summary['buffering_length'] is not None:
+                summary['buffering_length'] += 5
+                changed += 1
+            right.append(protocol.write(key, summary) + '\n')
+        right.append(protocol.write(['~extra'], {}) + '\n')
+
+        diff = Diff(samples=2).run(iter(left), iter(right))
+        report = diff.report()
+        self.assertTrue(diff.differs())
+        self.assertEqual(report['left'], len(left))
+        self.assertEqual(report['right'], len(right))
+        self.assertEqual(report['only_left'], 1)
+        self.assertEqual(report['only_right'], 1)
+        self.assertTrue(changed > 2)
+        self.assertEqual(report['different'], changed)
+        self.assertEqual(report['identical'], len(left) - 1 - changed)
+        field = report['fields']['buffering_length']
+        self.assertEqual(field['mismatches'], changed)
+        self.assertEqual(len(field['samples']), 2)
+        self.assertEqual(list(report['fields']), ['buffering_length'])
+
+        diff = Diff(tolerance=5).run(iter(left), iter(right))
+        self.assertEqual(diff.report()['equal_within_tolerance'], changed)
+        self.assertEqual(diff.report()['fields'], {})
+        diff = Diff(ignore=['buffering_length']).run(
+            iter(left), iter(right))
+        self.assertEqual(diff.report()['different'], 0)
+
+    def test_main(self):
+        shuffled = list(self.lines)
+        random.Random(5).shuffle(shuffled)
+        middle = len(shuffled) // 2
+        left = [self.write('left-0', shuffled[:middle]),
+                self.write('left-1', shuffled[middle:])]
+        right = self.write('right', self.lines)
+        with self.assertRaises(SystemExit) as exit:
+            main(['-S', '1000', '-T', self.tmp_dir, '--json'] + left +
+                 ['--', right])
+        self.assertEqual(exit.exception.code, 0)
+        with self.assertRaises(SystemExit) as exit:
+            main(['--sorted', right, left[0]])
+        self.assertEqual(exit.exception.code, 2)
+        # the sorted runs are removed
+        self.assertEqual(sorted(listdir(self.tmp_dir)),
+                         ['left-0', 'left-1', 'right'])
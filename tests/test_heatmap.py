@@ -0,0 +1,40 @@
+import unittest
+
+from agora.heatmap import BIN_SECONDS, PERCENT_BINS, TIME_BINS, \
+    PositionHistogram, session_heatmaps
+
+
+class HeatmapTestcase(unittest.TestCase):
+
+    """
+    Test agora.heatmap position histograms
+    """
+    def test_time_bins(self):
+        by_time, by_percent = session_heatmaps(['0', '29', '30', '95.5'])
+        self.assertEqual(by_time, [2, 1, 0, 1])
+        self.assertEqual(by_percent, None)
+
+    def test_percent_bins(self):
+        by_time, by_percent = session_heatmaps(
+            ['0', '50', '99', '100', '250', 'garbage', '-3'], '100')
+        expected = [0] * PERCENT_BINS
+        expected[0] = 1
+        expected[10] = 1
+        # the end of the video, and past it, count in the last bin
+        expected[-1] = 3
+        self.assertEqual(by_percent, expected)
+        self.assertEqual(sum(by_time), 5)
+
+    def test_bounded(self):
+        """
+        Positions far into a video shouldn't grow the histogram
+        """
+        by_time, _ = session_heatmaps([str(BIN_SECONDS * TIME_BINS * 10)])
+        self.assertEqual(len(by_time), TIME_BINS)
+        self.assertEqual(by_time[-1], 1)
+
+    def test_merge(self):
+        histogram = PositionHistogram(4, [1, 0, 2])
+        histogram.merge([0, 1, 0, 0, 5])
+        self.assertEqual(histogram.to_list(), [1, 1, 2, 5])
+        self.assertEqual(PositionHistogram(4).to_list(), [])
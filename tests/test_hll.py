@@ -0,0 +1,98 @@
+import random
+import unittest
+import uuid
+
+from agora.hll import HyperLogLog, precision_for_error
+
+
+class HyperLogLogTestcase(unittest.TestCase):
+
+    """
+    Test agora.hll.HyperLogLog against exact counts on generated ids
+    """
+    @classmethod
+    def setup_class(cls):
+        rand = random.Random(42)
+        cls.ids = [str(uuid.UUID(int=rand.getrandbits(128)))
+                   for _ in xrange(50000)]
+
+    def assert_close(self, sketch, exact):
+        # well within 4 standard errors
+        allowed = 4 * sketch.error_rate * exact
+        self.assertTrue(abs(sketch.count() - exact) <= allowed,
+                        '%d is not within %d of %d' % (
+                            sketch.count(), allowed, exact))
+
+    def test_precision_for_error(self):
+        self.assertEqual(precision_for_error(0.01), 14)
+        self.assertEqual(precision_for_error(0.05), 9)
+        self.assertRaises(ValueError, precision_for_error, 0)
+
+    def test_count(self):
+        """
+        Estimates stay within the error bound, duplicates don't count
+        """
+        for error_rate in (0.01, 0.02, 0.05):
+            sketch = HyperLogLog(error_rate)
+            for value in self.ids:
+                sketch.add(value)
+                sketch.add(value)
+            self.assert_close(sketch, len(self.ids))
+
+    def test_small_counts(self):
+        """
+        Small sets are counted (almost) exactly by linear counting
+        """
+        sketch = HyperLogLog()
+        for value in self.ids[:100]:
+            sketch.add(value)
+        self.assertTrue(abs(sketch.count() - 100) <= 1)
+        self.assertEqual(HyperLogLog().count(), 0)
+
+    def test_merge(self):
+        """
+        Merging sketches of overlapping sets estimates the union
+        """
+        first = HyperLogLog(0.02)
+        second = HyperLogLog(0.02)
+        whole = HyperLogLog(0.02)
+        for value in self.ids[:30000]:
+            first.add(value)
+        for value in self.ids[20000:]:
+            second.add(value)
+        for value in self.ids:
+            whole.add(value)
+        first.merge(second)
+        self.assertEqual(first.registers, whole.registers)
+        self.assert_close(first, len(self.ids))
+        self.assertRaises(ValueError, first.merge, HyperLogLog(0.05))
+
+    def test_serialization(self):
+        """
+        Sparse and dense sketches round trip through to_string
+        """
+        for size in (10, 10000):
+            sketch = HyperLogLog()
+            for value in self.ids[:size]:
+                sketch.add(value)
+            copy = HyperLogLog.from_string(sketch.to_string())
+            self.assertEqual(copy.count(), sketch.count())
+            self.assertEqual(copy.to_string(), sketch.to_string())
+        sparse = HyperLogLog()
+        sparse.add('one')
+        self.assertTrue(len(sparse.to_string()) < 16)
+
+    def test_sparse_matches_dense(self):
+        """
+        Sparse sketches convert to the same registers as dense ones
+        """
+        sparse = HyperLogLog()
+        for value in self.ids[:50]:
+            sparse.add(value)
+        dense = HyperLogLog()
+        dense._densify()
+        for value in self.ids[:50]:
+            dense.add(value)
+        self.assertEqual(sparse.count(), dense.count())
+        sparse._densify()
+        self.assertEqual(sparse.registers, dense.registers)
@@ -0,0 +1,85 @@
+import unittest
+
+from agora import logs
+from agora.ids import pack_id, unpack_id
+from agora.memory import deep_sizeof
+
+
+class IdsTestcase(unittest.TestCase):
+
+    """
+    Test agora.ids packing of UUID and other ids
+    """
+
+    def test_uuid(self):
+        value = '7c575311-c94b-fa72-6419-61862e36c687'
+        packed = pack_id(value)
+        self.assertEqual(len(packed), 17)
+        self.assertEqual(unpack_id(packed), value)
+
+    def test_other_ids(self):
+        for value in ('7C575311-C94B-FA72-6419-61862E36C687',
+                      'abc123-some-tpmid', u'caf\xe9', ''):
+            packed = pack_id(value)
+            self.assertEqual(unpack_id(packed), value)
+            self.assertNotEqual(packed, pack_id(value.lower() + 'x'))
+
+    def test_round_trip_type(self):
+        """
+        Both kinds of ids unpack to unicode, equal to the original
+        """
+        values = ['7c575311-c94b-fa72-6419-61862e36c687',
+                  u'00000000-0000-0000-0000-000000000001',
+                  'abc123-some-tpmid', u'caf\xe9']
+        unpacked = [unpack_id(pack_id(value)) for value in values]
+        self.assertEqual(unpacked, values)
+        self.assertEqual(set(type(value) for value in unpacked),
+                         set([unicode]))
+        self.assertEqual(sorted(unpacked), sorted(
+            value.decode('utf-8') if isinstance(value, str) else value
+            for value in values))
+
+    def test_order(self):
+        values = ['7c575311-c94b-fa72-6419-61862e36c687',
+                  '00000000-0000-0000-0000-000000000001',
+                  'ffffffff-0000-0000-0000-000000000000']
+        self.assertEqual([unpack_id(p) for p in
+                          sorted(pack_id(v) for v in values)], sorted(values))
+
+
+class InterningTestcase(unittest.TestCase):
+
+    """
+    Test that parsed events share the strings of repeated values
+    """
+
+    def setUp(self):
+        logs.clear_interned()
+
+    def tearDown(self):
+        logs.INTERNING = True
+
+    def parse(self):
+        line = ('{"time": "2014-09-02T17:00:00Z",'
+                ' "event_type": "MediaStarted",'
+                ' "x_episode_title": "Episode", "x_tracking_id": "%s"}')
+        return [logs.GoonHillyLog.parse_log_line_json(line % i)
+                for i in range(2)]
+
+    def test_shared_values(self):
+        first, second = self.parse()
+        self.assertEqual(first['x_episode_title'], 'Episode')
+        self.assertTrue(first['event_type'] is second['event_type'])
+        self.assertTrue(first['x_episode_title'] is second['x_episode_title'])
+        # unique ids aren't interned
+        self.assertFalse(first['x_tracking_id'] is second['x_tracking_id'])
+
+    def test_disabled(self):
+        logs.INTERNING = False
+        first, second = self.parse()
+        self.assertFalse(first['event_type'] is second['event_type'])
+
+    def test_deep_sizeof(self):
+        first, second = self.parse()
+        self.assertTrue(deep_sizeof([first, second]) <
+                        deep_sizeof(first) + deep_sizeof(second))
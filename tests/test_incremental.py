@@ -0,0 +1,155 @@
+import os
+import shutil
+import tempfile
+import unittest
+from os import path
+
+from agora.incremental import SessionStore, read_events, refresh, slice_key
+from agora.index import summarize
+from agora.logs import GoonHillyLog
+from agora.stats import PBSVideoStats
+
+HERE = path.abspath(path.dirname(__file__))
+
+
+class IncrementalTestcase(unittest.TestCase):
+
+    """
+    Test agora.incremental hourly refreshes of session summaries
+    """
+    @classmethod
+    def setup_class(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        with open(path.join(HERE, './fixtures/fluentd-log-sample')) as f:
+            lines = f.readlines()
+        # two "hourly" slices of the sample
+        middle = len(lines) // 2
+        cls.slices = []
+        for number, part in enumerate([lines[:middle], lines[middle:]]):
+            slice_path = path.join(cls.tmp_dir, '%02d.log' % number)
+            with open(slice_path, 'w') as f:
+                f.writelines(part)
+            cls.slices.append(slice_path)
+        cls.events = [GoonHillyLog.parse_log_line_json(line)
+                      for line in lines]
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def test_state_round_trip(self):
+        """
+        Adding events to restored state should equal adding them all at once
+        """
+        key = GoonHillyLog.tracking_key(self.events[0])
+        stream = [e for e in self.events
+                  if GoonHillyLog.tracking_key(e) == key]
+        whole = PBSVideoStats()
+        for event in stream:
+            whole.add_event(event)
+        part = PBSVideoStats()
+        for event in stream[:len(stream) // 2]:
+            part.add_event(event)
+        part = PBSVideoStats.from_state(part.to_state())
+        for event in stream[len(stream) // 2:]:
+            part.add_event(event)
+        self.assertEqual(part.summary(), whole.summary())
+
+    def test_refresh_matches_whole_day(self):
+        """
+        Summaries refreshed slice by slice should match a run over the day,
+        and a refresh should only emit the streams its slice touched
+        """
+        store = SessionStore(path.join(self.tmp_dir, 'state'))
+        try:
+            refreshed = [refresh(store, read_events(p)) for p in self.slices]
+            touched = set(GoonHillyLog.tracking_key(e) for e in read_events(
+                self.slices[1]) if e and GoonHillyLog.tracking_key(e))
+            self.assertEqual(set(k for k, _ in refreshed[1]), touched)
+            self.assertEqual(list(store.summaries()),
+                             list(summarize(self.events)))
+        finally:
+            store.close()
+
+    def test_slice_commit(self):
+        """
+        A slice's streams should only be stored together with its record
+        """
+        state_dir = path.join(self.tmp_dir, 'commit-state')
+        store = SessionStore(state_dir)
+        refresh(store, read_events(self.slices[0]))
+        streams = len(store)
+        # a crash before the commit leaves nothing behind
+        store.close()
+        store = SessionStore(state_dir)
+        self.assertEqual(len(store), 0)
+        self.assertFalse(store.has_slice(slice_key(self.slices[0])))
+
+        first = slice_key(self.slices[0])
+        refresh(store, read_events(self.slices[0]))
+        store.mark_slice(first)
+        store.close()
+        store = SessionStore(state_dir)
+        self.assertEqual(len(store), streams)
+        self.assertTrue(store.has_slice(first))
+
+        # a commit that fails half way leaves nothing behind
+        second = slice_key(self.slices[1])
+        refresh(store, read_events(self.slices[1]))
+        store.staged[max(store.staged)] = object()
+        self.assertRaises(Exception, store.mark_slice, second)
+        store.close()
+        store = SessionStore(state_dir)
+        self.assertEqual(len(store), streams)
+        self.assertFalse(store.has_slice(second))
+
+        refresh(store, read_events(self.slices[1]))
+        store.mark_slice(second)
+        store.compact()
+        try:
+            self.assertEqual(list(store.summaries()),
+                             list(summarize(self.events)))
+            self.assertEqual(len(store), len(list(summarize(self.events))))
+        finally:
+            store.close()
+
+    def test_dump_lookups(self):
+        """
+        Summaries of the store should use the lookups they are given
+        """
+        class Lookup(object):
+            def org_by_addr(self, ip):
+                return 'Test ISP'
+
+            def record_by_addr(self, ip):
+                return {'city': 'Testville'}
+
+        store = SessionStore(path.join(self.tmp_dir, 'lookup-state'))
+        try:
+            refresh(store, read_events(self.slices[0]))
+            summaries = [s for _, s in store.summaries(Lookup(), Lookup())]
+            self.assertTrue(summaries)
+            self.assertTrue(any(s['isp_name'] == 'Test ISP'
+                                for s in summaries))
+        finally:
+            store.close()
+
+    def test_slices_recorded(self):
+        """
+        Applied slices should be remembered across store instances, by
+        path and fingerprint
+        """
+        state_dir = path.join(self.tmp_dir, 'slices-state')
+        other_dir = path.join(self.tmp_dir, 'other')
+        os.makedirs(other_dir)
+        other = path.join(other_dir, path.basename(self.slices[0]))
+        shutil.copy(self.slices[0], other)
+        store = SessionStore(state_dir)
+        store.mark_slice(slice_key(self.slices[0]))
+        store.close()
+        store = SessionStore(state_dir)
+        self.assertTrue(store.has_slice(slice_key(self.slices[0])))
+        self.assertFalse(store.has_slice(slice_key(self.slices[1])))
+        # same name in another directory
+        self.assertFalse(store.has_slice(slice_key(other)))
+        store.close()
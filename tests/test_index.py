@@ -0,0 +1,178 @@
+import gzip
+import shutil
+import tempfile
+import unittest
+from os import path
+
+from agora import index
+from agora.logs import GoonHillyLog
+from agora.stats import PBSVideoStats
+
+HERE = path.abspath(path.dirname(__file__))
+
+
+class LogIndexTestcase(unittest.TestCase):
+
+    """
+    Test agora.index sidecar indexes
+    """
+    @classmethod
+    def setup_class(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        cls.plain_file = path.join(cls.tmp_dir, 'fluentd-log-sample')
+        shutil.copy(path.join(HERE, './fixtures/fluentd-log-sample'),
+                    cls.plain_file)
+        cls.gz_file = cls.plain_file + '.gz'
+        with open(cls.plain_file, 'rb') as src:
+            dst = gzip.open(cls.gz_file, 'wb')
+            shutil.copyfileobj(src, dst)
+            dst.close()
+        cls.seekable_file = path.join(cls.tmp_dir, 'seekable.gz')
+        index.write_seekable_gzip(cls.plain_file, cls.seekable_file,
+                                  block_size=16 * 1024)
+        for filename in (cls.plain_file, cls.gz_file, cls.seekable_file):
+            index.build_index(filename)
+
+        cls.events = []
+        with open(cls.plain_file, 'rb') as f:
+            for line in f:
+                cls.events.append(GoonHillyLog.parse_log_line_json(line))
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def test_seekable_gzip_roundtrip(self):
+        """
+        The recompressed file holds many members and the same data
+        """
+        with open(self.plain_file, 'rb') as f:
+            expected = f.read()
+        self.assertEqual(gzip.open(self.seekable_file).read(), expected)
+        saved = index.LogIndex.load(index.index_path_for(self.seekable_file))
+        self.assertTrue(len(saved.header['checkpoints']) > 10)
+
+    def test_checkpoints_line_up(self):
+        """
+        Every checkpoint should be a valid entry point into the file
+        """
+        _, lines = index.iter_lines(self.plain_file)
+        offsets = dict(lines)
+        saved = index.LogIndex.load(index.index_path_for(self.seekable_file))
+        for uncompressed, compressed in saved.header['checkpoints']:
+            with open(self.seekable_file, 'rb') as f:
+                f.seek(compressed)
+                line = gzip.GzipFile(fileobj=f, mode='rb').readline()
+            self.assertEqual(line, offsets[uncompressed])
+
+    def test_query_tracking_id(self):
+        """
+        Pulling one stream by tracking id should match a full scan
+        """
+        tracking_id = self.events[0]['x_tracking_id']
+        expected = [e for e in self.events
+                    if e['x_tracking_id'] == tracking_id]
+        for filename in (self.plain_file, self.gz_file, self.seekable_file):
+            events = list(index.query([filename], tracking_id=tracking_id))
+            self.assertEqual(events, expected)
+
+    def test_query_summary(self):
+        """
+        Queried events go through PBSVideoStats like the reducer does
+        """
+        tracking_id = self.events[0]['x_tracking_id']
+        stats = PBSVideoStats()
+        for event in self.events:
+            if event['x_tracking_id'] == tracking_id:
+                stats.add_event(event)
+        results = list(index.summarize(
+            index.query([self.seekable_file], tracking_id=tracking_id)))
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0][1], stats.summary())
+
+    def test_query_window(self):
+        """
+        A time window query returns exactly the events inside it
+        """
+        millis = sorted(index.event_millis(e) for e in self.events)
+        start_ms = millis[len(millis) // 3] + 30000
+        end_ms = millis[2 * len(millis) // 3] + 30000
+        expected = [e for e in self.events
+                    if start_ms <= index.event_millis(e) <= end_ms]
+        for filename in (self.plain_file, self.seekable_file):
+            events = list(index.query(
+                [filename], start_ms=start_ms, end_ms=end_ms))
+            self.assertEqual(events, expected)
+
+    def test_window_reads_matching_records(self):
+        """
+        A window query unpacks only the records of its minutes
+        """
+        saved = index.LogIndex.load(index.index_path_for(self.plain_file))
+        built = index.LogIndex.build(self.plain_file)
+        minutes = sorted(index.event_millis(e) // 60000 for e in self.events
+                         if e.get('x_tracking_id'))
+        first, last = minutes[len(minutes) // 3], minutes[len(minutes) // 2]
+        unpacked = []
+        records = saved.by_minute.records
+
+        def counted(start, end):
+            unpacked.append(end - start)
+            return records(start, end)
+        saved.by_minute.records = counted
+        offsets = saved.offsets_for_window(first * 60000, last * 60000)
+        matching = sum(1 for m in minutes if first <= m <= last)
+        self.assertEqual(unpacked, [matching])
+        self.assertEqual(len(offsets), matching)
+        self.assertEqual(offsets, built.offsets_for_window(
+            first * 60000, last * 60000))
+        tracking_id = self.events[0]['x_tracking_id']
+        self.assertEqual(saved.offsets_for_tracking_id(tracking_id),
+                         built.offsets_for_tracking_id(tracking_id))
+
+    def test_truncated_index(self):
+        """
+        A truncated index is refused
+        """
+        filename = path.join(self.tmp_dir, 'truncated')
+        shutil.copy(self.plain_file, filename)
+        index.build_index(filename)
+        index_path = index.index_path_for(filename)
+        with open(index_path, 'rb') as f:
+            data = f.read()
+        with open(index_path, 'wb') as f:
+            f.write(data[:-5])
+        self.assertRaises(index.LogIndexError, index.LogIndex.load,
+                          index_path)
+
+    def test_stale_index(self):
+        """
+        Changing the log invalidates its index
+        """
+        filename = path.join(self.tmp_dir, 'stale')
+        shutil.copy(self.plain_file, filename)
+        index.build_index(filename)
+        with open(filename, 'ab') as f:
+            f.write('\n')
+        self.assertRaises(index.LogIndexError, list,
+                          index.query([filename], tracking_id='x'))
+
+    def test_format_recorded(self):
+        """
+        The index records the format of its log and queries parse with it
+        """
+        filename = path.join(self.tmp_dir, 'goonhilly-log-sample')
+        shutil.copy(path.join(HERE, './fixtures/goonhilly-log-sample'),
+                    filename)
+        index.build_index(filename)
+        saved = index.LogIndex.load(index.index_path_for(filename))
+        self.assertEqual(saved.header['format'], 'goonhilly')
+        plain = index.LogIndex.load(index.index_path_for(self.plain_file))
+        self.assertEqual(plain.header['format'], 'json')
+        with open(filename) as f:
+            events = [GoonHillyLog.parse_log_line(line) for line in f]
+        tracking_id = [e for e in events if e][0]['x_tracking_id']
+        expected = [e for e in events
+                    if e and e.get('x_tracking_id') == tracking_id]
+        self.assertEqual(
+            list(index.query([filename], tracking_id=tracking_id)), expected)
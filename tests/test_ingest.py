@@ -0,0 +1,116 @@
+import gzip
+import shutil
+import tempfile
+import unittest
+from os import path
+from StringIO import StringIO
+
+from agora.ingest import IngestPipeline, open_input
+from agora.jobs import VideoStreamCondense
+
+HERE = path.abspath(path.dirname(__file__))
+
+
+class IngestPipelineTestcase(unittest.TestCase):
+
+    """
+    Test agora.ingest.IngestPipeline
+    """
+    @classmethod
+    def setup_class(cls):
+        cls.sample_data_file = path.join(
+            HERE, './fixtures/fluentd-log-sample')
+        cls.tmp_dir = tempfile.mkdtemp()
+        cls.gz_file = path.join(cls.tmp_dir, 'fluentd-log-sample.gz')
+        with open(cls.sample_data_file, 'rb') as src:
+            dst = gzip.open(cls.gz_file, 'wb')
+            shutil.copyfileobj(src, dst)
+            dst.close()
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def mapper_output(self):
+        """
+        Run the job's own mapper over the sample data.
+        """
+        mr_job = VideoStreamCondense(['--no-conf'])
+        protocol = mr_job.internal_protocol()
+        lines = []
+        mr_job.mapper_init()
+        with open(self.sample_data_file, 'r') as f:
+            for line in f:
+                for key, value in mr_job.mapper(None, line):
+                    lines.append(protocol.write(key, value) + '\n')
+        for key, value in mr_job.mapper_final():
+            lines.append(protocol.write(key, value) + '\n')
+        return lines
+
+    def run_pipeline(self, paths, **kwargs):
+        output = StringIO()
+        pipeline = IngestPipeline(**kwargs)
+        pipeline.run(paths, output)
+        return pipeline, output.getvalue().splitlines(True)
+
+    def test_matches_mapper(self):
+        """
+        The pipeline output should match the job's mapper line for line
+        """
+        pipeline, lines = self.run_pipeline(
+            [self.sample_data_file], workers=2, batch_size=37)
+        self.assertEqual(lines, self.mapper_output())
+        self.assertEqual(pipeline.counters['total-events'], 400)
+
+    def test_inline_workers(self):
+        """
+        Parsing in the writer thread gives the same output
+        """
+        _, inline = self.run_pipeline(
+            [self.sample_data_file], workers=0, batch_size=50)
+        _, pooled = self.run_pipeline(
+            [self.sample_data_file], workers=2, batch_size=50)
+        self.assertEqual(inline, pooled)
+
+    def test_gzip_input(self):
+        """
+        Compressed input is decompressed with or without external tools
+        """
+        for external in (True, False):
+            pipeline, lines = self.run_pipeline(
+                [self.gz_file], workers=1, batch_size=100,
+                external_decompression=external)
+            self.assertEqual(lines, self.mapper_output())
+
+    def test_stage_stats(self):
+        """
+        Every stage should account for its work
+        """
+        pipeline, lines = self.run_pipeline(
+            [self.sample_data_file, self.gz_file], workers=2,
+            batch_size=100, max_pending=2)
+        reader, parse, writer = pipeline.stats()
+        self.assertEqual(reader['lines'], 800)
+        self.assertEqual(reader['batches'], 8)
+        self.assertEqual(parse['lines'], 800)
+        self.assertEqual(writer['lines'], len(lines))
+        self.assertEqual(pipeline.counters['valid-events'], len(lines))
+
+    def test_mixed_formats(self):
+        """
+        Every file is parsed in the format its first lines look like
+        """
+        goonhilly_file = path.join(HERE, './fixtures/goonhilly-log-sample')
+        pipeline, lines = self.run_pipeline(
+            [self.sample_data_file, goonhilly_file], workers=2,
+            batch_size=100)
+        with open(goonhilly_file) as f:
+            goonhilly_lines = len(f.readlines())
+        self.assertEqual(pipeline.formats,
+                         {'json': 400, 'goonhilly': goonhilly_lines})
+        self.assertEqual(pipeline.counters['unparsable-events'], 0)
+
+    def test_open_input_plain(self):
+        stream = open_input(self.sample_data_file)
+        self.assertEqual(len(list(stream)), 400)
+        stream.close()
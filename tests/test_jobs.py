@@ -1,7 +1,15 @@
+import glob
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
 import unittest
 from os import path
 
+from agora.coverage import SupportMatrix, read_coverage
 from agora.jobs import VideoStreamCondense
+from agora.logs import GoonHillyLog
 
 HERE = path.abspath(path.dirname(__file__))
 
@@ -15,6 +23,8 @@ class VideoStreamCondenseTestcase(unittest.TestCase):
     def setup_class(cls):
         cls.sample_data_file = path.join(
             HERE, './fixtures/goonhilly-log-sample')
+        cls.fluentd_data_file = path.join(
+            HERE, './fixtures/fluentd-log-sample')
 
     def test_mr(self):
         """
@@ -29,3 +39,237 @@ class VideoStreamCondenseTestcase(unittest.TestCase):
                 for line in runner.stream_output():
                     results.append(line)
         self.assertTrue(len(results) > 0)
+
+    def run_job(self, args, data_file):
+        mr_job = VideoStreamCondense(['--no-conf', '-'] + args)
+        with open(data_file, 'r') as data:
+            mr_job.sandbox(stdin=data)
+            results = []
+            with mr_job.make_runner() as runner:
+                runner.run()
+                for line in runner.stream_output():
+                    results.append(mr_job.parse_output_line(line))
+        return results
+
+    def test_rollup(self):
+        """
+        The rollup step should account for every session
+        """
+        sessions = self.run_job([], self.fluentd_data_file)
+        rollups = self.run_job(['--rollup'], self.fluentd_data_file)
+        # the session summaries pass through the rollup step unchanged
+        self.assertEqual(
+            sorted((k, s) for k, s in rollups if not isinstance(k, list)),
+            sorted(sessions))
+        heavy_hitters = [(k, r) for k, r in rollups
+                         if isinstance(k, list) and k[0] == 'heavy-hitters']
+        self.assertTrue(heavy_hitters)
+        for key, report in heavy_hitters:
+            self.assertTrue(len(report['top']) <= 50)
+        rollups = [(k, r) for k, r in rollups
+                   if isinstance(k, list) and k[0] == 'title']
+        self.assertTrue(len(rollups) > 0)
+        self.assertTrue(len(rollups) < len(sessions))
+        self.assertEqual(sum(r['sessions'] for _, r in rollups),
+                         len(sessions))
+        self.assertEqual(
+            sum(r['buffering_events'] for _, r in rollups),
+            sum(s['buffering_events'] for _, s in sessions))
+
+    def test_concurrency(self):
+        """
+        The per minute totals should never be below any single source
+        """
+        results = self.run_job(['--concurrency'], self.fluentd_data_file)
+        totals = dict((k[1], v) for k, v in results if k[0] == 'total')
+        self.assertTrue(totals)
+        self.assertTrue(max(totals.values()) > 1)
+        for key, concurrency in results:
+            if key[0] == 'source':
+                self.assertTrue(concurrency <= totals[key[2]])
+
+    def test_lazy_imports(self):
+        """
+        A plain task must not load the lookup, date parsing or feature
+        modules
+        """
+        modules = ('pygeoip', 'dateutil', 'agora.concurrency',
+                   'agora.coverage', 'agora.memory', 'agora.metrics',
+                   'agora.quantiles', 'agora.rollup', 'agora.splits',
+                   'agora.topk')
+        code = ('import sys, agora.jobs; '
+                'agora.jobs.VideoStreamCondense(["--step-num=0", '
+                '"--mapper"]).steps(); '
+                'print sorted(m for m in %r if m in sys.modules)' % (modules,))
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         cwd=path.dirname(HERE))
+        self.assertEqual(output.strip(), '[]')
+
+    def test_memory_report(self):
+        """
+        The reducer memory report should have seen every session
+        """
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            sessions = self.run_job(['--memory-report', tmp_dir],
+                                    self.fluentd_data_file)
+            reports = []
+            for filename in glob.glob(
+                    path.join(tmp_dir, 'memory-reducer-*.json')):
+                with open(filename) as f:
+                    reports.append(json.load(f))
+        finally:
+            shutil.rmtree(tmp_dir)
+        self.assertEqual(sum(r['sessions'] for r in reports), len(sessions))
+        self.assertTrue(all(r['largest_sessions'] for r in reports))
+
+    def test_coverage(self):
+        """
+        The coverage side output should match a separate scan of the logs
+        """
+        expected = SupportMatrix()
+        with open(self.fluentd_data_file) as f:
+            for line in f:
+                expected.add_event(GoonHillyLog.parse_log_line_json(line))
+        for args in ([], ['--rollup'], ['--concurrency']):
+            tmp_dir = tempfile.mkdtemp()
+            try:
+                results = self.run_job(['--coverage', tmp_dir] + args,
+                                       self.fluentd_data_file)
+                self.assertEqual(results, self.run_job(
+                    args, self.fluentd_data_file))
+                self.assertEqual(read_coverage(tmp_dir).to_dict(),
+                                 expected.to_dict())
+            finally:
+                shutil.rmtree(tmp_dir)
+
+    def test_combine_splits(self):
+        """
+        Combining many small inputs should need fewer map tasks for the
+        same output
+        """
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            with open(self.fluentd_data_file) as f:
+                lines = f.readlines()
+            inputs = []
+            for number in range(0, len(lines), 40):
+                inputs.append(path.join(tmp_dir, 'part-%03d' % number))
+                with open(inputs[-1], 'w') as f:
+                    f.writelines(lines[number:number + 40])
+            runs = []
+            for args in ([], ['--combine-split-size', '200000']):
+                mr_job = VideoStreamCondense(['--no-conf'] + args + inputs)
+                with mr_job.make_runner() as runner:
+                    runner.run()
+                    results = sorted(mr_job.parse_output_line(line)
+                                     for line in runner.stream_output())
+                    overhead = runner.counters()[0]['task-overhead']
+                runs.append((results, overhead))
+        finally:
+            shutil.rmtree(tmp_dir)
+        (separate, separate_overhead), (combined, combined_overhead) = runs
+        self.assertEqual(combined, separate)
+        self.assertEqual(separate_overhead['map-tasks'], len(inputs))
+        self.assertTrue(combined_overhead['map-tasks'] < len(inputs) / 2)
+        self.assertTrue('startup-ms' in combined_overhead)
+
+    def test_mixed_split(self):
+        """
+        A split holding files of both formats, as a combined split on
+        Hadoop can, should parse every line with the parser of its file
+        """
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            parts = []
+            for name in (self.sample_data_file, self.fluentd_data_file):
+                parts.append(path.join(tmp_dir, path.basename(name)))
+                with open(name) as f:
+                    with open(parts[-1], 'w') as out:
+                        out.writelines(f.readlines()[:60])
+            mixed = path.join(tmp_dir, 'mixed')
+            with open(mixed, 'w') as out:
+                for name in parts:
+                    with open(name) as f:
+                        out.write(f.read())
+            runs = []
+            for inputs in ([mixed], parts):
+                mr_job = VideoStreamCondense(['--no-conf'] + inputs)
+                with mr_job.make_runner() as runner:
+                    runner.run()
+                    results = sorted(mr_job.parse_output_line(line)
+                                     for line in runner.stream_output())
+                    counters = runner.counters()[0]
+                runs.append((results, counters))
+        finally:
+            shutil.rmtree(tmp_dir)
+        (mixed, mixed_counters), (separate, separate_counters) = runs
+        self.assertEqual(mixed, separate)
+        self.assertEqual(mixed_counters['input-formats'],
+                         {'goonhilly': 60, 'json': 60})
+        self.assertEqual(mixed_counters['job-metrics'],
+                         separate_counters['job-metrics'])
+
+    def test_interim_metrics(self):
+        """
+        Interim metrics should count the lines of a task that is still
+        running
+        """
+        interim = []
+
+        class ProgressJob(VideoStreamCondense):
+            def _map_line(self, line):
+                pair = super(ProgressJob, self)._map_line(line)
+                if self.progress and self.progress.counts['lines'] == 150:
+                    # as if the interval had passed
+                    self.progress.write()
+                    interim.append(launcher.interim_snapshot())
+                return pair
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            prefix = path.join(tmp_dir, 'run')
+            launcher = ProgressJob(
+                ['--no-conf', '--metrics', prefix, '--metrics-interval',
+                 '3600', self.fluentd_data_file])
+            launcher.sandbox()
+            launcher.run_job()
+            self.assertFalse(path.exists(prefix + '.progress'))
+        finally:
+            shutil.rmtree(tmp_dir)
+        # once in each of the two map tasks
+        self.assertEqual(len(interim), 2)
+        # the runner has no counters of the running task yet
+        self.assertEqual(interim[0]['counters'], {})
+        self.assertEqual(interim[0]['lines'], 150)
+        self.assertTrue(interim[0]['lines_per_second'] > 0)
+        first_task = interim[1]['counters']['job-metrics']['total-events']
+        self.assertEqual(interim[1]['lines'], first_task + 150)
+
+    def test_metrics(self):
+        """
+        A run with --metrics should write its counters, phases and output
+        size
+        """
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            prefix = path.join(tmp_dir, 'run')
+            mr_job = VideoStreamCondense(
+                ['--no-conf', '--metrics', prefix, self.fluentd_data_file])
+            mr_job.sandbox()
+            mr_job.run_job()
+            with open(prefix + '.json') as f:
+                metrics = json.load(f)
+            self.assertTrue(path.exists(prefix + '.prom'))
+        finally:
+            shutil.rmtree(tmp_dir)
+        self.assertEqual(metrics['status'], 'succeeded')
+        self.assertEqual(metrics['lines'], 400)
+        self.assertEqual(metrics['bytes_in'],
+                         path.getsize(self.fluentd_data_file))
+        self.assertEqual(metrics['bytes_out'],
+                         len(mr_job.stdout.getvalue()))
+        self.assertEqual(metrics['sessions'],
+                         len(mr_job.stdout.getvalue().splitlines()))
+        self.assertEqual(sorted(metrics['phases']),
+                         ['sessions-mapper', 'sessions-reducer'])
@@ -0,0 +1,112 @@
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from os import path
+
+from agora import load
+from agora.index import summarize
+from agora.logs import GoonHillyLog
+from mrjob.protocol import JSONProtocol
+
+HERE = path.abspath(path.dirname(__file__))
+
+
+class BulkLoaderTestcase(unittest.TestCase):
+
+    """
+    Test agora.load.BulkLoader against sqlite
+    """
+    @classmethod
+    def setup_class(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        with open(path.join(HERE, './fixtures/fluentd-log-sample')) as f:
+            events = [GoonHillyLog.parse_log_line_json(line) for line in f]
+        cls.summaries = [summary for _, summary in summarize(events)]
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def loader(self, name, **kwargs):
+        db_path = path.join(self.tmp_dir, name)
+        loader = load.BulkLoader(load.SQLiteBackend(db_path), **kwargs)
+        loader.create_table()
+        return loader, db_path
+
+    def query(self, db_path, sql):
+        connection = sqlite3.connect(db_path)
+        try:
+            return connection.execute(sql).fetchall()
+        finally:
+            connection.close()
+
+    def test_batches(self):
+        loader, db_path = self.loader('batches.db', batch_size=7,
+                                      transaction_size=20)
+        loader.load(self.summaries)
+        loader.close()
+        stats = loader.stats()
+        batches = -(-len(self.summaries) // 7)
+        self.assertEqual(stats['rows'], len(self.summaries))
+        self.assertEqual(stats['batches'], batches)
+        # two whole batches per transaction
+        self.assertEqual(stats['transactions'], -(-batches // 2))
+        self.assertEqual(stats['connections'], 1)
+        self.assertEqual(
+            self.query(db_path, 'SELECT COUNT(*) FROM sessions'),
+            [(len(self.summaries),)])
+
+    def test_upsert(self):
+        """
+        Loading twice keeps one row per stream, with the latest values
+        """
+        loader, db_path = self.loader('upsert.db', batch_size=50)
+        loader.load(self.summaries)
+        changed = dict(self.summaries[0], title=u'changed')
+        loader.load(self.summaries + [changed])
+        loader.close()
+        self.assertEqual(loader.stats()['connections'], 1)
+        self.assertEqual(
+            self.query(db_path, 'SELECT COUNT(*) FROM sessions'),
+            [(len(self.summaries),)])
+        self.assertEqual(self.query(
+            db_path, "SELECT title FROM sessions WHERE tracking_id = '%s'"
+            % changed['tracking_id']), [(u'changed',)])
+
+    def test_shared_tracking_id(self):
+        """
+        Streams sharing a short tracking id keep their own rows
+        """
+        loader, db_path = self.loader('shared.db')
+        other = dict(self.summaries[0], media_id=u'other-media')
+        loader.load(self.summaries + [other])
+        loader.close()
+        self.assertEqual(loader.stats()['duplicates'], 0)
+        self.assertEqual(self.query(
+            db_path, "SELECT COUNT(*) FROM sessions WHERE tracking_id = '%s'"
+            % other['tracking_id']), [(2,)])
+
+    def test_duplicates_in_batch(self):
+        loader, db_path = self.loader('duplicates.db')
+        loader.load(self.summaries[:3] + self.summaries[:1] + [{}])
+        loader.close()
+        stats = loader.stats()
+        self.assertEqual(stats['rows'], 3)
+        self.assertEqual(stats['duplicates'], 1)
+        self.assertEqual(stats['skipped'], 1)
+
+    def test_main(self):
+        output = path.join(self.tmp_dir, 'output')
+        protocol = JSONProtocol()
+        with open(output, 'w') as f:
+            for summary in self.summaries:
+                f.write(protocol.write(summary['tracking_id'], summary))
+                f.write('\n')
+            # rollups aren't loaded
+            f.write(protocol.write(['rollup', '2014-09-02'], {}) + '\n')
+        db_path = path.join(self.tmp_dir, 'main.db')
+        load.main(['--db', 'sqlite:///' + db_path, '-b', '10', output])
+        self.assertEqual(
+            self.query(db_path, 'SELECT COUNT(*) FROM sessions'),
+            [(len(self.summaries),)])
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+import json
+import unittest
+from os import path
+
+from agora import logs
+from agora.logs import GoonHillyLog, JSONNormalizer
+from agora.quarantine import Quarantine
+
+HERE = path.abspath(path.dirname(__file__))
+
+
+class JSONNormalizerTestcase(unittest.TestCase):
+
+    """
+    Test agora.logs.JSONNormalizer parsing of fluentd lines
+    """
+    @classmethod
+    def setup_class(cls):
+        with open(path.join(HERE, './fixtures/fluentd-log-sample')) as f:
+            cls.lines = f.readlines()
+
+    def line(self, **fields):
+        event = {'time': '2014-09-02T17:20:54Z', 'event_type': 'MediaStarted'}
+        event.update(fields)
+        return json.dumps(event)
+
+    def test_event_date(self):
+        self.assertEqual(logs.event_date('2014-09-02T17:20:54Z'),
+                         '2014-09-02 17:20:54')
+        self.assertEqual(logs.event_date('2014-09-02T17:20:54.123+02:00'),
+                         '2014-09-02 17:20:54')
+        # not ISO, through dateutil
+        self.assertEqual(logs.event_date('Sep 2 2014 17:20:54'),
+                         '2014-09-02 17:20:54')
+        self.assertEqual(logs.event_date('2014-02-30T17:20:54Z'), None)
+        self.assertEqual(logs.event_date('never'), None)
+        self.assertEqual(logs.event_date(None), None)
+
+    def test_unicode_quotes(self):
+        event = GoonHillyLog.parse_log_line_json(
+            self.line(x_episode_title=u'"Caf\xe9"', x_custom='"x"'))
+        self.assertEqual(event['x_episode_title'], u'Caf\xe9')
+        # undeclared fields are passed through, unquoted
+        self.assertEqual(event['x_custom'], 'x')
+
+    def test_session_id(self):
+        event = GoonHillyLog.parse_log_line_json(
+            self.line(x_session_id='5ECBF50E-32CD'))
+        self.assertEqual(event['x_session_id'], '5ecbf50e-32cd')
+
+    def test_declared_only(self):
+        normalizer = JSONNormalizer(passthrough=False)
+        event = normalizer.parse(self.line(x_custom='x'))
+        self.assertFalse('x_custom' in event)
+        self.assertEqual(event['event_type'], 'MediaStarted')
+
+    def test_bad_lines(self):
+        self.assertEqual(GoonHillyLog.parse_log_line_json('{"x'), None)
+        self.assertEqual(GoonHillyLog.parse_log_line_json('[1, 2]'), None)
+        self.assertEqual(GoonHillyLog.parse_log_line_json(
+            self.line(time='never')), None)
+
+    def test_batch(self):
+        single = [GoonHillyLog.parse_log_line_json(l) for l in self.lines]
+        self.assertEqual(GoonHillyLog.parse_log_lines_json(self.lines),
+                         single)
+        # a bad line falls back to decoding line by line
+        lines = self.lines[:5] + ['{"x'] + self.lines[5:10]
+        events = GoonHillyLog.parse_log_lines_json(lines)
+        self.assertEqual(events, single[:5] + [None] + single[5:10])
+        # lines that don't hold exactly one object each
+        events = GoonHillyLog.parse_log_lines_json(['{}, {}', '1'])
+        self.assertEqual(events, [None, None])
+
+    def test_backends(self):
+        expected = [GoonHillyLog.parse_log_line_json(l) for l in self.lines]
+        for name in logs.JSON_BACKENDS:
+            try:
+                normalizer = JSONNormalizer(backend=name)
+            except ImportError:
+                continue
+            self.assertEqual(normalizer.backend, name)
+            self.assertEqual(normalizer.parse_lines(self.lines), expected)
+
+
+class LogFormatTestcase(unittest.TestCase):
+
+    """
+    Test the agora.logs input format registry and sniffing
+    """
+    @classmethod
+    def setup_class(cls):
+        with open(path.join(HERE, './fixtures/goonhilly-log-sample')) as f:
+            cls.goonhilly_lines = f.readlines()
+        with open(path.join(HERE, './fixtures/fluentd-log-sample')) as f:
+            cls.json_lines = f.readlines()
+
+    def tearDown(self):
+        logs.FORMATS[:] = [f for f in logs.FORMATS if f.name != 'test']
+
+    def test_sniff(self):
+        self.assertEqual(logs.sniff_format(self.goonhilly_lines[:20]).name,
+                         'goonhilly')
+        self.assertEqual(logs.sniff_format(self.json_lines[:20]).name, 'json')
+        # majority wins, nothing matching gets the default
+        self.assertEqual(logs.sniff_format(
+            self.json_lines[:2] + self.goonhilly_lines[:3]).name, 'goonhilly')
+        self.assertEqual(logs.sniff_format(['', 'garbage']).name, 'json')
+
+    def test_goonhilly_format(self):
+        events = logs.get_format('goonhilly').parse_lines(
+            self.goonhilly_lines[:10])
+        self.assertTrue(all(events))
+        self.assertTrue(all(e['event_date'] for e in events))
+
+    def test_register(self):
+        log_format = logs.LogFormat(
+            'test', lambda line: line.startswith('test '),
+            lambda line, quarantine=None: {'line': line})
+        logs.register_format(log_format)
+        self.assertTrue(logs.get_format('test') is log_format)
+        self.assertEqual(logs.sniff_format(['test 1']).parse_lines(
+            ['test 1']), [{'line': 'test 1'}])
+        self.assertRaises(KeyError, logs.get_format, 'missing')
+
+    def test_line_parser(self):
+        """
+        Lines are sniffed again only where the bound format fails, and a
+        line of another format switches the parser
+        """
+        sniffed = []
+        json_format = logs.get_format('json')
+        counting = logs.LogFormat(
+            'json', lambda line: sniffed.append(line) or
+            json_format.sniff(line), json_format.parse)
+        logs.register_format(counting)
+        try:
+            quarantine = Quarantine()
+            parser = logs.LineParser(counting, quarantine)
+            lines = self.json_lines[:10] + self.goonhilly_lines[:10] + \
+                ['garbage\n'] + self.json_lines[10:20]
+            events = [parser.parse(line) for line in lines]
+            sniffs = len(sniffed)
+            batch = logs.LineParser(counting).parse_lines(lines)
+        finally:
+            logs.register_format(json_format)
+        self.assertEqual(events[:20], [
+            json_format.parse(line) for line in self.json_lines[:10]] + [
+            GoonHillyLog.parse_log_line(line)
+            for line in self.goonhilly_lines[:10]])
+        self.assertEqual(events[20], None)
+        self.assertTrue(all(events[21:]))
+        self.assertEqual(batch, events)
+        self.assertEqual(parser.log_format.name, 'json')
+        self.assertEqual(sum(quarantine.counts.values()), 1)
+        # twice at the switch to goonhilly, once at the garbage line and
+        # once at the switch back
+        self.assertEqual(sniffs, 4)
@@ -0,0 +1,75 @@
+import json
+import shutil
+import tempfile
+import unittest
+from os import path
+
+from agora import memory
+from agora.logs import GoonHillyLog
+from agora.stats import PBSVideoStats
+
+HERE = path.abspath(path.dirname(__file__))
+
+
+class MemoryDiagnosticsTestcase(unittest.TestCase):
+
+    """
+    Test agora.memory sizes and task diagnostics
+    """
+    @classmethod
+    def setup_class(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        with open(path.join(HERE, './fixtures/fluentd-log-sample')) as f:
+            events = [GoonHillyLog.parse_log_line_json(line) for line in f]
+        cls.streams = {}
+        for event in events:
+            key = GoonHillyLog.tracking_key(event)
+            if key:
+                cls.streams.setdefault(key, []).append(event)
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def test_deep_sizeof_exclude(self):
+        big = ['x' * 1000]
+        stats = PBSVideoStats(isp_lookup=big)
+        self.assertTrue(memory.deep_sizeof(stats) -
+                        memory.deep_sizeof(stats, exclude=(big,)) >= 1000)
+
+    def test_largest_sessions(self):
+        diagnostics = memory.MemoryDiagnostics(top_n=3, snapshot_interval=50)
+        for key, events in sorted(self.streams.iteritems()):
+            stats = PBSVideoStats()
+            for event in events:
+                stats.add_event(event)
+            diagnostics.add_session(key, stats, len(events))
+        report_file = path.join(self.tmp_dir, 'report.json')
+        diagnostics.close(report_file)
+        with open(report_file) as f:
+            report = json.load(f)
+
+        self.assertEqual(report['sessions'], len(self.streams))
+        self.assertEqual(report['events'],
+                         sum(len(e) for e in self.streams.values()))
+        largest = report['largest_sessions']
+        self.assertEqual(len(largest), 3)
+        self.assertEqual([s['bytes'] for s in largest],
+                         sorted([s['bytes'] for s in largest], reverse=True))
+        self.assertEqual(largest[0]['events'],
+                         len(self.streams[largest[0]['key']]))
+        self.assertTrue(report['peak_rss_kb'] > 0)
+        self.assertEqual(report['tracemalloc'], memory.tracemalloc is not None)
+
+    @unittest.skipIf(memory.tracemalloc is None,
+                     'tracemalloc is not available')
+    def test_allocation_sites(self):
+        diagnostics = memory.MemoryDiagnostics(snapshot_interval=10)
+        events = []
+        with open(path.join(HERE, './fixtures/fluentd-log-sample')) as f:
+            for line in f:
+                events.append(GoonHillyLog.parse_log_line_json(line))
+                diagnostics.add_events()
+        report = diagnostics.close()
+        self.assertTrue(report['snapshots'] > 0)
+        self.assertTrue(report['allocation_sites'])
@@ -0,0 +1,74 @@
+import json
+import shutil
+import tempfile
+import time
+import unittest
+from os import path
+
+from agora import metrics
+
+
+class MetricsTestcase(unittest.TestCase):
+
+    """
+    Test agora.metrics snapshots and their formats
+    """
+    @classmethod
+    def setup_class(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def snapshot(self):
+        run = metrics.RunMetrics(bytes_in=1000)
+        run.bytes_out = 10
+        return run.snapshot([
+            {'job-metrics': {'total-events': 400},
+             'phase-metrics': {'sessions-mapper-tasks': 2,
+                               'sessions-mapper-wall-ms': 1500,
+                               'sessions-mapper-cpu-ms': 1200}},
+            {'job-metrics': {'total-events': 1},
+             'event-metrics': {'total-streams': 199}}], 'succeeded')
+
+    def test_snapshot(self):
+        snapshot = self.snapshot()
+        self.assertEqual(snapshot['counters']['job-metrics'],
+                         {'total-events': 401})
+        self.assertEqual(snapshot['lines'], 401)
+        self.assertEqual(snapshot['sessions'], 199)
+        self.assertEqual(snapshot['phases'], {'sessions-mapper': {
+            'tasks': 2, 'wall_seconds': 1.5, 'cpu_seconds': 1.2}})
+        self.assertTrue(snapshot['cpu_seconds'] >= 0)
+
+    def test_prometheus(self):
+        text = metrics.to_prometheus(self.snapshot())
+        lines = text.splitlines()
+        self.assertTrue('agora_run_info{status="succeeded"} 1' in lines)
+        self.assertTrue('agora_run_bytes_in 1000' in lines)
+        self.assertTrue('agora_phase_wall_seconds{phase="sessions-mapper"} '
+                        '1.5' in lines)
+        self.assertTrue('agora_counter_total{group="job-metrics",'
+                        'name="total-events"} 401' in lines)
+        self.assertTrue('# TYPE agora_counter_total counter' in lines)
+        # every sample has a type
+        names = set(line.split()[2] for line in lines
+                    if line.startswith('# TYPE'))
+        for line in lines:
+            if not line.startswith('#'):
+                self.assertTrue(line.split('{')[0].split()[0] in names)
+
+    def test_snapshots(self):
+        prefix = path.join(self.tmp_dir, 'interim')
+        snapshots = metrics.Snapshots(prefix, 0.01, self.snapshot)
+        snapshots.start()
+        deadline = time.time() + 10
+        while not snapshots.written and time.time() < deadline:
+            time.sleep(0.01)
+        snapshots.stop()
+        self.assertTrue(snapshots.written)
+        with open(prefix + '.json') as f:
+            self.assertEqual(json.load(f)['lines'], 401)
+        self.assertTrue(path.exists(prefix + '.prom'))
+        self.assertFalse(path.exists(prefix + '.json.tmp'))
@@ -0,0 +1,116 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+from os import path
+from StringIO import StringIO
+
+from agora.ingest import IngestPipeline
+from agora.objectstore import (LocalStore, PrefetchReader, iter_lines,
+                               parse_uri)
+
+HERE = path.abspath(path.dirname(__file__))
+
+
+class PrefetchReaderTestcase(unittest.TestCase):
+
+    """
+    Test agora.objectstore.PrefetchReader against a filesystem store
+    """
+    @classmethod
+    def setup_class(cls):
+        cls.sample_data_file = path.join(
+            HERE, './fixtures/fluentd-log-sample')
+        with open(cls.sample_data_file) as f:
+            cls.lines = f.readlines()
+        # s3://logs/2014-09-02/ with one object per 50 lines, some gzipped
+        cls.tmp_dir = tempfile.mkdtemp()
+        day = path.join(cls.tmp_dir, 'logs', '2014-09-02')
+        os.makedirs(day)
+        for number in range(0, len(cls.lines), 50):
+            name = path.join(day, 'part-%03d' % number)
+            if number % 100:
+                f = gzip.open(name + '.gz', 'wb')
+            else:
+                f = open(name, 'wb')
+            f.writelines(cls.lines[number:number + 50])
+            f.close()
+        open(path.join(day, '_SUCCESS'), 'w').close()
+        cls.store = LocalStore(cls.tmp_dir)
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def read_all(self, reader):
+        names = []
+        lines = []
+        for name, stream in reader:
+            names.append(name)
+            lines.extend(stream)
+        return names, lines
+
+    def test_parse_uri(self):
+        self.assertEqual(parse_uri('s3://logs/2014-09-02/'),
+                         ('logs', '2014-09-02/'))
+        self.assertRaises(ValueError, parse_uri, '/logs/2014-09-02')
+
+    def test_in_order(self):
+        """
+        Objects should be read in listing order whatever finishes first
+        """
+        reader = PrefetchReader(self.store, ['s3://logs/2014-09-02/'],
+                                workers=4, chunk_size=1000)
+        names, lines = self.read_all(reader)
+        self.assertEqual(len(names), 8)
+        self.assertEqual(names, sorted(names))
+        self.assertEqual(lines, self.lines)
+        stats = reader.stats.as_dict()
+        self.assertEqual(stats['objects'], 8)
+        self.assertEqual(stats['bytes'], sum(
+            size for _, size in self.store.list('logs', '2014-09-02/')))
+
+    def test_read_ahead_bound(self):
+        """
+        A buffer smaller than a chunk still makes progress, and never
+        holds more than one chunk past its bound
+        """
+        reader = PrefetchReader(self.store, ['s3://logs/2014-09-02/'],
+                                workers=4, max_buffer=500, chunk_size=1000)
+        _, lines = self.read_all(reader)
+        self.assertEqual(lines, self.lines)
+        self.assertTrue(reader.stats.peak_buffered <= 500 + 1000)
+
+    def test_partial_reads(self):
+        """
+        Skipping the rest of an object shouldn't hold up the next ones
+        """
+        reader = PrefetchReader(self.store, ['s3://logs/2014-09-02/'],
+                                workers=2, max_buffer=2000, chunk_size=500)
+        first_lines = [next(stream) for _, stream in reader]
+        self.assertEqual(first_lines, self.lines[::50])
+
+    def test_errors(self):
+        """
+        A failed download is raised when its object is read
+        """
+        store = LocalStore(self.tmp_dir)
+        store.open = lambda bucket, key: open('/nonexistent/' + key)
+        reader = PrefetchReader(store, ['s3://logs/2014-09-02/'])
+        self.assertRaises(IOError, self.read_all, reader)
+
+    def test_iter_lines(self):
+        chunks = ['a\nb', 'c\n', '\nd']
+        self.assertEqual(list(iter_lines(chunks)), ['a\n', 'bc\n', '\n', 'd'])
+
+    def test_ingest(self):
+        """
+        The ingest pipeline output shouldn't depend on where logs come from
+        """
+        local = StringIO()
+        IngestPipeline(workers=0).run([self.sample_data_file], local)
+        fetched = StringIO()
+        IngestPipeline(workers=0).run(PrefetchReader(
+            self.store, ['s3://logs/2014-09-02/'], chunk_size=1000), fetched)
+        self.assertEqual(fetched.getvalue(), local.getvalue())
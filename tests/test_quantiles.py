@@ -0,0 +1,73 @@
+import random
+import unittest
+
+from agora.quantiles import KLLSketch
+
+
+class KLLSketchTestcase(unittest.TestCase):
+
+    """
+    Test agora.quantiles.KLLSketch against exact quantiles
+    """
+    @classmethod
+    def setup_class(cls):
+        rand = random.Random(7)
+        # buffering-like, heavy tailed values
+        cls.values = [int(rand.expovariate(1 / 30.0)) for _ in xrange(50000)]
+        cls.sorted_values = sorted(cls.values)
+
+    def assert_rank_error(self, sketch, allowed=0.02):
+        n = len(self.sorted_values)
+        for fraction in (0.01, 0.25, 0.5, 0.9, 0.95, 0.99):
+            estimate = sketch.quantile(fraction)
+            # fraction of values <= estimate, allowing for ties
+            low = self._rank(estimate, strict=True) / float(n)
+            high = self._rank(estimate) / float(n)
+            self.assertTrue(low - allowed <= fraction <= high + allowed,
+                            'p%s: %s covers %.3f..%.3f' % (
+                                fraction, estimate, low, high))
+
+    def _rank(self, value, strict=False):
+        import bisect
+        if strict:
+            return bisect.bisect_left(self.sorted_values, value)
+        return bisect.bisect_right(self.sorted_values, value)
+
+    def test_quantiles(self):
+        sketch = KLLSketch()
+        for value in self.values:
+            sketch.add(value)
+        self.assertEqual(sketch.count, len(self.values))
+        self.assertEqual(sketch.min, min(self.values))
+        self.assertEqual(sketch.max, max(self.values))
+        self.assert_rank_error(sketch)
+
+    def test_bounded_memory(self):
+        sketch = KLLSketch(k=100)
+        for value in self.values:
+            sketch.add(value)
+        self.assertTrue(sum(len(c) for c in sketch.compactors) < 400)
+
+    def test_merge(self):
+        """
+        Merging many small sketches stays accurate
+        """
+        merged = KLLSketch()
+        for start in xrange(0, len(self.values), 1000):
+            part = KLLSketch()
+            for value in self.values[start:start + 1000]:
+                part.add(value)
+            merged.merge(part)
+        self.assertEqual(merged.count, len(self.values))
+        self.assert_rank_error(merged)
+
+    def test_serialization(self):
+        sketch = KLLSketch()
+        for value in self.values[:5000]:
+            sketch.add(value)
+        copy = KLLSketch.from_string(sketch.to_string())
+        self.assertEqual(copy.compactors, sketch.compactors)
+        self.assertEqual(copy.quantiles([0.5, 0.99]),
+                         sketch.quantiles([0.5, 0.99]))
+        self.assertEqual(KLLSketch.from_string(KLLSketch().to_string())
+                         .quantile(0.5), None)
@@ -0,0 +1,91 @@
+import json
+import shutil
+import tempfile
+import unittest
+from os import path
+
+from agora import quarantine
+from agora.logs import GoonHillyLog
+from agora.stats import PBSVideoStats
+
+
+class QuarantineTestcase(unittest.TestCase):
+
+    """
+    Test agora.quarantine and the parsers and stats that report to it
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.side_file = path.join(self.tmp_dir, 'q', 'quarantine.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def event(self, **fields):
+        event = {'x_tracking_id': 'abc', 'x_tpmid': '123',
+                 'event_type': 'MediaStarted',
+                 'event_date': '2014-09-02 17:20:54'}
+        event.update(fields)
+        return event
+
+    def test_parse_errors(self):
+        q = quarantine.Quarantine(self.side_file)
+        self.assertEqual(GoonHillyLog.parse_log_line_json('{"x', q), None)
+        self.assertEqual(
+            GoonHillyLog.parse_log_line_json('{"time": "never"}', q), None)
+        self.assertEqual(GoonHillyLog.parse_log_line('garbage', q), None)
+        self.assertEqual(GoonHillyLog.parse_log_line(
+            '2014-09-02 17:20:54,184 no bracket', q), None)
+        q.close()
+        self.assertEqual(q.counts[quarantine.UNPARSABLE], 2)
+        self.assertEqual(q.counts[quarantine.BAD_DATE], 2)
+        records = list(quarantine.read_side_file(self.side_file))
+        self.assertEqual(records[0], (quarantine.UNPARSABLE, '{"x', None))
+
+    def test_bad_events(self):
+        q = quarantine.Quarantine(self.side_file)
+        stats = PBSVideoStats(quarantine=q)
+        stats.add_event(self.event())
+        stats.add_event(self.event(x_tpmid=''))
+        stats.add_event(self.event(x_buffering_length='-3'))
+        stats.add_event(self.event(x_buffering_length='2.5'))
+        stats.add_event(self.event(x_tpmid='456'))
+        q.close()
+        self.assertEqual(q.total(), 4)
+        for reason in (quarantine.NO_MEDIA_ID, quarantine.NEGATIVE_BUFFERING,
+                       quarantine.FLOAT_BUFFERING,
+                       quarantine.MEDIA_ID_MISMATCH):
+            self.assertEqual(q.counts[reason], 1)
+        events = [event for _, _, event in
+                  quarantine.read_side_file(self.side_file)]
+        self.assertEqual(events[1]['x_buffering_length'], '-3')
+
+    def test_sampling_and_cap(self):
+        rejected = []
+        q = quarantine.Quarantine(self.side_file, sample_rate=0.5, seed=1,
+                                  on_reject=rejected.append)
+        for i in xrange(1000):
+            q.reject(quarantine.UNPARSABLE, 'line %d' % i)
+        q.close()
+        self.assertEqual(len(rejected), 1000)
+        self.assertTrue(300 < q.written < 700)
+
+        q = quarantine.Quarantine(self.side_file + '2', max_bytes=1000)
+        for i in xrange(1000):
+            q.reject(quarantine.UNPARSABLE, 'line %d' % i)
+        q.close()
+        self.assertTrue(path.getsize(self.side_file + '2') <= 1000)
+        self.assertEqual(q.written + q.dropped, 1000)
+
+    def test_no_side_file(self):
+        q = quarantine.Quarantine()
+        q.reject(quarantine.BAD_DATE, 'line')
+        self.assertEqual(q.counts[quarantine.BAD_DATE], 1)
+        self.assertEqual(q.written, 0)
+
+    def test_undecodable_line(self):
+        q = quarantine.Quarantine(self.side_file)
+        q.reject(quarantine.UNPARSABLE, 'caf\xe9\n')
+        q.close()
+        with open(self.side_file) as f:
+            self.assertEqual(json.loads(f.read())['line'], u'caf\ufffd')
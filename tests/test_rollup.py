@@ -0,0 +1,180 @@
+import unittest
+from os import path
+
+from agora.rollup import RollupStats, rollup_keys, session_partials
+from agora.stats import PBSVideoStats
+from mrjob.protocol import JSONProtocol
+
+HERE = path.abspath(path.dirname(__file__))
+
+
+class RollupStatsTestcase(unittest.TestCase):
+
+    """
+    Test agora.rollup.RollupStats
+    """
+    @staticmethod
+    def events_generator():
+        """
+        Parse the output from our VideoCondense mapper.
+        """
+        protocol = JSONProtocol()
+        input_filename = './fixtures/video-stream-mapper-sample'
+        with open(path.join(HERE, input_filename), 'r') as f:
+            for line in f:
+                yield protocol.read(line)
+
+    @classmethod
+    def setup_class(cls):
+        """
+        Build the session summaries of our sample data.
+        """
+        events = {}
+        for key, event in cls.events_generator():
+            if key:
+                events.setdefault(key, []).append(event)
+        cls.summaries = []
+        for key, key_events in events.items():
+            stats = PBSVideoStats()
+            for event in key_events:
+                stats.add_event(event)
+            cls.summaries.append(stats.summary())
+
+    def test_totals(self):
+        """
+        Totals should match the session summaries
+        """
+        stats = RollupStats()
+        for summary in self.summaries:
+            stats.add_summary(summary)
+        results = stats.summary()
+        self.assertEqual(results['sessions'], len(self.summaries))
+        self.assertEqual(
+            results['buffering_events'],
+            sum(s['buffering_events'] for s in self.summaries))
+        self.assertEqual(
+            results['playing_duration'],
+            sum(s['playing_duration'] or 0 for s in self.summaries))
+        self.assertEqual(
+            results['completed'],
+            len([s for s in self.summaries if s['finished_playback']]))
+
+    def test_merge(self):
+        """
+        Merging partials in any grouping gives the same rollup
+        """
+        whole = RollupStats()
+        partials = [RollupStats() for _ in range(3)]
+        for count, summary in enumerate(self.summaries):
+            whole.add_summary(summary)
+            partials[count % 3].add_summary(summary)
+        merged = RollupStats()
+        for partial in partials:
+            merged.merge(partial.to_dict())
+        self.assertEqual(merged.summary(), whole.summary())
+
+    def test_rollup_keys(self):
+        summary = self.summaries[0]
+        title_key, source_key, component_key = rollup_keys(summary)
+        day = summary['earliest_time'][:10]
+        self.assertEqual(title_key, ['title', day, summary['source'],
+                                     summary['component'], summary['title']])
+        self.assertEqual(source_key, ['source', day, summary['source']])
+        self.assertEqual(component_key, ['component', day, summary['source'],
+                                         summary['component']])
+
+    def test_quantiles(self):
+        """
+        Only per component rollups carry quantile sketches
+        """
+        merged = {}
+        for summary in self.summaries:
+            for key, partial in session_partials(summary):
+                stats = merged.setdefault(key[0], RollupStats())
+                stats.merge(partial)
+        self.assertEqual(merged['title'].quantiles, {})
+        results = merged['component'].summary()
+        durations = sorted(s['playing_duration'] for s in self.summaries
+                           if s['playing_duration'] is not None)
+        self.assertEqual(results['playing_duration_p50'],
+                         durations[(len(durations) - 1) // 2])
+        self.assertTrue(
+            results['buffering_length_p50'] <=
+            results['buffering_length_p95'] <=
+            results['buffering_length_p99'])
+
+    def test_distinct_counts(self):
+        """
+        Distinct counts survive merging and serialization
+        """
+        whole = RollupStats()
+        partials = [RollupStats() for _ in range(3)]
+        for count, summary in enumerate(self.summaries):
+            whole.add_summary(summary)
+            partials[count % 3].add_summary(summary)
+        merged = RollupStats()
+        for partial in partials:
+            merged.merge(partial.to_dict())
+        viewers = set(s['viewer_id'] for s in self.summaries
+                      if s['viewer_id'])
+        sessions = set(s['session_id'] for s in self.summaries
+                       if s['session_id'])
+        results = merged.summary()
+        self.assertEqual(results['distinct_viewers'],
+                         whole.summary()['distinct_viewers'])
+        # linear counting range, only a few hash collisions
+        self.assertTrue(
+            abs(results['distinct_viewers'] - len(viewers)) <= 5)
+        self.assertTrue(
+            abs(results['distinct_sessions'] - len(sessions)) <= 5)
+
+    def test_heatmaps(self):
+        """
+        Merged heatmaps should add up the bins of every session
+        """
+        partials = [RollupStats() for _ in range(2)]
+        for count, summary in enumerate(self.summaries):
+            partials[count % 2].add_summary(summary)
+        merged = RollupStats()
+        for partial in partials:
+            merged.merge(partial.to_dict())
+        results = merged.summary()
+        self.assertEqual(
+            sum(results['buffering_time_bins']),
+            sum(sum(s['buffering_time_bins'] or ())
+                for s in self.summaries))
+        self.assertEqual(
+            sum(results['buffering_percent_bins']),
+            sum(sum(s['buffering_percent_bins'] or ())
+                for s in self.summaries))
+
+    def test_bitrates(self):
+        """
+        Merged rendition seconds and bandwidth ranges should cover every
+        session
+        """
+        partials = [RollupStats() for _ in range(3)]
+        for count, summary in enumerate(self.summaries):
+            partials[count % 3].add_summary(summary)
+        merged = RollupStats()
+        for partial in partials:
+            merged.merge(partial.to_dict())
+        results = merged.summary()
+        seconds = {}
+        for summary in self.summaries:
+            for kbps, played in zip(summary['renditions'],
+                                    summary['rendition_seconds']):
+                seconds[kbps] = seconds.get(kbps, 0) + played
+        self.assertTrue(seconds)
+        self.assertEqual(dict(zip(results['renditions'],
+                                  results['rendition_seconds'])), seconds)
+        self.assertAlmostEqual(
+            results['mean_bitrate'],
+            float(sum(k * s for k, s in seconds.items())) /
+            sum(seconds.values()))
+        bandwidths = [s['min_bandwidth'] for s in self.summaries
+                      if s['min_bandwidth'] is not None]
+        self.assertEqual(results['min_bandwidth'], min(bandwidths))
+        self.assertEqual(results['max_bandwidth'], max(
+            s['max_bandwidth'] for s in self.summaries
+            if s['max_bandwidth'] is not None))
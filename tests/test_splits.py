@@ -0,0 +1,72 @@
+import gzip
+import shutil
+import tempfile
+import time
+import unittest
+from os import path
+
+from agora.ingest import open_input
+from agora.splits import coalesce, group_inputs, process_started
+
+HERE = path.abspath(path.dirname(__file__))
+
+
+class SplitsTestcase(unittest.TestCase):
+
+    """
+    Test agora.splits grouping of small inputs
+    """
+    @classmethod
+    def setup_class(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        with open(path.join(HERE, './fixtures/fluentd-log-sample')) as f:
+            cls.lines = f.readlines()
+        cls.json_files = []
+        for number in range(0, 200, 50):
+            name = path.join(cls.tmp_dir, 'fluentd-%03d.log' % number)
+            with open(name, 'w') as f:
+                # no newline at the end of a file
+                f.write(''.join(cls.lines[number:number + 50]).rstrip('\n'))
+            cls.json_files.append(name)
+        cls.gz_files = []
+        for number in range(200, 400, 50):
+            name = path.join(cls.tmp_dir, 'fluentd-%03d.gz' % number)
+            f = gzip.open(name, 'wb')
+            f.writelines(cls.lines[number:number + 50])
+            f.close()
+            cls.gz_files.append(name)
+        cls.goonhilly_file = path.join(HERE, './fixtures/goonhilly-log-sample')
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def test_groups(self):
+        """
+        Only files of one compression and format share a group
+        """
+        groups = group_inputs(
+            self.json_files + [self.goonhilly_file] + self.gz_files, 10 ** 6)
+        self.assertEqual(groups, [self.json_files, [self.goonhilly_file],
+                                  self.gz_files])
+        # files over the target size stay on their own
+        groups = group_inputs(self.json_files, 1)
+        self.assertEqual(groups, [[name] for name in self.json_files])
+
+    def test_coalesce(self):
+        output_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+        inputs = coalesce(self.json_files + self.gz_files, 10 ** 6,
+                          output_dir)
+        self.assertEqual(len(inputs), 2)
+        lines = []
+        for name in inputs:
+            f = open_input(name, external=False)
+            lines.extend(line.rstrip('\n') + '\n' for line in f)
+            f.close()
+        self.assertEqual(lines, self.lines)
+
+    def test_process_started(self):
+        started = process_started()
+        if started is None:
+            raise unittest.SkipTest('no /proc')
+        self.assertTrue(0 <= time.time() - started < 24 * 3600)
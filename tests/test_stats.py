@@ -1,4 +1,5 @@
 import copy
+import random
 import unittest
 from os import path
 
@@ -40,6 +41,14 @@ class PBSVideoStatsTestcase(unittest.TestCase):
                 key_events.append(event)
                 cls.events[key] = key_events
 
+    def test_summary_fields(self):
+        """
+        Test that SUMMARY_FIELDS lists every field of summary().
+        """
+        names = [name for name, _ in PBSVideoStats.SUMMARY_FIELDS]
+        self.assertEqual(len(names), len(set(names)))
+        self.assertEqual(set(names), set(PBSVideoStats().summary()))
+
     def test_finished_playback(self):
         """
         Test that we're accurately marking playback as finished.
@@ -196,6 +205,108 @@ class PBSVideoStatsTestcase(unittest.TestCase):
             self.assertEqual(
                 results.get('user_bitrate_events'), user_bitrate_events)
 
+    def test_rendition_time(self):
+        """
+        Test that rendition time follows the play intervals, whatever the
+        order the events arrive in
+        """
+        def event(etype, date, stream_size=None, bandwidth=None):
+            event = {'x_tracking_id': 'a', 'x_tpmid': '1',
+                     'event_type': etype,
+                     'event_date': '2014-09-02 17:%s' % date}
+            if stream_size:
+                event['x_stream_size'] = stream_size
+            if bandwidth:
+                event['x_bandwidth'] = bandwidth
+            return event
+
+        events = [event('MediaStarted', '00:00', '1000', '300000.5'),
+                  event('MediaQualityChangeAuto', '01:00', '3000'),
+                  event('MediaScrub', '02:00', '3000', 'bad'),
+                  event('MediaBufferingStart', '03:00', None, '100000'),
+                  event('MediaEnded', '05:00', '3000'),
+                  # nothing plays between an end and the next start
+                  event('MediaStarted', '10:00', '1000', '900000'),
+                  event('MediaCompleted', '10:10')]
+
+        def summarize(events):
+            stats = PBSVideoStats()
+            for e in events:
+                stats.add_event(e)
+            return stats.summary()
+
+        summary = summarize(events)
+        self.assertEqual(summary['renditions'], [1000, 3000])
+        self.assertEqual(summary['rendition_seconds'], [70, 240])
+        self.assertEqual(summary['mean_bitrate'],
+                         (1000 * 70 + 3000 * 240) / 310.0)
+        self.assertEqual(summary['playing_duration'], 310)
+        self.assertEqual(summary['min_bandwidth'], 100000.0)
+        self.assertEqual(summary['max_bandwidth'], 900000.0)
+
+        fields = ('renditions', 'rendition_seconds', 'mean_bitrate',
+                  'min_bandwidth', 'max_bandwidth', 'playing_duration')
+        orders = [list(reversed(events)),
+                  sorted(events, key=lambda e: JSONProtocol().write(None, e))]
+        for order in orders:
+            other = summarize(order)
+            self.assertEqual([other[f] for f in fields],
+                             [summary[f] for f in fields])
+
+        # the points survive the state of an incremental refresh
+        stats = PBSVideoStats()
+        for e in events[4:]:
+            stats.add_event(e)
+        state = JSONProtocol().read(JSONProtocol().write(
+            None, stats.to_state()))[1]
+        resumed = PBSVideoStats.from_state(state)
+        for e in events[:4]:
+            resumed.add_event(e)
+        self.assertEqual(resumed.summary()['rendition_seconds'],
+                         [70, 240])
+
+    def test_rendition_order(self):
+        """
+        Test that shuffled events give the rendition time of the events in
+        time order
+        """
+        def event(second, etype='MediaScrub', stream_size=None):
+            event = {'x_tracking_id': 'a', 'x_tpmid': '1',
+                     'event_type': etype,
+                     'event_date': '2014-09-02 17:%02d:%02d' % (
+                         second // 60, second % 60)}
+            if stream_size:
+                event['x_stream_size'] = stream_size
+            return event
+
+        def rendition_seconds(events):
+            stats = PBSVideoStats()
+            for e in events:
+                stats.add_event(e)
+            summary = stats.summary()
+            return summary['renditions'], summary['rendition_seconds']
+
+        start = event(0, 'MediaStarted')
+        end = event(599, 'MediaEnded')
+        # a short change inside a long run of the same rendition, in time
+        # order and arriving last
+        events = [start] + [
+            event(second, stream_size='3000' if second == 301 else '1000')
+            for second in range(599)] + [end]
+        self.assertEqual(rendition_seconds(events), ([1000, 3000], [598, 1]))
+        late = events[:302] + events[303:] + events[302:303]
+        self.assertEqual(rendition_seconds(late), ([1000, 3000], [598, 1]))
+
+        # alternating renditions
+        events = [start, end] + [
+            event(second, stream_size=('1000', '3000')[second // 7 % 2])
+            for second in range(599)]
+        expected = rendition_seconds(events)
+        for seed in range(5):
+            shuffled = list(events)
+            random.Random(seed).shuffle(shuffled)
+            self.assertEqual(rendition_seconds(shuffled), expected)
+
     def test_buffering_length(self):
         """
         Verify that we're summing the time a stream spends buffering.
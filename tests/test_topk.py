@@ -0,0 +1,66 @@
+import random
+import unittest
+
+from agora.topk import HeavyHitters, SpaceSaving, merge_heavy_hitters
+
+
+class SpaceSavingTestcase(unittest.TestCase):
+
+    """
+    Test agora.topk.SpaceSaving against exact weights
+    """
+    @classmethod
+    def setup_class(cls):
+        rand = random.Random(3)
+        # zipf-like stream of (isp, buffering length)
+        cls.stream = []
+        for _ in xrange(20000):
+            isp = 'isp-%d' % int(rand.paretovariate(1.2))
+            cls.stream.append((isp, rand.randint(1, 20)))
+        cls.exact = {}
+        for isp, weight in cls.stream:
+            cls.exact[isp] = cls.exact.get(isp, 0) + weight
+
+    def assert_bounds(self, summary):
+        """
+        Every count is an upper bound off by at most its error, and
+        untracked items weigh no more than max_error
+        """
+        for item, count, error in summary.top():
+            self.assertTrue(count - error <= self.exact[item] <= count)
+        for item, weight in self.exact.iteritems():
+            if item not in summary.counters:
+                self.assertTrue(weight <= summary.max_error)
+
+    def test_top(self):
+        summary = SpaceSaving(40)
+        for item, weight in self.stream:
+            summary.offer(item, weight)
+        self.assertEqual(summary.total, sum(self.exact.values()))
+        self.assert_bounds(summary)
+        exact_top = sorted(self.exact, key=lambda i: -self.exact[i])[:5]
+        self.assertEqual([i[0] for i in summary.top(5)], exact_top)
+
+    def test_merge(self):
+        parts = [SpaceSaving(40) for _ in range(4)]
+        for count, (item, weight) in enumerate(self.stream):
+            parts[count % 4].offer(item, weight)
+        merged = merge_heavy_hitters(p.to_dict() for p in parts)
+        self.assertEqual(len(merged.counters), 40)
+        self.assertEqual(merged.total, sum(self.exact.values()))
+        self.assert_bounds(merged)
+
+    def test_heavy_hitters(self):
+        """
+        Session summaries are tracked per day, dimension and weight
+        """
+        heavy_hitters = HeavyHitters(top_k=2)
+        heavy_hitters.add_summary({
+            'earliest_time': '2014-09-02 17:20:54', 'title': 'NOVA',
+            'isp_name': None, 'buffering_events': 3,
+            'buffering_length': None})
+        partials = dict((tuple(k), v) for k, v in heavy_hitters.partials())
+        self.assertEqual(partials.keys(), [
+            ('heavy-hitters', '2014-09-02', 'title', 'buffering_events')])
+        summary = partials.values()[0]
+        self.assertEqual(summary['counters'], [['NOVA', 3, 0]])
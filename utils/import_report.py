@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+#
+# import time report for task startup, like python 3's -X importtime
+#
+#   python utils/import_report.py [-n 20] [MODULE...]
+#
+# every module is imported in a fresh interpreter, the way hadoop streaming
+# starts each task, and the slowest imports are listed with their self and
+# cumulative times
+#
+
+import json
+import os
+import subprocess
+import sys
+import time
+from optparse import OptionParser
+
+# imports that should only happen in the phase that needs them
+HEAVY_MODULES = ('pygeoip', 'dateutil', 'boto', 'pyarrow', 'psycopg2')
+
+DEFAULT_MODULES = ('agora.jobs', 'agora.stats', 'agora.logs')
+
+
+def _child(module):
+    '''
+    Imports module with a timing hook and prints the timings as JSON
+    '''
+    import __builtin__
+    original = __builtin__.__import__
+    timings = []
+    stack = []
+
+    def timed_import(name, *args, **kwargs):
+        before = len(sys.modules)
+        stack.append(0.0)
+        start = time.time()
+        try:
+            return original(name, *args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            if len(sys.modules) > before:
+                # something new was loaded by this import
+                timings.append([name, len(stack), elapsed - nested, elapsed])
+
+    __builtin__.__import__ = timed_import
+    start = time.time()
+    __import__(module)
+    total = time.time() - start
+    __builtin__.__import__ = original
+    loaded = sorted(set(name.split('.')[0] for name in sys.modules))
+    json.dump({'module': module, 'total': total, 'timings': timings,
+               'heavy': [m for m in HEAVY_MODULES if m in loaded]},
+              sys.stdout)
+
+
+def measure(module, python=sys.executable):
+    '''
+    Import timings of module in a fresh interpreter
+    '''
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        filter(None, [root, env.get('PYTHONPATH')]))
+    output = subprocess.check_output(
+        [python, os.path.abspath(__file__), '--child', module], env=env)
+    return json.loads(output)
+
+
+def report(result, top=20, out=sys.stdout):
+    print >> out, 'import %s: %.1f ms, loads %s' % (
+        result['module'], result['total'] * 1000,
+        ', '.join(result['heavy']) or 'no heavy modules')
+    print >> out, '%10s | %10s | imported package' % (
+        'self [us]', 'cumulative')
+    slowest = sorted(result['timings'], key=lambda t: -t[3])[:top]
+    for name, depth, self_time, cumulative in slowest:
+        print >> out, '%10d | %10d | %s%s' % (
+            self_time * 10 ** 6, cumulative * 10 ** 6, '  ' * depth, name)
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] [MODULE...]')
+    parser.add_option('-n', '--top', type='int', default=20,
+                      help='number of imports listed per module')
+    parser.add_option('--child', help='internal: time one import')
+    options, modules = parser.parse_args()
+    if options.child:
+        _child(options.child)
+        return
+    for module in modules or DEFAULT_MODULES:
+        report(measure(module), options.top)
+        print
+
+
+if __name__ == "__main__":
+    main()
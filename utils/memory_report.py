@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+#
+# compares memory of parsed events and per stream state with and without
+# interning / packed ids
+#
+#   python utils/memory_report.py tests/fixtures/fluentd-log-sample
+#
+
+import sys
+import time
+
+from agora import logs
+from import_report import measure as measure_imports, report as import_report
+from agora.ids import pack_id
+from agora.memory import deep_sizeof, peak_rss_kb
+from agora.stats import PBSVideoStats
+
+
+def parse_file(path):
+    events = []
+    with open(path) as f:
+        for line in f:
+            if line.startswith('{'):
+                event = logs.GoonHillyLog.parse_log_line_json(line)
+            else:
+                event = logs.GoonHillyLog.parse_log_line(line)
+            if event:
+                events.append(event)
+    return events
+
+
+def group(events, packed):
+    streams = {}
+    for event in events:
+        key = logs.GoonHillyLog.tracking_key(event)
+        if not key:
+            continue
+        if packed:
+            key = pack_id(key)
+        if key not in streams:
+            streams[key] = PBSVideoStats()
+        streams[key].add_event(event)
+    return streams
+
+
+def measure(paths, interning, packed):
+    logs.INTERNING = interning
+    logs.clear_interned()
+    start = time.time()
+    events = []
+    for path in paths:
+        events.extend(parse_file(path))
+    streams = group(events, packed)
+    return {
+        'events': len(events),
+        'streams': len(streams),
+        'event_bytes': deep_sizeof(events),
+        'stream_bytes': deep_sizeof(streams),
+        'seconds': time.time() - start,
+    }
+
+
+def main():
+    paths = sys.argv[1:]
+    if not paths:
+        sys.exit('usage: memory_report.py FILE...')
+    before = measure(paths, interning=False, packed=False)
+    after = measure(paths, interning=True, packed=True)
+    print '%d events, %d streams' % (before['events'], before['streams'])
+    print '%-14s %14s %14s %8s' % ('', 'before', 'after', 'saved')
+    for name in ('event_bytes', 'stream_bytes'):
+        saved = 1 - float(after[name]) / before[name] if before[name] else 0
+        print '%-14s %14d %14d %7.1f%%' % (
+            name, before[name], after[name], saved * 100)
+    print '%-14s %14.2f %14.2f' % ('seconds', before['seconds'],
+                                   after['seconds'])
+    print 'peak rss: %s KB' % peak_rss_kb()
+    # task startup cost, every mapper and reducer pays it again
+    import_report(measure_imports('agora.jobs'), top=5)
+
+
+if __name__ == "__main__":
+    main()
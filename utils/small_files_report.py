@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+#
+# map task count and startup overhead with and without combined splits
+#
+#   python utils/small_files_report.py [-n 200] [-s 1048576] [-r local]
+#
+# writes -n small fluentd files generated from the sample log, runs the job
+# on them as they are and with --combine-split-size, and prints the map
+# tasks, their summed and average startup time and the wall time of each
+#
+
+import os
+import shutil
+import tempfile
+import time
+from optparse import OptionParser
+
+from agora.jobs import VideoStreamCondense
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE = os.path.join(ROOT, 'tests', 'fixtures', 'fluentd-log-sample')
+
+
+def generate(directory, files, lines_per_file):
+    with open(SAMPLE) as f:
+        lines = f.readlines()
+    paths = []
+    for number in range(files):
+        path = os.path.join(directory, 'fluentd-%05d.log' % number)
+        start = number * lines_per_file % len(lines)
+        with open(path, 'w') as f:
+            f.writelines((lines * 2)[start:start + lines_per_file])
+        paths.append(path)
+    return paths
+
+
+def run(paths, runner, args):
+    job = VideoStreamCondense(['--no-conf', '-r', runner] + args + paths)
+    started = time.time()
+    with job.make_runner() as job_runner:
+        job_runner.run()
+        for _ in job_runner.stream_output():
+            pass
+        counters = job_runner.counters()[0].get('task-overhead', {})
+    return counters, time.time() - started
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--files', type='int', default=200,
+                      help='number of small input files')
+    parser.add_option('-l', '--lines', type='int', default=20,
+                      help='lines per input file')
+    parser.add_option('-s', '--split-size', type='int', default=1024 * 1024,
+                      help='--combine-split-size of the combined run')
+    parser.add_option('-r', '--runner', default='local',
+                      help='mrjob runner (local starts a process per task)')
+    options, _ = parser.parse_args()
+    # local tasks import agora from this checkout
+    os.environ['PYTHONPATH'] = os.pathsep.join(
+        filter(None, [ROOT, os.environ.get('PYTHONPATH')]))
+
+    directory = tempfile.mkdtemp()
+    try:
+        paths = generate(directory, options.files, options.lines)
+        print '%d files of %d lines' % (len(paths), options.lines)
+        print '%-10s %10s %12s %12s %12s %10s' % (
+            'splits', 'map tasks', 'startup ms', 'avg ms', 'geoip ms',
+            'wall s')
+        for name, args in (
+                ('separate', []),
+                ('combined',
+                 ['--combine-split-size', str(options.split_size)])):
+            counters, elapsed = run(paths, options.runner, args)
+            tasks = counters.get('map-tasks', 0)
+            startup = counters.get('startup-ms', 0)
+            print '%-10s %10d %12d %12.1f %12d %10.2f' % (
+                name, tasks, startup, startup / float(tasks or 1),
+                counters.get('geoip-load-ms', 0), elapsed)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()